@@ -0,0 +1,247 @@
+﻿"""Maintenance commands for the hub database: ``python -m app.admin <command>``."""
+from __future__ import annotations
+
+import argparse
+import functools
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from app import db, retention, settings, shards, transfer
+
+
+def open_engine(db_path: Path) -> db.Engine | shards.ShardedEngine:
+    engine = shards.create_engine(db_path)
+    engine.start()
+    return engine
+
+
+def database_files(db_path: Path) -> list[Path]:
+    count = settings.get_shard_count()
+    if not count:
+        return [db_path]
+    directory = settings.get_shard_dir(db_path)
+    return [shards.shard_path(directory, index) for index in range(count)]
+
+
+def cmd_retention(args: argparse.Namespace) -> int:
+    policies = settings.get_retention_policies()
+    if not policies:
+        print("AGENTCHAT_RETENTION is not set (or not valid JSON)", file=sys.stderr)
+        return 2
+    engine = open_engine(args.db)
+    try:
+        moved = retention.run_once(engine, policies)
+    finally:
+        engine.close()
+    for room, count in sorted(moved.items()):
+        print(f"{room}: archived {count} messages")
+    if not moved:
+        print("nothing to archive")
+    return 0
+
+
+def cmd_vacuum(args: argparse.Namespace) -> int:
+    if args.full:
+        # VACUUM rewrites the file, which is also the only way to switch an
+        # existing database to incremental auto-vacuum. It blocks writers.
+        for path in database_files(args.db):
+            conn = sqlite3.connect(path, isolation_level=None)
+            try:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+            print(f"{path}: vacuum complete")
+        return 0
+    engine = open_engine(args.db)
+    status = 0
+    try:
+        for shard in engine.shards:
+            with shard.reader() as conn:
+                enabled = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+            if not enabled:
+                print(f"{shard.db_path}: incremental vacuum is off; run with --full once")
+                status = 1
+                continue
+            pages = retention.incremental_vacuum(shard, threading.Event())
+            print(f"{shard.db_path}: released {pages} pages")
+    finally:
+        engine.close()
+    return status
+
+
+def cmd_rebuild_stats(args: argparse.Namespace) -> int:
+    engine = open_engine(args.db)
+    try:
+        for shard in engine.shards:
+            started = time.monotonic()
+            shard.run_write(db.rebuild_stats).result()
+            rooms = len(shard.rooms())
+            print(f"{shard.db_path}: stats for {rooms} rooms in {time.monotonic() - started:.1f}s")
+    finally:
+        engine.close()
+    return 0
+
+
+def cmd_split_shards(args: argparse.Namespace) -> int:
+    count = args.shards or settings.get_shard_count()
+    if count < 1:
+        print("pass --shards N or set AGENTCHAT_SHARDS", file=sys.stderr)
+        return 2
+    directory = args.dest or settings.get_shard_dir(args.db)
+    try:
+        counts = shards.split_database(args.db, directory, count, settings.get_shard_map())
+    except FileExistsError as exc:
+        print(str(exc), file=sys.stderr)
+        return 1
+    for index, written in enumerate(counts):
+        print(f"{shards.shard_path(directory, index)}: {written} messages")
+    print(f"start the server with AGENTCHAT_SHARDS={count} to use the shards")
+    return 0
+
+
+def cmd_export(args: argparse.Namespace) -> int:
+    started = time.monotonic()
+    count = 0
+    out = transfer.open_output(args.output)
+    try:
+        # Shards are written one after the other; their ids may overlap.
+        for path in database_files(args.db):
+            messages = db.iter_messages(
+                path, args.after_id, rooms=args.room or None, before_id=args.before_id
+            )
+            count += transfer.export_messages(messages, out)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        else:
+            out.flush()
+    seconds = time.monotonic() - started
+    print(
+        f"exported {count} messages in {seconds:.1f}s ({count / max(seconds, 1e-9):.0f} rows/s)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def cmd_import(args: argparse.Namespace) -> int:
+    paths = database_files(args.db)
+    route = None
+    if len(paths) > 1:
+        shard_map = settings.get_shard_map()
+        shards.check_layout(settings.get_shard_dir(args.db), len(paths), shard_map)
+        route = functools.partial(shards.shard_for, count=len(paths), shard_map=shard_map)
+
+    def progress(report: transfer.ImportReport) -> None:
+        print(f"{report.imported} messages, {report.rate:.0f} rows/s", file=sys.stderr)
+
+    with ExitStack() as stack:
+        sources = (
+            (name, stack.enter_context(transfer.open_input(name))) for name in args.files
+        )
+        try:
+            report = transfer.import_messages(
+                paths,
+                sources,
+                route=route,
+                keep_ids=args.keep_ids,
+                batch_size=args.batch,
+                progress=progress,
+            )
+        except ValueError as exc:
+            print(str(exc), file=sys.stderr)
+            return 1
+    for name, lineno, reason in report.reasons:
+        print(f"{name}:{lineno}: {reason}", file=sys.stderr)
+    ids = f" (ids {report.first_id}-{report.last_id})" if report.imported and not route else ""
+    print(
+        f"imported {report.imported} messages{ids} in {report.seconds:.1f}s"
+        f" ({report.rate:.0f} rows/s)"
+    )
+    if report.rejected:
+        print(f"skipped {report.rejected} invalid lines", file=sys.stderr)
+        return 1
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Multi-agent chat hub maintenance")
+    parser.add_argument(
+        "--db", type=Path, default=None, help="SQLite path (default: $AGENTCHAT_DB)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    retention_parser = subparsers.add_parser(
+        "retention", help="archive expired messages now (uses AGENTCHAT_RETENTION)"
+    )
+    retention_parser.set_defaults(handler=cmd_retention)
+
+    vacuum_parser = subparsers.add_parser("vacuum", help="return free pages to the OS")
+    vacuum_parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rewrite the whole file; enables incremental vacuum on older databases",
+    )
+    vacuum_parser.set_defaults(handler=cmd_vacuum)
+
+    stats_parser = subparsers.add_parser(
+        "rebuild-stats", help="recompute the room/agent/kind statistics from the messages"
+    )
+    stats_parser.set_defaults(handler=cmd_rebuild_stats)
+
+    split_parser = subparsers.add_parser(
+        "split-shards", help="copy a single-file database into per-room shards"
+    )
+    split_parser.add_argument(
+        "--shards", type=int, default=0, help="shard count (default: $AGENTCHAT_SHARDS)"
+    )
+    split_parser.add_argument(
+        "--dest", type=Path, default=None, help="shard directory (default: --db without suffix)"
+    )
+    split_parser.set_defaults(handler=cmd_split_shards)
+
+    export_parser = subparsers.add_parser(
+        "export", help="write messages as NDJSON (gzip when the file name ends in .gz)"
+    )
+    export_parser.add_argument(
+        "-o", "--output", default="-", help="output file (default: stdout)"
+    )
+    export_parser.add_argument(
+        "--room", action="append", help="only this room (repeatable; default: all)"
+    )
+    export_parser.add_argument("--after-id", type=int, default=0, help="only ids above this")
+    export_parser.add_argument("--before-id", type=int, default=None, help="only ids below this")
+    export_parser.set_defaults(handler=cmd_export)
+
+    import_parser = subparsers.add_parser(
+        "import",
+        help="load NDJSON messages (from export, or archive segments); the server must be stopped",
+    )
+    import_parser.add_argument("files", nargs="+", help="NDJSON or .gz files, - for stdin")
+    import_parser.add_argument(
+        "--keep-ids",
+        action="store_true",
+        help="keep the ids in the files (new database only) instead of assigning new ones",
+    )
+    import_parser.add_argument(
+        "--batch",
+        type=int,
+        default=transfer.IMPORT_BATCH,
+        help=f"messages per transaction (default: {transfer.IMPORT_BATCH})",
+    )
+    import_parser.set_defaults(handler=cmd_import)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    args.db = args.db or settings.get_db_path()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
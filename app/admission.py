@@ -0,0 +1,131 @@
+﻿from __future__ import annotations
+
+import math
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from app import metrics
+
+
+class Throttled(Exception):
+    """A request exceeded a rate limit; retry after ``retry_after`` seconds."""
+
+    def __init__(self, scope: str, key: str, retry_after: float) -> None:
+        super().__init__(f"rate limit for {scope} {key!r} exceeded")
+        self.scope = scope
+        self.key = key
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class Overloaded(Exception):
+    """Too many requests are already waiting on the database."""
+
+    retry_after_header = "1"
+
+
+class TokenBucket:
+    """Token buckets per key: ``rate`` tokens a second, holding at most ``burst``.
+
+    Only touched from the event loop, so there is no locking. Buckets that
+    have refilled completely are forgotten once there are more than
+    ``max_keys`` of them, since a full bucket is the same as a new one.
+    """
+
+    def __init__(self, rate: float, burst: int, *, max_keys: int = 10000) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        # key -> [tokens, last refill]
+        self._buckets: dict[str, list[float]] = {}
+
+    def wait_time(self, key: str, cost: int, now: float) -> float:
+        """Seconds until ``cost`` tokens are available (0 when they are now).
+
+        A cost above ``burst`` needs a full bucket and then empties it, so
+        an oversized batch is slowed down rather than refused forever.
+        """
+        bucket = self._buckets.get(key)
+        tokens = self.burst if bucket is None else self._refill(bucket, now)
+        needed = min(cost, self.burst)
+        return 0.0 if tokens >= needed else (needed - tokens) / self.rate
+
+    def charge(self, key: str, cost: int, now: float) -> None:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._forget_full(now)
+            bucket = self._buckets[key] = [float(self.burst), now]
+        bucket[0] = max(0.0, self._refill(bucket, now) - min(cost, self.burst))
+
+    def _refill(self, bucket: list[float], now: float) -> float:
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        return bucket[0]
+
+    def _forget_full(self, now: float) -> None:
+        for key, bucket in list(self._buckets.items()):
+            if self._refill(bucket, now) >= self.burst:
+                del self._buckets[key]
+
+
+class Admission:
+    """Decides whether a request may reach the database.
+
+    ``check`` applies the per-agent and per-room token buckets to the
+    messages of one post (a batch is charged only if every bucket can pay,
+    so a rejected request costs nothing); ``slot`` caps how many requests
+    wait on the writer or the thread pool at once.
+    """
+
+    def __init__(
+        self,
+        *,
+        agent_limit: TokenBucket | None = None,
+        room_limit: TokenBucket | None = None,
+        max_in_flight: int = 0,
+    ) -> None:
+        self.agent_limit = agent_limit
+        self.room_limit = room_limit
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    def check(self, messages: Iterable[dict]) -> None:
+        """Charge one token per message or raise ``Throttled``."""
+        limits = [
+            (scope, limit)
+            for scope, limit in (("agent", self.agent_limit), ("room", self.room_limit))
+            if limit is not None
+        ]
+        if not limits:
+            return
+        costs: dict[tuple[str, str], int] = {}
+        for message in messages:
+            for scope, _ in limits:
+                key = (scope, message[scope])
+                costs[key] = costs.get(key, 0) + 1
+        now = time.monotonic()
+        by_scope = dict(limits)
+        for (scope, key), cost in costs.items():
+            delay = by_scope[scope].wait_time(key, cost, now)
+            if delay:
+                metrics.THROTTLED.inc(scope, key)
+                raise Throttled(scope, key, delay)
+        for (scope, key), cost in costs.items():
+            by_scope[scope].charge(key, cost, now)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one in-flight slot for the block, or raise ``Overloaded``."""
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            metrics.SHED.inc()
+            raise Overloaded()
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,126 @@
+﻿from __future__ import annotations
+
+import gzip
+import json
+import os
+import threading
+import urllib.parse
+from pathlib import Path
+from typing import Iterator
+
+
+def room_dirname(room: str) -> str:
+    return urllib.parse.quote(room, safe="-_").replace(".", "%2E")
+
+
+class ArchiveStore:
+    """Append-only gzip NDJSON segments of messages moved out of SQLite.
+
+    Segments live at ``<root>/<room>/<first_id>-<last_id>.ndjson.gz`` and are
+    never rewritten, so a directory listing is enough to know which id ranges
+    of a room are archived. Listings are cached per room and redone when the
+    directory's mtime changes, so segments written by other processes (other
+    workers, the admin command) show up without a restart.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        # room -> (directory mtime_ns, sorted segments)
+        self._segments: dict[str, tuple[int, list[tuple[int, int, Path]]]] = {}
+        self._lock = threading.Lock()
+
+    def last_id(self, room: str) -> int:
+        segments = self._room_segments(room)
+        return segments[-1][1] if segments else 0
+
+    def write_segment(self, room: str, rows: list[dict]) -> Path:
+        first_id, last_id = rows[0]["id"], rows[-1]["id"]
+        directory = self.root / room_dirname(room)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{first_id:012d}-{last_id:012d}.ndjson.gz"
+        # Per-process temp name: several workers may run retention at once.
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as out:
+                for row in rows:
+                    out.write(json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._segments.pop(room, None)
+        return path
+
+    def read(
+        self, room: str, after_id: int | None, limit: int, before_id: int | None = None
+    ) -> list[dict]:
+        """Up to ``limit`` archived rows right above ``after_id``, ascending."""
+        rows: list[dict] = []
+        for row in self.iter_rows(room, after_id):
+            if before_id is not None and row["id"] >= before_id:
+                break
+            rows.append(row)
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def read_before(
+        self, room: str, before_id: int, limit: int, after_id: int | None = None
+    ) -> list[dict]:
+        """Up to ``limit`` archived rows right below ``before_id``, descending."""
+        lower = after_id or 0
+        rows: list[dict] = []
+        for first_id, _, path in reversed(self._room_segments(room)):
+            if first_id >= before_id:
+                continue
+            segment = [
+                row
+                for row in self._load(path)
+                if lower < row["id"] < before_id
+            ]
+            rows.extend(reversed(segment))
+            if len(rows) >= limit or first_id <= lower:
+                break
+        return rows[:limit]
+
+    def iter_rows(self, room: str, after_id: int | None) -> Iterator[dict]:
+        start = after_id or 0
+        for _, last_id, path in self._room_segments(room):
+            if last_id <= start:
+                continue
+            for row in self._load(path):
+                if row["id"] > start:
+                    yield row
+
+    @staticmethod
+    def _load(path: Path) -> Iterator[dict]:
+        with gzip.open(path, "rb") as lines:
+            for line in lines:
+                yield json.loads(line)
+
+    def _room_segments(self, room: str) -> list[tuple[int, int, Path]]:
+        directory = self.root / room_dirname(room)
+        try:
+            mtime = directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            cached = self._segments.get(room)
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1])
+        segments = self._scan(directory)
+        with self._lock:
+            self._segments[room] = (mtime, segments)
+        return list(segments)
+
+    @staticmethod
+    def _scan(directory: Path) -> list[tuple[int, int, Path]]:
+        segments = []
+        for path in directory.glob("*.ndjson.gz"):
+            first, _, last = path.name.split(".", 1)[0].partition("-")
+            try:
+                segments.append((int(first), int(last), path))
+            except ValueError:
+                continue
+        segments.sort()
+        return segments
@@ -0,0 +1,86 @@
+﻿from __future__ import annotations
+
+import hashlib
+import re
+import stat
+from pathlib import Path
+
+import anyio
+from fastapi.staticfiles import StaticFiles
+from starlette.responses import Response
+from starlette.types import Scope
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# "app.js" is also served as "app.<12 hex digits>.js".
+_HASHED_NAME = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<suffix>\.[A-Za-z0-9]+)$")
+_STATIC_REF = re.compile(r"""(["'])/static/([^"'?#]+)\1""")
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header lists ``etag`` (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(","))
+
+
+class AssetFiles(StaticFiles):
+    """``StaticFiles`` that also serves every file under a content-hashed name.
+
+    Hashed names are cached by browsers for a year, since a changed file
+    gets a new name; plain names are revalidated (ETag / Last-Modified) on
+    every use. ``page`` rewrites an HTML page to point at the hashed names.
+    """
+
+    def __init__(self, *, directory: Path, prefix: str = "/static/") -> None:
+        super().__init__(directory=directory, check_dir=False)
+        self.prefix = prefix
+        # name -> ((mtime_ns, size), digest)
+        self._digests: dict[str, tuple[tuple[int, int], str]] = {}
+
+    def digest(self, name: str) -> str | None:
+        full_path, stat_result = self.lookup_path(name)
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            return None
+        key = (stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self._digests.get(name)
+        if cached is None or cached[0] != key:
+            cached = key, hashlib.sha256(Path(full_path).read_bytes()).hexdigest()[:12]
+            self._digests[name] = cached
+        return cached[1]
+
+    def hashed_name(self, name: str) -> str:
+        digest = self.digest(name)
+        stem, dot, suffix = name.rpartition(".")
+        if digest is None or not dot:
+            return name
+        return f"{stem}.{digest}.{suffix}"
+
+    def page(self, path: Path) -> tuple[bytes, str]:
+        """The HTML at ``path`` with static references hashed, and its ETag."""
+
+        def hashed(match: re.Match) -> str:
+            quote, name = match.groups()
+            return f"{quote}{self.prefix}{self.hashed_name(name)}{quote}"
+
+        body = _STATIC_REF.sub(hashed, path.read_text(encoding="utf-8-sig")).encode("utf-8")
+        return body, f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        match = _HASHED_NAME.match(path)
+        current = None
+        if match is not None:
+            name = match["stem"] + match["suffix"]
+            current = await anyio.to_thread.run_sync(self.digest, name)
+        if current is None:
+            response = await super().get_response(path, scope)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        response = await super().get_response(name, scope)
+        # A page from before the file changed still gets the file, uncached.
+        response.headers["Cache-Control"] = (
+            IMMUTABLE if current == match["digest"] else "no-cache"
+        )
+        return response
@@ -0,0 +1,149 @@
+﻿from __future__ import annotations
+
+import codecs
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import IO, AsyncIterable
+
+import anyio
+
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+# Characters of an attachment copied into ``content`` when a message has none.
+PREVIEW_CHARS = 500
+# Uploads are hashed and written on a worker thread in pieces of about this size.
+WRITE_CHUNK = 1024 * 1024
+# Bytes looked at to tell text from binary.
+SNIFF_BYTES = 4096
+
+
+class BlobTooLarge(Exception):
+    def __init__(self, limit: int) -> None:
+        super().__init__(f"larger than {limit} bytes")
+        self.limit = limit
+
+
+def _is_text(head: bytes) -> bool:
+    if b"\0" in head:
+        return False
+    try:
+        # Not final: ``head`` may end in the middle of a character.
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _write(out: IO[bytes], hasher, pieces: list[bytes]) -> None:
+    for piece in pieces:
+        hasher.update(piece)
+    out.writelines(pieces)
+
+
+class BlobStore:
+    """Content-addressed storage for message attachments too large for ``content``.
+
+    Files are named by the sha256 of their bytes, under ``root/<first two
+    hex digits>/``, so the same bytes uploaded twice are stored once. An
+    upload is written to ``root/tmp`` and renamed into place only when
+    complete and synced, so a blob id that resolves always names the whole
+    file.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def size(self, digest: str) -> int | None:
+        try:
+            return self.path(digest).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def _head(self, digest: str, size: int) -> bytes:
+        with open(self.path(digest), "rb") as fh:
+            return fh.read(size)
+
+    def media_type(self, digest: str) -> str:
+        """``text/plain`` for UTF-8 text, else ``application/octet-stream``;
+        raises FileNotFoundError for an unknown blob."""
+        if _is_text(self._head(digest, SNIFF_BYTES)):
+            return "text/plain; charset=utf-8"
+        return "application/octet-stream"
+
+    def preview(self, digest: str, size: int) -> str:
+        head = self._head(digest, PREVIEW_CHARS * 4)
+        if not _is_text(head[:SNIFF_BYTES]):
+            return f"[binary attachment, {size} bytes]"
+        text = head.decode("utf-8", errors="ignore")
+        if len(text) > PREVIEW_CHARS or len(head) < size:
+            return text[:PREVIEW_CHARS].rstrip() + "…"
+        return text or "[empty attachment]"
+
+    def attach(self, messages: list[dict]) -> None:
+        """Check the blob of each message that has one, filling in ``blob_size``
+        and, where ``content`` is empty, a preview. Raises ValueError for a
+        blob that was never uploaded."""
+        for message in messages:
+            digest = message.get("blob")
+            if not digest:
+                continue
+            size = self.size(digest)
+            if size is None:
+                raise ValueError(f"unknown blob {digest}")
+            message["blob_size"] = size
+            if not message["content"]:
+                message["content"] = self.preview(digest, size)
+
+    def _open_temp(self) -> tuple[IO[bytes], Path]:
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        fd, name = tempfile.mkstemp(dir=tmp_dir)
+        return os.fdopen(fd, "wb"), Path(name)
+
+    def _place(self, out: IO[bytes], tmp: Path, digest: str) -> bool:
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        final = self.path(digest)
+        if final.exists():
+            tmp.unlink()
+            return False
+        final.parent.mkdir(exist_ok=True)
+        os.replace(tmp, final)
+        return True
+
+    async def save(self, chunks: AsyncIterable[bytes]) -> tuple[str, int, bool]:
+        """Store streamed bytes; returns their id, size and whether they were new.
+
+        Raises BlobTooLarge as soon as more than ``max_bytes`` arrive.
+        """
+        out, tmp = await anyio.to_thread.run_sync(self._open_temp)
+        hasher = hashlib.sha256()
+        size = 0
+        pieces: list[bytes] = []
+        buffered = 0
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise BlobTooLarge(self.max_bytes)
+                pieces.append(chunk)
+                buffered += len(chunk)
+                if buffered >= WRITE_CHUNK:
+                    await anyio.to_thread.run_sync(_write, out, hasher, pieces)
+                    pieces = []
+                    buffered = 0
+            await anyio.to_thread.run_sync(_write, out, hasher, pieces)
+            digest = hasher.hexdigest()
+            created = await anyio.to_thread.run_sync(self._place, out, tmp, digest)
+        except BaseException:
+            out.close()
+            tmp.unlink(missing_ok=True)
+            raise
+        return digest, size, created
@@ -0,0 +1,132 @@
+﻿from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Callable
+
+from app.db import Engine, select_after
+from app.shards import ShardedEngine
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, dict], None]
+_TAIL_BATCH = 1000
+
+
+class LocalBus:
+    """Delivers published frames straight to this process's watchers.
+
+    Only correct with a single server process, which is the default setup.
+    """
+
+    def __init__(self) -> None:
+        self._deliver: Deliver | None = None
+
+    async def start(self, deliver: Deliver) -> None:
+        self._deliver = deliver
+
+    async def close(self) -> None:
+        self._deliver = None
+
+    def publish(self, room: str, payload: dict) -> None:
+        if self._deliver is not None:
+            self._deliver(room, payload)
+
+
+class SQLiteBus:
+    """Cross-process delivery by tailing the database every worker writes to.
+
+    ``publish`` does nothing: each process polls ``PRAGMA data_version`` on
+    its own connection per shard (it changes whenever another connection
+    commits) and delivers the new rows in id order, so every worker sees
+    every message, its own included, in the same per-room order. Costs up
+    to ``interval`` seconds of delivery latency and one cheap pragma per
+    shard per tick when idle.
+    """
+
+    def __init__(self, engine: Engine | ShardedEngine, interval: float = 0.05) -> None:
+        self.engine = engine
+        self.interval = max(0.001, interval)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    async def start(self, deliver: Deliver) -> None:
+        if self._thread is not None:
+            return
+        loop = asyncio.get_running_loop()
+        tails = await asyncio.to_thread(self._open_tails)
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(tails, loop, deliver), name="agentchat-bus", daemon=True
+        )
+        self._thread.start()
+
+    async def close(self) -> None:
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set()
+        await asyncio.to_thread(thread.join)
+
+    def publish(self, room: str, payload: dict) -> None:
+        return None
+
+    def _open_tails(self) -> list[list]:
+        # [shard, connection, data_version, last delivered id]
+        tails = []
+        for shard in self.engine.shards:
+            conn = sqlite3.connect(shard.db_path, check_same_thread=False)
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            last_id = conn.execute("SELECT coalesce(max(id), 0) FROM messages").fetchone()[0]
+            tails.append([shard, conn, version, last_id])
+        return tails
+
+    def _run(
+        self, tails: list[list], loop: asyncio.AbstractEventLoop, deliver: Deliver
+    ) -> None:
+        try:
+            while not self._stop.wait(self.interval):
+                for tail in tails:
+                    try:
+                        self._poll(tail, loop, deliver)
+                    except sqlite3.Error:
+                        logger.exception("bus poll failed for %s", tail[0].db_path)
+        finally:
+            for tail in tails:
+                tail[1].close()
+
+    def _poll(self, tail: list, loop: asyncio.AbstractEventLoop, deliver: Deliver) -> None:
+        shard, conn, version, last_id = tail
+        current = conn.execute("PRAGMA data_version").fetchone()[0]
+        if current == version:
+            return
+        tail[2] = current
+        while True:
+            rows = select_after(conn, shard.lookup, last_id, _TAIL_BATCH)
+            if not rows:
+                break
+            last_id = tail[3] = rows[-1]["id"]
+            # Consecutive rows of one room go out as one frame; rooms keep id order.
+            start = 0
+            for end in range(1, len(rows) + 1):
+                if end < len(rows) and rows[end]["room"] == rows[start]["room"]:
+                    continue
+                chunk = rows[start:end]
+                if len(chunk) == 1:
+                    payload = {"type": "message", "data": chunk[0]}
+                else:
+                    payload = {"type": "messages", "data": chunk}
+                loop.call_soon_threadsafe(deliver, chunk[0]["room"], payload)
+                start = end
+            if len(rows) < _TAIL_BATCH:
+                break
+
+
+def create_bus(
+    backend: str, engine: Engine | ShardedEngine, interval: float
+) -> LocalBus | SQLiteBus:
+    if backend == "sqlite":
+        return SQLiteBus(engine, interval)
+    return LocalBus()
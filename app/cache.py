@@ -0,0 +1,173 @@
+﻿from __future__ import annotations
+
+import threading
+from collections import OrderedDict, deque
+from typing import Callable
+
+# Rough per-message bookkeeping cost (dict, keys, ts string) on top of content.
+_MESSAGE_OVERHEAD = 256
+
+
+def _message_size(message: dict) -> int:
+    return _MESSAGE_OVERHEAD + len(message["content"])
+
+
+class _RoomBuffer:
+    __slots__ = ("messages", "floor", "size")
+
+    def __init__(self, messages: list[dict], floor: int) -> None:
+        self.messages: deque[dict] = deque(messages)
+        # Every message of the room with an id above ``floor`` is in ``messages``.
+        self.floor = floor
+        self.size = sum(_message_size(message) for message in messages)
+
+
+class HistoryCache:
+    """Recent messages per room, kept in bounded ring buffers.
+
+    Rooms are filled on first access from a loader (single-flight, so a storm of
+    reconnecting watchers triggers one query per room) and then kept current by
+    the writer via ``append``. Whole rooms are evicted least-recently-used once
+    the estimated size exceeds ``max_bytes``.
+    """
+
+    def __init__(self, room_capacity: int, max_bytes: int) -> None:
+        self.room_capacity = max(1, room_capacity)
+        self.max_bytes = max(0, max_bytes)
+        self._rooms: OrderedDict[str, _RoomBuffer] = OrderedDict()
+        self._warming: dict[str, tuple[threading.Event, list[dict]]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def ensure(self, room: str, loader: Callable[[str, int], list[dict]]) -> None:
+        """Warm ``room`` with ``loader(room, capacity)`` unless it is cached already."""
+        with self._lock:
+            if room in self._rooms:
+                return
+            warming = self._warming.get(room)
+            if warming is None:
+                self._warming[room] = (threading.Event(), [])
+        if warming is not None:
+            warming[0].wait()
+            return
+        try:
+            rows = loader(room, self.room_capacity)
+        except BaseException:
+            with self._lock:
+                event, _ = self._warming.pop(room)
+            event.set()
+            raise
+        with self._lock:
+            event, pending = self._warming.pop(room)
+            last_id = rows[-1]["id"] if rows else 0
+            rows.extend(message for message in pending if message["id"] > last_id)
+            if len(rows) < self.room_capacity:
+                floor = 0
+            else:
+                rows = rows[-self.room_capacity :]
+                floor = rows[0]["id"] - 1
+            buffer = _RoomBuffer(rows, floor)
+            self._rooms[room] = buffer
+            self._size += buffer.size
+            self._evict(keep=room)
+        event.set()
+
+    def append(self, messages: list[dict]) -> None:
+        with self._lock:
+            for message in messages:
+                room = message["room"]
+                warming = self._warming.get(room)
+                if warming is not None:
+                    warming[1].append(message)
+                    continue
+                buffer = self._rooms.get(room)
+                if buffer is None:
+                    continue
+                buffer.messages.append(message)
+                size = _message_size(message)
+                buffer.size += size
+                self._size += size
+                if len(buffer.messages) > self.room_capacity:
+                    dropped = buffer.messages.popleft()
+                    buffer.floor = dropped["id"]
+                    size = _message_size(dropped)
+                    buffer.size -= size
+                    self._size -= size
+            self._evict()
+
+    def recent(self, room: str, limit: int) -> list[dict] | None:
+        """The latest ``limit`` messages in ascending order, or None on a miss."""
+        rows = self.page(room, None, None, limit, descending=True)
+        if rows is not None:
+            rows.reverse()
+        return rows
+
+    def page(
+        self,
+        room: str,
+        after_id: int | None,
+        before_id: int | None,
+        limit: int,
+        descending: bool = False,
+    ) -> list[dict] | None:
+        """Up to ``limit`` messages strictly between the bounds, in scan order.
+
+        Ascending pages start right above ``after_id``, descending ones right
+        below ``before_id``. Returns None unless the buffer is known to hold
+        every message the page could contain.
+        """
+        lower = after_id or 0
+        with self._lock:
+            buffer = self._touch(room)
+            if buffer is None:
+                return None
+            if not descending:
+                if lower < buffer.floor:
+                    return None
+                newer: list[dict] = []
+                for message in reversed(buffer.messages):
+                    if message["id"] <= lower:
+                        break
+                    newer.append(message)
+                newer.reverse()
+                if before_id is not None:
+                    newer = [m for m in newer if m["id"] < before_id]
+                return newer[:limit]
+            older: list[dict] = []
+            for message in reversed(buffer.messages):
+                if message["id"] <= lower:
+                    return older
+                if before_id is None or message["id"] < before_id:
+                    older.append(message)
+                    if len(older) >= limit:
+                        return older
+            # Ran off the start of the buffer: complete only if nothing between
+            # ``lower`` and the oldest buffered message can exist.
+            if buffer.floor > lower:
+                return None
+            return older
+
+    def invalidate(self, room: str | None = None) -> None:
+        with self._lock:
+            rooms = list(self._rooms) if room is None else [room]
+            for name in rooms:
+                buffer = self._rooms.pop(name, None)
+                if buffer is not None:
+                    self._size -= buffer.size
+
+    def _touch(self, room: str) -> _RoomBuffer | None:
+        buffer = self._rooms.get(room)
+        if buffer is not None:
+            self._rooms.move_to_end(room)
+        return buffer
+
+    def _evict(self, keep: str | None = None) -> None:
+        while self._size > self.max_bytes and self._rooms:
+            room, buffer = next(iter(self._rooms.items()))
+            if room == keep:
+                if len(self._rooms) == 1:
+                    return
+                self._rooms.move_to_end(room)
+                continue
+            del self._rooms[room]
+            self._size -= buffer.size
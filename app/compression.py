@@ -0,0 +1,126 @@
+﻿from __future__ import annotations
+
+import gzip
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is always available
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Bodies larger than this are compressed on a worker thread, not the event loop.
+THREAD_THRESHOLD = 64 * 1024
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "text/",
+)
+
+
+def brotli_available() -> bool:
+    return brotli is not None
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    """The best of ``br`` and ``gzip`` the client accepts, or None."""
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        offered[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if offered.get(encoding, offered.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the output (and so any cache) stable for equal bodies.
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compressible(headers: Headers) -> bool:
+    content_type = headers.get("content-type", "")
+    return (
+        "content-encoding" not in headers
+        and not content_type.startswith("text/event-stream")
+        and content_type.startswith(COMPRESSIBLE_TYPES)
+    )
+
+
+class CompressionMiddleware:
+    """Compresses complete HTTP responses of at least ``minimum_size`` bytes.
+
+    Only responses sent as a single body are touched; streamed ones (SSE,
+    exports) pass through unchanged so nothing is held back waiting for the
+    compressor. A strong ETag becomes weak, as the bytes no longer match it.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Message | None = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            body = message.get("body", b"")
+            headers = MutableHeaders(scope=start)
+            if (
+                message.get("more_body", False)
+                or start["status"] != 200
+                or len(body) < self.minimum_size
+                or not _compressible(headers)
+            ):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            if len(body) > THREAD_THRESHOLD:
+                body = await anyio.to_thread.run_sync(compress, body, encoding)
+            else:
+                body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag is not None and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,72 +1,1211 @@
 ﻿from __future__ import annotations
 
+import queue
 import sqlite3
-from datetime import datetime, timezone
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, Sequence
 
-def _connect(db_path: Path) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+from app import metrics
+from app.archive import ArchiveStore
+from app.cache import HistoryCache
+
+SCHEMA_VERSION = 4
+
+# Message columns stored as ids into small lookup tables.
+_LOOKUPS = {"room": "rooms", "agent": "agents", "kind": "kinds"}
+MESSAGE_COLUMNS = "id, ts, room_id, agent_id, kind_id, content, blob, blob_size"
+_INSERT_SQL = (
+    "INSERT INTO messages (ts, room_id, agent_id, kind_id, content, blob, blob_size)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+_INSERT_WITH_ID_SQL = (
+    "INSERT INTO messages (id, ts, room_id, agent_id, kind_id, content, blob, blob_size)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_STATS_UPSERTS = (
+    # room_stats: (room_id, messages, last_id, last_ts)
+    "INSERT INTO room_stats VALUES (?, ?, ?, ?) ON CONFLICT (room_id) DO UPDATE SET"
+    " messages = messages + excluded.messages,"
+    " last_ts = CASE WHEN excluded.last_id > last_id THEN excluded.last_ts ELSE last_ts END,"
+    " last_id = MAX(last_id, excluded.last_id)",
+    # room_agent_stats: (room_id, agent_id, messages, last_id, last_ts)
+    "INSERT INTO room_agent_stats VALUES (?, ?, ?, ?, ?) ON CONFLICT (room_id, agent_id)"
+    " DO UPDATE SET messages = messages + excluded.messages,"
+    " last_ts = CASE WHEN excluded.last_id > last_id THEN excluded.last_ts ELSE last_ts END,"
+    " last_id = MAX(last_id, excluded.last_id)",
+    # room_kind_stats: (room_id, kind_id, messages)
+    "INSERT INTO room_kind_stats VALUES (?, ?, ?) ON CONFLICT (room_id, kind_id)"
+    " DO UPDATE SET messages = messages + excluded.messages",
+    # room_minute_stats: (room_id, minute, messages)
+    "INSERT INTO room_minute_stats VALUES (?, ?, ?) ON CONFLICT (room_id, minute)"
+    " DO UPDATE SET messages = messages + excluded.messages",
+)
+MINUTE_MICROS = 60_000_000
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_STOP = object()
+
+
+class _Job:
+    __slots__ = ("fn", "future")
+
+    def __init__(self, fn: Callable[[sqlite3.Connection], object]) -> None:
+        self.fn = fn
+        self.future: Future = Future()
+
+
+def _connect(db_path: Path, **kwargs: object) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, **kwargs)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def to_micros(ts: str) -> int:
+    """ISO-8601 timestamp to integer microseconds since the epoch (naive means UTC)."""
+    parsed = datetime.fromisoformat(ts)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    delta = parsed - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def from_micros(value: int) -> str:
+    """Inverse of ``to_micros``, formatted like ``datetime.isoformat()`` in UTC."""
+    seconds, micros = divmod(value, 1_000_000)
+    if micros:
+        return f"{_second_prefix(seconds)}.{micros:06d}+00:00"
+    return _second_prefix(seconds) + "+00:00"
+
+
+@lru_cache(maxsize=4096)
+def _second_prefix(seconds: int) -> str:
+    # Rows of a history page are usually seconds apart, so this hits often and
+    # saves building a datetime per row.
+    return (_EPOCH + timedelta(seconds=seconds)).replace(tzinfo=None).isoformat()
+
+
 def init_db(db_path: Path) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
-    with _connect(db_path) as conn:
+    conn = _connect(db_path, isolation_level=None)
+    try:
+        # Only takes effect for a new file; existing ones need a full VACUUM
+        # (see ``python -m app.admin vacuum --full``).
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA foreign_keys=ON;")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 2 and _has_column(conn, "messages", "room"):
+                _migrate_v1(conn)
+            _create_schema(conn)
+            if not _has_column(conn, "messages", "blob"):
+                conn.execute("ALTER TABLE messages ADD COLUMN blob TEXT")
+                conn.execute("ALTER TABLE messages ADD COLUMN blob_size INTEGER")
+            _init_fts(conn)
+            if version < 3:
+                rebuild_stats(conn)
+            if version < SCHEMA_VERSION:
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def _has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM pragma_table_info(?) WHERE name = ?", (table, column)
+    ).fetchone()
+    return row is not None
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    for table in _LOOKUPS.values():
         conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ts TEXT NOT NULL,
-                room TEXT NOT NULL,
-                agent TEXT NOT NULL,
-                kind TEXT NOT NULL,
-                content TEXT NOT NULL
-            );
-            """
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)"
         )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            room_id INTEGER NOT NULL REFERENCES rooms(id),
+            agent_id INTEGER NOT NULL REFERENCES agents(id),
+            kind_id INTEGER NOT NULL REFERENCES kinds(id),
+            content TEXT NOT NULL,
+            -- sha256 of an attachment in the blob store; content is then its preview
+            blob TEXT,
+            blob_size INTEGER
+        );
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id, id);"
+    )
+    # Summaries of the rows in ``messages``, kept current by every write so
+    # listing rooms or their activity never scans messages (see add_stats).
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS room_stats (
+            room_id INTEGER PRIMARY KEY,
+            messages INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS room_agent_stats (
+            room_id INTEGER NOT NULL,
+            agent_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            PRIMARY KEY (room_id, agent_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS room_kind_stats (
+            room_id INTEGER NOT NULL,
+            kind_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (room_id, kind_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS room_minute_stats (
+            room_id INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (room_id, minute)
+        ) WITHOUT ROWID;
+        """
+    )
+    # Named leases for maintenance that only one process may run at a time.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        """
+    )
+
+
+def _migrate_v1(conn: sqlite3.Connection) -> None:
+    # v1 stored room/agent/kind as TEXT on every row and ts as an ISO string.
+    # Ids, content and the AUTOINCREMENT high-water mark carry over unchanged,
+    # so the external-content FTS index stays valid without a rebuild.
+    conn.create_function("agentchat_micros", 1, to_micros, deterministic=True)
+    seq = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'messages'"
+    ).fetchone()
+    for table in _LOOKUPS.values():
         conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room, id);"
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)"
+        )
+    for column, table in _LOOKUPS.items():
+        conn.execute(
+            f"INSERT OR IGNORE INTO {table} (name) SELECT DISTINCT {column} FROM messages"
+        )
+    conn.execute("ALTER TABLE messages RENAME TO messages_v1")
+    conn.execute("DROP INDEX IF EXISTS idx_messages_room_id")
+    _create_schema(conn)
+    conn.execute(
+        """
+        INSERT INTO messages (id, ts, room_id, agent_id, kind_id, content)
+        SELECT m.id, agentchat_micros(m.ts), r.id, a.id, k.id, m.content
+        FROM messages_v1 m
+        JOIN rooms r ON r.name = m.room
+        JOIN agents a ON a.name = m.agent
+        JOIN kinds k ON k.name = m.kind
+        ORDER BY m.id
+        """
+    )
+    for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE messages_v1")
+    if seq is not None:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'messages'")
+        conn.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (seq[0],)
         )
 
 
-def insert_message(db_path: Path, message: dict) -> dict:
-    ts = message.get("ts") or datetime.now(timezone.utc).isoformat()
-    room = message["room"]
-    agent = message["agent"]
-    kind = message["kind"]
-    content = message["content"]
-    with _connect(db_path) as conn:
-        cur = conn.execute(
-            "INSERT INTO messages (ts, room, agent, kind, content) VALUES (?, ?, ?, ?, ?)",
-            (ts, room, agent, kind, content),
-        )
-        msg_id = cur.lastrowid
-    return {
-        "id": msg_id,
-        "ts": ts,
-        "room": room,
-        "agent": agent,
-        "kind": kind,
-        "content": content,
+def _init_fts(conn: sqlite3.Connection) -> None:
+    # External-content FTS5 index over messages.content, kept in sync by triggers
+    # so every write path (engine, scripts, imports) is covered.
+    existed = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    ).fetchone()
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id'
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content)
+            VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END;
+        """
+    )
+    if not existed:
+        conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+class NameLookup:
+    """Process-local copy of the rooms/agents/kinds tables (name <-> id).
+
+    Names are looked up in the database only on a miss. Ids created by the
+    writer are kept aside and published with ``remember_created`` once their
+    transaction has committed, so a rollback cannot leave phantom ids behind.
+    """
+
+    def __init__(self) -> None:
+        self._ids: dict[str, dict[str, int]] = {t: {} for t in _LOOKUPS.values()}
+        self._names: dict[str, dict[int, str]] = {t: {} for t in _LOOKUPS.values()}
+        self._lock = threading.Lock()
+
+    def id_of(self, conn: sqlite3.Connection, table: str, name: str) -> int | None:
+        ident = self._ids[table].get(name)
+        if ident is not None:
+            return ident
+        row = conn.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self._ids[table][name] = row[0]
+            self._names[table][row[0]] = name
+        return row[0]
+
+    def name_of(self, conn: sqlite3.Connection, table: str, ident: int) -> str:
+        # Plain dict reads are safe without the lock; only updates take it.
+        name = self._names[table].get(ident)
+        if name is not None:
+            return name
+        rows = conn.execute(f"SELECT id, name FROM {table}").fetchall()
+        with self._lock:
+            for row_id, row_name in rows:
+                self._ids[table][row_name] = row_id
+                self._names[table][row_id] = row_name
+            return self._names[table][ident]
+
+    def ids_for(
+        self, conn: sqlite3.Connection, row: dict, created: dict[tuple[str, str], int]
+    ) -> tuple[int, int, int]:
+        """Ids for a row's room/agent/kind inside a write transaction, adding new names."""
+        ids = []
+        for column, table in _LOOKUPS.items():
+            name = row[column]
+            ident = created.get((table, name))
+            if ident is None:
+                ident = self.id_of(conn, table, name)
+            if ident is None:
+                cur = conn.execute(f"INSERT INTO {table} (name) VALUES (?)", (name,))
+                ident = cur.lastrowid
+                created[(table, name)] = ident
+            ids.append(ident)
+        return ids[0], ids[1], ids[2]
+
+    def remember_created(self, created: dict[tuple[str, str], int]) -> None:
+        with self._lock:
+            for (table, name), ident in created.items():
+                self._ids[table][name] = ident
+                self._names[table][ident] = name
+
+    def messages(
+        self,
+        conn: sqlite3.Connection,
+        rows: Iterable[Sequence],
+        extra: tuple[str, ...] = (),
+    ) -> list[dict]:
+        """API-shaped dicts for rows selected as ``MESSAGE_COLUMNS`` plus ``extra`` columns."""
+        rooms, agents, kinds = (self._names[t] for t in ("rooms", "agents", "kinds"))
+        result = []
+        for row in rows:
+            ident, ts, room_id, agent_id, kind_id, content, blob, blob_size = row[:8]
+            message = {
+                "id": ident,
+                "ts": from_micros(ts),
+                "room": rooms.get(room_id) or self.name_of(conn, "rooms", room_id),
+                "agent": agents.get(agent_id) or self.name_of(conn, "agents", agent_id),
+                "kind": kinds.get(kind_id) or self.name_of(conn, "kinds", kind_id),
+                "content": content,
+            }
+            if blob is not None:
+                message["blob"] = blob
+                message["blob_size"] = blob_size
+            if extra:
+                message.update(zip(extra, row[8:]))
+            result.append(message)
+        return result
+
+
+def _prepare(message: dict) -> dict:
+    # Round-trip a caller-supplied ts so the saved row matches what reads return.
+    ts = message.get("ts")
+    prepared = {
+        "ts": from_micros(to_micros(ts)) if ts else datetime.now(timezone.utc).isoformat(),
+        "room": message["room"],
+        "agent": message["agent"],
+        "kind": message["kind"],
+        "content": message["content"],
     }
+    if message.get("blob"):
+        prepared["blob"] = message["blob"]
+        prepared["blob_size"] = message["blob_size"]
+    return prepared
 
 
-def fetch_messages(
-    db_path: Path, room: str, limit: int, after_id: int | None
-) -> list[dict]:
-    limit = max(1, min(limit, 1000))
-    query = (
-        "SELECT id, ts, room, agent, kind, content FROM messages WHERE room = ?"
+def write_rows(
+    conn: sqlite3.Connection,
+    lookup: NameLookup,
+    rows: list[dict],
+    *,
+    keep_ids: bool = False,
+) -> tuple[dict[tuple[str, str], int], int]:
+    """Insert prepared rows in the caller's transaction and update the stats.
+
+    With ``keep_ids`` each row's ``id`` is written as-is (migrations, imports).
+    Returns the lookup names created, for ``lookup.remember_created`` after
+    the commit, and the id of the last row (``last_insert_rowid()`` no longer
+    is by then: the stats upserts change it).
+    """
+    created: dict[tuple[str, str], int] = {}
+    params = []
+    for row in rows:
+        values = (
+            to_micros(row["ts"]),
+            *lookup.ids_for(conn, row, created),
+            row["content"],
+            row.get("blob"),
+            row.get("blob_size"),
+        )
+        params.append((row["id"], *values) if keep_ids else values)
+    conn.executemany(_INSERT_WITH_ID_SQL if keep_ids else _INSERT_SQL, params)
+    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    if keep_ids:
+        add_stats(conn, [values[:5] for values in params])
+    else:
+        # The caller holds the write lock, so the rows got consecutive ids.
+        first_id = last_id - len(params) + 1
+        add_stats(conn, [(first_id + n, *values[:4]) for n, values in enumerate(params)])
+    return created, last_id
+
+
+def add_stats(
+    conn: sqlite3.Connection, rows: Iterable[tuple[int, int, int, int, int]], sign: int = 1
+) -> None:
+    """Fold ``(id, ts, room_id, agent_id, kind_id)`` rows into the stats tables.
+
+    Rows are aggregated first, so a batch costs one upsert per room, agent,
+    kind and minute it touches. ``sign=-1`` takes deleted rows back out; the
+    last id/ts then stay as they were.
+    """
+    by_room: dict[int, list[int]] = {}
+    by_agent: dict[tuple[int, int], list[int]] = {}
+    by_kind: dict[tuple[int, int], int] = {}
+    by_minute: dict[tuple[int, int], int] = {}
+    for ident, ts, room_id, agent_id, kind_id in rows:
+        for key, totals in ((room_id, by_room), ((room_id, agent_id), by_agent)):
+            entry = totals.get(key)
+            if entry is None:
+                totals[key] = [sign, ident, ts]
+            else:
+                entry[0] += sign
+                if ident > entry[1]:
+                    entry[1], entry[2] = ident, ts
+        key = (room_id, kind_id)
+        by_kind[key] = by_kind.get(key, 0) + sign
+        key = (room_id, ts // MINUTE_MICROS)
+        by_minute[key] = by_minute.get(key, 0) + sign
+    if not by_room:
+        return
+    room_sql, agent_sql, kind_sql, minute_sql = _STATS_UPSERTS
+    conn.executemany(room_sql, [(key, *entry) for key, entry in by_room.items()])
+    conn.executemany(agent_sql, [(*key, *entry) for key, entry in by_agent.items()])
+    conn.executemany(kind_sql, [(*key, count) for key, count in by_kind.items()])
+    conn.executemany(minute_sql, [(*key, count) for key, count in by_minute.items()])
+    if sign < 0:
+        for table in ("room_agent_stats", "room_kind_stats", "room_minute_stats"):
+            conn.execute(f"DELETE FROM {table} WHERE messages <= 0")
+
+
+def delete_range(conn: sqlite3.Connection, room_id: int, first_id: int, last_id: int) -> None:
+    """Delete a room's messages with ids in ``[first_id, last_id]``, keeping the stats in step."""
+    rows = conn.execute(
+        "SELECT id, ts, room_id, agent_id, kind_id FROM messages"
+        " WHERE room_id = ? AND id BETWEEN ? AND ?",
+        (room_id, first_id, last_id),
+    ).fetchall()
+    add_stats(conn, [tuple(row) for row in rows], sign=-1)
+    conn.execute(
+        "DELETE FROM messages WHERE room_id = ? AND id BETWEEN ? AND ?",
+        (room_id, first_id, last_id),
+    )
+
+
+def take_lease(conn: sqlite3.Connection, name: str, owner: str, seconds: float) -> bool:
+    """Claim or renew lease ``name`` for ``seconds``; False while another owner holds it.
+
+    Run in a write transaction (``Engine.run_write``). A holder that dies
+    without ``release_lease`` only blocks others until the lease expires.
+    """
+    now = time.time()
+    conn.execute(
+        "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET"
+        " owner = excluded.owner, expires = excluded.expires"
+        " WHERE leases.owner = excluded.owner OR leases.expires < ?",
+        (name, owner, now + seconds, now),
+    )
+    row = conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+    return row[0] == owner
+
+
+def release_lease(conn: sqlite3.Connection, name: str, owner: str) -> None:
+    conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+def rebuild_stats(conn: sqlite3.Connection) -> None:
+    """Recompute the stats tables from ``messages`` in the caller's transaction."""
+    for table in ("room_stats", "room_agent_stats", "room_kind_stats", "room_minute_stats"):
+        conn.execute(f"DELETE FROM {table}")
+    # With MAX(), SQLite takes the bare ``ts`` column from the row holding the max.
+    conn.execute(
+        "INSERT INTO room_stats SELECT room_id, COUNT(*), MAX(id), ts"
+        " FROM messages GROUP BY room_id"
     )
-    params: list[object] = [room]
+    conn.execute(
+        "INSERT INTO room_agent_stats SELECT room_id, agent_id, COUNT(*), MAX(id), ts"
+        " FROM messages GROUP BY room_id, agent_id"
+    )
+    conn.execute(
+        "INSERT INTO room_kind_stats SELECT room_id, kind_id, COUNT(*)"
+        " FROM messages GROUP BY room_id, kind_id"
+    )
+    conn.execute(
+        "INSERT INTO room_minute_stats SELECT room_id, ts / ?, COUNT(*)"
+        " FROM messages GROUP BY 1, 2",
+        (MINUTE_MICROS,),
+    )
+
+
+@contextmanager
+def bulk_load(conn: sqlite3.Connection) -> Iterator[int]:
+    """Defer index upkeep while the block inserts many rows through ``conn``.
+
+    The FTS insert trigger is dropped and the new rows are indexed in one
+    statement at the end; on an empty table the room index is dropped and
+    rebuilt too, which is much cheaper than maintaining it row by row. Yields
+    the highest id ever assigned before the load, so 0 only for a table that
+    never had rows (not one emptied by retention). The indexes are restored
+    however the block exits. ``conn`` must be in autocommit mode.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        high = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        sequence = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'messages'"
+        ).fetchone()
+        if sequence is not None:
+            high = max(high, sequence[0])
+        empty = conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+        conn.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+        if empty:
+            conn.execute("DROP INDEX IF EXISTS idx_messages_room_id")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    try:
+        yield high
+    finally:
+        # Also covers rows other writers added meanwhile: they all have
+        # higher ids, and the trigger is only restored in this transaction.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO messages_fts(rowid, content)"
+                " SELECT id, content FROM messages WHERE id > ?",
+                (high,),
+            )
+            _create_schema(conn)
+            _init_fts(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def _history_query(
+    room_id: int,
+    limit: int,
+    after_id: int | None,
+    before_id: int | None = None,
+    descending: bool = False,
+) -> tuple[str, list[object]]:
+    # Both bounds and either direction are range scans on idx_messages_room_id.
+    query = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room_id = ?"
+    params: list[object] = [room_id]
     if after_id is not None:
         query += " AND id > ?"
         params.append(after_id)
-    query += " ORDER BY id ASC LIMIT ?"
+    if before_id is not None:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?" if descending else " ORDER BY id ASC LIMIT ?"
+    params.append(max(1, limit))
+    return query, params
+
+
+def scans_down(after_id: int | None, before_id: int | None, order: str) -> bool:
+    """Whether a page is read from its upper bound downwards.
+
+    A lone ``before_id`` pages backwards and a lone ``after_id`` forwards;
+    with no bound (or both) the requested order decides.
+    """
+    if (after_id is None) != (before_id is None):
+        return before_id is not None
+    return order == "desc"
+
+
+def _fts_query(text: str) -> str:
+    # Each whitespace-separated term becomes a quoted FTS5 string so that
+    # punctuation from tracebacks cannot break the query; a trailing * keeps
+    # its prefix-match meaning.
+    terms = []
+    for term in text.split():
+        prefix = term.endswith("*") and len(term) > 1
+        if prefix:
+            term = term[:-1]
+        quoted = '"' + term.replace('"', '""') + '"'
+        terms.append(quoted + "*" if prefix else quoted)
+    return " ".join(terms)
+
+
+def _search_query(
+    text: str,
+    *,
+    filters: dict[str, int],
+    order: str,
+    after: dict | None,
+    limit: int,
+) -> tuple[str, list[object]]:
+    query = (
+        "SELECT m.id, m.ts, m.room_id, m.agent_id, m.kind_id, m.content, m.blob, m.blob_size,"
+        " snippet(messages_fts, 0, '[', ']', '...', 16) AS snippet,"
+        " messages_fts.rank AS rank"
+        " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        " WHERE messages_fts MATCH ?"
+    )
+    params: list[object] = [_fts_query(text)]
+    for column, value in filters.items():
+        query += f" AND m.{column} = ?"
+        params.append(value)
+    if order == "recent":
+        if after is not None:
+            query += " AND messages_fts.rowid < ?"
+            params.append(after["id"])
+        query += " ORDER BY messages_fts.rowid DESC"
+    else:
+        if after is not None:
+            query += (
+                " AND (messages_fts.rank > ?"
+                " OR (messages_fts.rank = ? AND messages_fts.rowid > ?))"
+            )
+            params.extend([after["rank"], after["rank"], after["id"]])
+        query += " ORDER BY messages_fts.rank, messages_fts.rowid"
+    query += " LIMIT ?"
     params.append(limit)
-    with _connect(db_path) as conn:
-        rows = conn.execute(query, params).fetchall()
-    return [dict(row) for row in rows]
+    return query, params
+
+
+def _select_room(
+    conn: sqlite3.Connection,
+    lookup: NameLookup,
+    room: str,
+    limit: int,
+    after_id: int | None,
+    before_id: int | None,
+    descending: bool,
+) -> list[dict]:
+    room_id = lookup.id_of(conn, "rooms", room)
+    if room_id is None:
+        return []
+    query, params = _history_query(room_id, limit, after_id, before_id, descending)
+    # Plain tuples: sqlite3.Row buys nothing here and costs per row.
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return lookup.messages(conn, cursor.execute(query, params))
+
+
+def insert_message(db_path: Path, message: dict) -> dict:
+    row = _prepare(message)
+    # ``with conn`` only commits; closing releases the file for exclusive
+    # users such as ``transfer.import_messages``.
+    conn = _connect(db_path)
+    try:
+        with conn:
+            _, msg_id = write_rows(conn, NameLookup(), [row])
+    finally:
+        conn.close()
+    return {"id": msg_id, **row}
+
+
+def fetch_messages(
+    db_path: Path,
+    room: str,
+    limit: int,
+    after_id: int | None,
+    before_id: int | None = None,
+    order: str = "asc",
+) -> list[dict]:
+    descending = scans_down(after_id, before_id, order)
+    limit = max(1, min(limit, 1000))
+    conn = _connect(db_path)
+    try:
+        rows = _select_room(conn, NameLookup(), room, limit, after_id, before_id, descending)
+    finally:
+        conn.close()
+    if descending != (order == "desc"):
+        rows.reverse()
+    return rows
+
+
+def fetch_recent(db_path: Path, room: str, limit: int) -> list[dict]:
+    """The latest ``limit`` messages of ``room``, oldest first."""
+    conn = _connect(db_path)
+    try:
+        rows = _select_room(conn, NameLookup(), room, limit, None, None, True)
+    finally:
+        conn.close()
+    rows.reverse()
+    return rows
+
+
+def select_after(
+    conn: sqlite3.Connection, lookup: NameLookup, after_id: int, limit: int
+) -> list[dict]:
+    """Up to ``limit`` messages of any room with an id above ``after_id``, in id order."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(
+        f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+        (after_id, limit),
+    )
+    return lookup.messages(conn, rows)
+
+
+def iter_messages(
+    db_path: Path,
+    after_id: int = 0,
+    chunk: int = 5000,
+    *,
+    rooms: Sequence[str] | None = None,
+    before_id: int | None = None,
+) -> Iterator[dict]:
+    """Every message in id order, read in keyset pages so memory stays flat.
+
+    ``rooms`` and ``before_id`` narrow it to some rooms and to ids below a bound.
+    """
+    lookup = NameLookup()
+    conn = _connect(db_path)
+    try:
+        if rooms is None and before_id is None:
+            while True:
+                rows = select_after(conn, lookup, after_id, chunk)
+                if not rows:
+                    return
+                yield from rows
+                after_id = rows[-1]["id"]
+        query = f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id > ?"
+        params: list[object] = []
+        if rooms is not None:
+            room_ids = [lookup.id_of(conn, "rooms", room) for room in rooms]
+            room_ids = [room_id for room_id in room_ids if room_id is not None]
+            if not room_ids:
+                return
+            query += f" AND room_id IN ({', '.join('?' * len(room_ids))})"
+            params.extend(room_ids)
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id LIMIT ?"
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        while True:
+            rows = lookup.messages(conn, cursor.execute(query, (after_id, *params, chunk)))
+            if not rows:
+                return
+            yield from rows
+            after_id = rows[-1]["id"]
+    finally:
+        conn.close()
+
+
+class Engine:
+    """Long-lived database access for the server process.
+
+    All writes go through a single writer thread that owns one connection and
+    commits whatever arrived while the previous transaction was running (plus
+    up to ``max_wait`` seconds more) as one transaction of at most
+    ``max_batch`` rows. Reads reuse pooled connections instead of reconnecting
+    and are answered from ``cache`` when the requested range is in memory, or
+    from ``archive`` when it was moved out of SQLite by retention.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        *,
+        max_batch: int = 256,
+        max_wait: float = 0.002,
+        max_idle_readers: int = 8,
+        cache: HistoryCache | None = None,
+        archive: ArchiveStore | None = None,
+    ) -> None:
+        self.db_path = db_path
+        self.cache = cache
+        self.archive = archive
+        self.lookup = NameLookup()
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self.max_idle_readers = max(0, max_idle_readers)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+        self._running = False
+        self._idle_readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+
+    @property
+    def shards(self) -> list[Engine]:
+        return [self]
+
+    @property
+    def queue_depth(self) -> int:
+        """Write requests waiting for the writer thread."""
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        if self._writer is not None:
+            return
+        init_db(self.db_path)
+        if self.cache is not None:
+            self.cache.invalidate()
+        self._running = True
+        self._writer = threading.Thread(
+            target=self._run_writer, name="agentchat-writer", daemon=True
+        )
+        self._writer.start()
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self._running = False
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._writer = None
+        with self._readers_lock:
+            idle, self._idle_readers = self._idle_readers, []
+        for conn in idle:
+            conn.close()
+
+    def submit(self, message: dict) -> Future:
+        """Queue one message for the writer; the future resolves to the saved row."""
+        return self._enqueue([_prepare(message)], single=True)
+
+    def submit_many(self, messages: list[dict]) -> Future:
+        """Queue messages to be committed together; resolves to the saved rows."""
+        return self._enqueue([_prepare(message) for message in messages], single=False)
+
+    def _enqueue(self, rows: list[dict], *, single: bool) -> Future:
+        future: Future = Future()
+        if not self._running:
+            future.set_exception(RuntimeError("database engine is not running"))
+        elif not rows:
+            future.set_result([])
+        else:
+            self._queue.put((rows, future, single, time.perf_counter()))
+        return future
+
+    def run_write(self, fn: Callable[[sqlite3.Connection], object]) -> Future:
+        """Run ``fn(conn)`` on the writer thread in its own transaction.
+
+        Used for maintenance writes so they queue up behind inserts instead of
+        contending for the SQLite write lock from another connection.
+        """
+        job = _Job(fn)
+        if not self._running:
+            job.future.set_exception(RuntimeError("database engine is not running"))
+        else:
+            self._queue.put(job)
+        return job.future
+
+    def insert_message(self, message: dict) -> dict:
+        return self.submit(message).result()
+
+    def insert_messages(self, messages: list[dict]) -> list[dict]:
+        return self.submit_many(messages).result()
+
+    def fetch_messages(
+        self,
+        room: str,
+        limit: int,
+        after_id: int | None,
+        before_id: int | None = None,
+        order: str = "asc",
+    ) -> list[dict]:
+        """One page of ``room`` strictly between the bounds, sorted by ``order``."""
+        started = time.perf_counter()
+        limit = max(1, min(limit, 1000))
+        descending = scans_down(after_id, before_id, order)
+        rows = self._scan(room, limit, after_id, before_id, descending)
+        if descending != (order == "desc"):
+            rows.reverse()
+        metrics.READ_SECONDS.observe(time.perf_counter() - started, "fetch")
+        return rows
+
+    def fetch_recent(self, room: str, limit: int) -> list[dict]:
+        """The latest ``limit`` messages of ``room``, oldest first."""
+        started = time.perf_counter()
+        rows = None
+        if self.cache is not None:
+            self.cache.ensure(room, self._load_recent)
+            rows = self.cache.recent(room, limit)
+        if rows is None:
+            rows = self._load_recent(room, limit)
+        metrics.READ_SECONDS.observe(time.perf_counter() - started, "recent")
+        return rows
+
+    def _scan(
+        self,
+        room: str,
+        limit: int,
+        after_id: int | None,
+        before_id: int | None,
+        descending: bool,
+    ) -> list[dict]:
+        # Ids up to ``archived_to`` live in archive segments, the rest in SQLite
+        # (and possibly the cache). Rows are returned in scan order.
+        archived_to = self.archive.last_id(room) if self.archive is not None else 0
+        lower = after_id or 0
+        if not archived_to or lower >= archived_to:
+            return self._scan_live(room, limit, after_id, before_id, descending)
+        if before_id is not None and before_id <= archived_to + 1:
+            if descending:
+                return self.archive.read_before(room, before_id, limit, after_id)
+            return self.archive.read(room, after_id, limit, before_id)
+        if descending:
+            rows = self._scan_live(room, limit, archived_to, before_id, True)
+            if len(rows) < limit:
+                rows += self.archive.read_before(
+                    room, archived_to + 1, limit - len(rows), after_id
+                )
+            return rows
+        rows = self.archive.read(room, after_id, limit)
+        if len(rows) < limit:
+            rows += self._scan_live(room, limit - len(rows), archived_to, before_id, False)
+        return rows
+
+    def _scan_live(
+        self,
+        room: str,
+        limit: int,
+        after_id: int | None,
+        before_id: int | None,
+        descending: bool,
+    ) -> list[dict]:
+        if self.cache is not None:
+            self.cache.ensure(room, self._load_recent)
+            cached = self.cache.page(room, after_id, before_id, limit, descending)
+            if cached is not None:
+                return cached
+        with self.reader() as conn:
+            return _select_room(
+                conn, self.lookup, room, limit, after_id, before_id, descending
+            )
+
+    def search(
+        self,
+        text: str,
+        *,
+        room: str | None = None,
+        agent: str | None = None,
+        kind: str | None = None,
+        order: str = "rank",
+        after: dict | None = None,
+        limit: int = 50,
+    ) -> tuple[list[dict], dict | None]:
+        """Full-text search returning one page of hits and the ``after`` value
+        for the next page (None when this page is the last one).
+
+        Raises ValueError for an unusable query or ``after`` value.
+        """
+        if after is not None:
+            try:
+                after = {"id": int(after["id"]), "rank": float(after.get("rank", 0.0))}
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("invalid cursor") from None
+        if not text.split():
+            return [], None
+        limit = max(1, min(limit, 200))
+        started = time.perf_counter()
+        with self.reader() as conn:
+            filters: dict[str, int] = {}
+            for column, name in (("room", room), ("agent", agent), ("kind", kind)):
+                if name is None:
+                    continue
+                ident = self.lookup.id_of(conn, _LOOKUPS[column], name)
+                if ident is None:
+                    return [], None
+                filters[f"{column}_id"] = ident
+            query, params = _search_query(
+                text, filters=filters, order=order, after=after, limit=limit
+            )
+            try:
+                rows = conn.execute(query, params).fetchall()
+            except sqlite3.OperationalError as exc:
+                raise ValueError(str(exc)) from exc
+            hits = self.lookup.messages(conn, rows, extra=("snippet", "rank"))
+        metrics.READ_SECONDS.observe(time.perf_counter() - started, "search")
+        if len(hits) < limit:
+            return hits, None
+        return hits, {"id": hits[-1]["id"], "rank": hits[-1]["rank"]}
+
+    def rooms(self) -> list[dict]:
+        """Every room with its message count and latest message, by name."""
+        started = time.perf_counter()
+        with self.reader() as conn:
+            rows = conn.execute(
+                "SELECT room_id, messages, last_id, last_ts FROM room_stats"
+            ).fetchall()
+            result = [
+                {
+                    "room": self.lookup.name_of(conn, "rooms", room_id),
+                    "messages": messages,
+                    "last_id": last_id,
+                    "last_ts": from_micros(last_ts),
+                }
+                for room_id, messages, last_id, last_ts in rows
+            ]
+        result.sort(key=lambda room: room["room"])
+        metrics.READ_SECONDS.observe(time.perf_counter() - started, "rooms")
+        return result
+
+    def room_stats(self, room: str, minutes: int = 60) -> dict | None:
+        """Counts for ``room`` per agent and kind, plus messages per minute over
+        the last ``minutes`` (by message timestamp); None for an unknown room."""
+        started = time.perf_counter()
+        with self.reader() as conn:
+            room_id = self.lookup.id_of(conn, "rooms", room)
+            summary = None
+            if room_id is not None:
+                summary = conn.execute(
+                    "SELECT messages, last_id, last_ts FROM room_stats WHERE room_id = ?",
+                    (room_id,),
+                ).fetchone()
+            if summary is None:
+                return None
+            agents = conn.execute(
+                "SELECT agent_id, messages, last_id, last_ts FROM room_agent_stats"
+                " WHERE room_id = ? ORDER BY messages DESC",
+                (room_id,),
+            ).fetchall()
+            kinds = conn.execute(
+                "SELECT kind_id, messages FROM room_kind_stats"
+                " WHERE room_id = ? ORDER BY messages DESC",
+                (room_id,),
+            ).fetchall()
+            now_minute = int(time.time()) // 60
+            per_minute = conn.execute(
+                "SELECT minute, messages FROM room_minute_stats"
+                " WHERE room_id = ? AND minute > ? ORDER BY minute",
+                (room_id, now_minute - minutes),
+            ).fetchall()
+            result = {
+                "room": room,
+                "messages": summary[0],
+                "last_id": summary[1],
+                "last_ts": from_micros(summary[2]),
+                "agents": [
+                    {
+                        "agent": self.lookup.name_of(conn, "agents", agent_id),
+                        "messages": messages,
+                        "last_id": last_id,
+                        "last_ts": from_micros(last_ts),
+                    }
+                    for agent_id, messages, last_id, last_ts in agents
+                ],
+                "kinds": [
+                    {"kind": self.lookup.name_of(conn, "kinds", kind_id), "messages": messages}
+                    for kind_id, messages in kinds
+                ],
+                "per_minute": [
+                    {"minute": from_micros(minute * MINUTE_MICROS), "messages": messages}
+                    for minute, messages in per_minute
+                ],
+            }
+        metrics.READ_SECONDS.observe(time.perf_counter() - started, "stats")
+        return result
+
+    def _load_recent(self, room: str, limit: int) -> list[dict]:
+        with self.reader() as conn:
+            rows = _select_room(conn, self.lookup, room, limit, None, None, True)
+        rows.reverse()
+        return rows
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a pooled read-only connection for the duration of the block."""
+        with self._readers_lock:
+            conn = self._idle_readers.pop() if self._idle_readers else None
+        if conn is None:
+            conn = _connect(self.db_path, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            with self._readers_lock:
+                keep = self._running and len(self._idle_readers) < self.max_idle_readers
+                if keep:
+                    self._idle_readers.append(conn)
+            if not keep:
+                conn.close()
+
+    def _run_writer(self) -> None:
+        conn = _connect(self.db_path, isolation_level=None)
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                if isinstance(item, _Job):
+                    self._run_job(conn, item)
+                    continue
+                job = None
+                batch = [item]
+                pending_rows = len(item[0])
+                deadline = time.monotonic() + self.max_wait
+                while pending_rows < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        if remaining > 0:
+                            item = self._queue.get(timeout=remaining)
+                        else:
+                            item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    if isinstance(item, _Job):
+                        job = item
+                        break
+                    batch.append(item)
+                    pending_rows += len(item[0])
+                self._commit(conn, batch)
+                if job is not None:
+                    self._run_job(conn, job)
+        finally:
+            conn.close()
+            self._fail_pending()
+
+    def _commit(
+        self, conn: sqlite3.Connection, batch: list[tuple[list[dict], Future, bool, float]]
+    ) -> None:
+        # A future cancelled before the writer picked it up is simply dropped.
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        for item in batch:
+            metrics.WRITE_QUEUE_SECONDS.observe(started - item[3])
+        rows = [row for item in batch for row in item[0]]
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            created, last_id = write_rows(conn, self.lookup, rows)
+            conn.execute("COMMIT")
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future, _, _ in batch:
+                future.set_exception(exc)
+            return
+        metrics.WRITE_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        metrics.WRITE_BATCH_ROWS.observe(len(rows))
+        metrics.MESSAGES.inc_each((row["room"], row["kind"]) for row in rows)
+        self.lookup.remember_created(created)
+        # Only this thread writes and AUTOINCREMENT ids grow by one per insert,
+        # so the rows of one transaction received consecutive ids.
+        first_id = last_id - len(rows) + 1
+        saved = [{"id": first_id + offset, **row} for offset, row in enumerate(rows)]
+        # The cache must hold the rows before any caller learns their ids.
+        if self.cache is not None:
+            self.cache.append(saved)
+        start = 0
+        for item_rows, future, single, _ in batch:
+            item_saved = saved[start : start + len(item_rows)]
+            start += len(item_rows)
+            future.set_result(item_saved[0] if single else item_saved)
+
+    def _run_job(self, conn: sqlite3.Connection, job: _Job) -> None:
+        if not job.future.set_running_or_notify_cancel():
+            return
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            result = job.fn(conn)
+            conn.execute("COMMIT")
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            job.future.set_exception(exc)
+            return
+        job.future.set_result(result)
+
+    def _fail_pending(self) -> None:
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _STOP:
+                continue
+            future = item.future if isinstance(item, _Job) else item[1]
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("database engine is not running"))
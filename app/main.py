@@ -1,18 +1,177 @@
 ﻿from __future__ import annotations
 
+import asyncio
+import hashlib
+import json
+import threading
+import time
 from pathlib import Path
 
 from contextlib import asynccontextmanager
+from typing import Literal
 
 import anyio
-from fastapi import FastAPI, Query, WebSocket
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
+from pydantic import ValidationError
 from starlette.websockets import WebSocketDisconnect
 
-from app import db, settings
-from app.realtime import ConnectionManager
-from app.schema import MessageIn, MessageOut
+from app import metrics, retention, settings
+from app.admission import Admission, Overloaded, Throttled, TokenBucket
+from app.assets import IMMUTABLE, AssetFiles, etag_matches
+from app.blobs import DIGEST, BlobStore, BlobTooLarge
+from app.bus import create_bus
+from app.cache import HistoryCache
+from app.compression import CompressionMiddleware
+from app.cursor import decode_cursor, encode_cursor
+from app.db import scans_down
+from app.realtime import BurstCoalescer, Client, ConnectionManager, decode_frame
+from app.schema import (
+    BlobRef,
+    IngestSummary,
+    MessageIn,
+    MessageOut,
+    RoomStats,
+    RoomSummary,
+    SearchPage,
+)
+from app.shards import create_engine
+
+MAX_NDJSON_LINE = 64 * 1024
+SSE_RETRY_MS = 2000
+
+
+async def _run_in_thread(fn, *args):
+    """``anyio.to_thread.run_sync`` that records how long the call waited for a thread."""
+    queued = time.perf_counter()
+
+    def call():
+        metrics.THREAD_WAIT_SECONDS.observe(time.perf_counter() - queued)
+        return fn(*args)
+
+    return await anyio.to_thread.run_sync(call)
+
+
+def _wal_bytes(db_path: Path) -> int:
+    try:
+        return (db_path.parent / f"{db_path.name}-wal").stat().st_size
+    except OSError:
+        return 0
+
+
+def _parse_ndjson_line(line: bytes, lineno: int) -> dict | None:
+    if not line.strip():
+        return None
+    try:
+        return MessageIn.model_validate_json(line).model_dump()
+    except ValidationError as exc:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", lineno, *error["loc"])} for error in exc.errors()]
+        ) from None
+
+
+def _page_from_cursor(values: dict) -> tuple[int | None, int | None, str]:
+    order = values["o"]
+    if order not in ("asc", "desc"):
+        raise ValueError("invalid order")
+    after_id = int(values["a"]) if "a" in values else None
+    before_id = int(values["b"]) if "b" in values else None
+    if (after_id is None) == (before_id is None):
+        raise ValueError("cursor needs exactly one bound")
+    return after_id, before_id, order
+
+
+def _page_key(
+    room: str, limit: int, after_id: int | None, before_id: int | None, order: str
+) -> str:
+    raw = json.dumps([room, limit, after_id, before_id, order]).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=12).hexdigest()
+
+
+def _page_etag(key: str, messages: list[dict], final: bool) -> str:
+    """ETag of a history page. Messages are never edited, so a page is
+    identified by its ids; a final page's tag depends on the query alone."""
+    if final:
+        return f'"{key}"'
+    ids = ",".join(str(message["id"]) for message in messages).encode("ascii")
+    return f'"{key}-{hashlib.blake2b(ids, digest_size=8).hexdigest()}"'
+
+
+def _parse_ws_post(frame: dict, room: str, limit: int) -> list[dict]:
+    """Messages of a ``{"type": "post", "data": {...} | [...]}`` frame; room defaults
+    to the socket's. Raises ValueError with a client-facing detail."""
+    data = frame.get("data")
+    items = data if isinstance(data, list) else [data]
+    if len(items) > limit:
+        raise ValueError(f"more than {limit} messages")
+    messages = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"message {index} is not an object")
+        try:
+            messages.append(MessageIn.model_validate({"room": room, **item}).model_dump())
+        except ValidationError as exc:
+            error = exc.errors()[0]
+            loc = ".".join(str(part) for part in error["loc"])
+            raise ValueError(f"message {index}: {loc}: {error['msg']}") from None
+    return messages
+
+
+def _parse_subscription(
+    frame: dict,
+) -> tuple[str, list[str] | None, list[str] | None, int | None]:
+    room = frame.get("room")
+    if not isinstance(room, str) or not room:
+        raise ValueError("room is required")
+    filters = []
+    for key in ("agents", "kinds"):
+        value = frame.get(key)
+        if value is not None and (
+            not isinstance(value, list) or not all(isinstance(item, str) for item in value)
+        ):
+            raise ValueError(f"{key} must be a list of strings")
+        filters.append(value or None)
+    last_id = frame.get("last_id")
+    if last_id is not None and (not isinstance(last_id, int) or isinstance(last_id, bool)):
+        raise ValueError("last_id must be an integer")
+    return room, filters[0], filters[1], last_id
+
+
+def _split_filter(raw: str | None) -> list[str] | None:
+    values = [value.strip() for value in (raw or "").split(",") if value.strip()]
+    return values or None
+
+
+async def _read_ndjson(request: Request, limit: int) -> list[dict]:
+    messages: list[dict] = []
+    buffer = b""
+    lineno = 0
+
+    def take(line: bytes) -> None:
+        nonlocal lineno
+        lineno += 1
+        message = _parse_ndjson_line(line, lineno)
+        if message is None:
+            return
+        if len(messages) >= limit:
+            raise HTTPException(status_code=413, detail=f"more than {limit} messages")
+        messages.append(message)
+
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            take(line)
+        if len(buffer) > MAX_NDJSON_LINE:
+            raise HTTPException(status_code=413, detail=f"line {lineno + 1} is too long")
+    take(buffer)
+    return messages
 
 
 def create_app(db_path: Path | None = None) -> FastAPI:
@@ -22,56 +181,527 @@ def create_app(db_path: Path | None = None) -> FastAPI:
 
     resolved_db = db_path or settings.get_db_path()
     history_limit = settings.get_history_limit()
-    manager = ConnectionManager()
+    sse_heartbeat = settings.get_sse_heartbeat()
+    ingest_limit = settings.get_ingest_max_messages()
+    manager = ConnectionManager(
+        max_queue=settings.get_ws_queue_size(), policy=settings.get_ws_overflow_policy()
+    )
+    cache_size = settings.get_cache_room_messages()
+    bus_backend = settings.get_bus_backend()
+    if bus_backend != "local":
+        # Other workers write too, and only this process's writer feeds the cache.
+        cache_size = 0
+    engine = create_engine(
+        resolved_db,
+        max_batch=settings.get_write_batch_size(),
+        max_wait=settings.get_write_max_wait(),
+        cache=(
+            HistoryCache(cache_size, settings.get_cache_max_bytes())
+            if cache_size
+            else None
+        ),
+    )
+    bus = create_bus(bus_backend, engine, settings.get_bus_poll_interval())
+    blobs = BlobStore(settings.get_blob_dir(resolved_db), settings.get_blob_max_bytes())
+    coalesce_window = settings.get_coalesce_window()
+    coalescer = (
+        BurstCoalescer(manager.broadcast, coalesce_window, settings.get_coalesce_max_messages())
+        if coalesce_window
+        else None
+    )
+    retention_policies = settings.get_retention_policies()
+    agent_rate, agent_burst = settings.get_agent_rate_limit()
+    room_rate, room_burst = settings.get_room_rate_limit()
+    admission = Admission(
+        agent_limit=TokenBucket(agent_rate, agent_burst) if agent_rate else None,
+        room_limit=TokenBucket(room_rate, room_burst) if room_rate else None,
+        max_in_flight=settings.get_max_in_flight(),
+    )
+    # Uploads stream for as long as the client takes, so they get their own cap.
+    uploads = Admission(max_in_flight=settings.get_max_uploads())
 
     @asynccontextmanager
     async def lifespan(_: FastAPI):
-        db.init_db(resolved_db)
-        yield
+        engine.start()
+        await bus.start(coalescer.publish if coalescer is not None else manager.broadcast)
+        stop = threading.Event()
+        retention_task = None
+        if retention_policies:
+            retention_task = asyncio.create_task(
+                retention.run_periodically(
+                    engine, retention_policies, settings.get_retention_interval(), stop
+                )
+            )
+        try:
+            yield
+        finally:
+            stop.set()
+            if retention_task is not None:
+                retention_task.cancel()
+                await asyncio.gather(retention_task, return_exceptions=True)
+            await bus.close()
+            if coalescer is not None:
+                coalescer.close()
+            await anyio.to_thread.run_sync(engine.close)
 
     app = FastAPI(title="Multi-Agent Chat Hub", lifespan=lifespan)
+    compress_min_bytes = settings.get_compress_min_bytes()
+    if compress_min_bytes:
+        app.add_middleware(CompressionMiddleware, minimum_size=compress_min_bytes)
+
+    @app.exception_handler(Throttled)
+    async def throttled(_: Request, exc: Throttled) -> JSONResponse:
+        return JSONResponse(
+            {"detail": str(exc), "retry_after": round(exc.retry_after, 3)},
+            status_code=429,
+            headers={"Retry-After": exc.retry_after_header},
+        )
+
+    @app.exception_handler(Overloaded)
+    async def overloaded(_: Request, exc: Overloaded) -> JSONResponse:
+        return JSONResponse(
+            {"detail": "server busy"},
+            status_code=503,
+            headers={"Retry-After": exc.retry_after_header},
+        )
+
+    def publish_batch(saved: list[dict]) -> None:
+        by_room: dict[str, list[dict]] = {}
+        for message in saved:
+            by_room.setdefault(message["room"], []).append(message)
+        for room, messages in by_room.items():
+            bus.publish(room, {"type": "messages", "data": messages})
+
+    async def attach_blobs(messages: list[dict]) -> None:
+        # Only messages with a blob touch the disk here.
+        if any(message.get("blob") for message in messages):
+            await _run_in_thread(blobs.attach, messages)
+
+    async def ingest(messages: list[dict]) -> list[dict]:
+        # Blob references are checked first so a rejected request costs no tokens.
+        try:
+            await attach_blobs(messages)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from None
+        admission.check(messages)
+        with admission.slot():
+            saved = await asyncio.wrap_future(engine.submit_many(messages))
+        publish_batch(saved)
+        return saved
+
+    async def read(fn, *args):
+        # HTTP reads only; sockets have no status code to shed load with.
+        with admission.slot():
+            return await _run_in_thread(fn, *args)
+
+    async def long_poll(
+        room: str,
+        limit: int,
+        after_id: int | None,
+        before_id: int | None,
+        order: str,
+        wait: float,
+    ) -> list[dict]:
+        """Like ``fetch_messages``, but an empty page parks the request (no
+        thread, no query) until a message is broadcast to ``room`` or ``wait``
+        seconds pass.
+
+        Once a room has had a broadcast, polls past its latest id skip the
+        database entirely, including when they time out. Every stored
+        message is broadcast: posts through this process, and with the
+        SQLite bus anything any connection commits. Imports refuse to run
+        next to a server.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            # Registered before looking, so a broadcast racing the query wakes us.
+            waiter = manager.waiter(room)
+            try:
+                latest = manager.latest_id(room)
+                if after_id is not None and latest is not None and latest <= after_id:
+                    # Nothing newer was broadcast: no need to ask the database.
+                    messages = []
+                else:
+                    messages = await read(
+                        engine.fetch_messages, room, limit, after_id, before_id, order
+                    )
+                remaining = deadline - loop.time()
+                if messages or remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    break
+            finally:
+                manager.discard_waiter(room, waiter)
+        return messages
 
+    assets = AssetFiles(directory=static_dir)
     if static_dir.exists():
-        app.mount("/static", StaticFiles(directory=static_dir), name="static")
+        app.mount("/static", assets, name="static")
 
     @app.get("/")
-    def index() -> FileResponse:
-        return FileResponse(frontend_dir / "index.html", media_type="text/html")
+    def index(request: Request) -> Response:
+        body, etag = assets.page(frontend_dir / "index.html")
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="text/html", headers=headers)
 
     @app.get("/health")
     def health() -> dict:
         return {"ok": True}
 
+    def shard_samples(read) -> list[tuple[tuple, float]]:
+        return [((str(index),), read(shard)) for index, shard in enumerate(engine.shards)]
+
+    app_metrics = (
+        metrics.Gauge(
+            "agentchat_connections",
+            "Open WebSocket and SSE watchers.",
+            lambda: [((), manager.connections)],
+        ),
+        metrics.Gauge(
+            "agentchat_watchers",
+            "Watchers subscribed per room.",
+            lambda: [((room,), count) for room, count in manager.watcher_counts().items()],
+            ("room",),
+        ),
+        metrics.Gauge(
+            "agentchat_in_flight",
+            "HTTP requests waiting on the database.",
+            lambda: [((), admission.in_flight)],
+        ),
+        metrics.Gauge(
+            "agentchat_write_queue_depth",
+            "Write requests waiting for the writer thread.",
+            lambda: shard_samples(lambda shard: shard.queue_depth),
+            ("shard",),
+        ),
+        metrics.Gauge(
+            "agentchat_sqlite_wal_bytes",
+            "Size of the SQLite write-ahead log.",
+            lambda: shard_samples(lambda shard: _wal_bytes(shard.db_path)),
+            ("shard",),
+        ),
+    )
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def prometheus_metrics() -> PlainTextResponse:
+        return PlainTextResponse(
+            metrics.render((*metrics.PROCESS_METRICS, *app_metrics)),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
     @app.get("/api/messages", response_model=list[MessageOut])
     async def get_messages(
+        request: Request,
+        response: Response,
         room: str = Query(default="default"),
         limit: int = Query(default=200, ge=1, le=1000),
         after_id: int | None = Query(default=None, ge=1),
+        before_id: int | None = Query(default=None, ge=1),
+        order: Literal["asc", "desc"] = Query(default="asc"),
+        cursor: str | None = Query(default=None),
+        wait: float = Query(default=0, ge=0, le=60),
     ) -> list[dict]:
-        return await anyio.to_thread.run_sync(
-            db.fetch_messages, resolved_db, room, limit, after_id
+        if cursor is not None:
+            try:
+                after_id, before_id, order = _page_from_cursor(decode_cursor(cursor))
+            except (KeyError, TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="invalid cursor") from None
+        # A full page read upwards from after_id can never change: new ids are
+        # always higher, and rows moved out by retention stay readable by id.
+        can_be_final = after_id is not None and not scans_down(after_id, before_id, order)
+        key = _page_key(room, limit, after_id, before_id, order)
+        if_none_match = request.headers.get("if-none-match")
+        if can_be_final and etag_matches(if_none_match, _page_etag(key, [], True)):
+            # Only ever handed out for a final page, so no need to read it again.
+            headers = {"ETag": _page_etag(key, [], True), "Cache-Control": IMMUTABLE}
+            return Response(status_code=304, headers=headers)
+        if wait:
+            messages = await long_poll(room, limit, after_id, before_id, order, wait)
+        else:
+            messages = await read(
+                engine.fetch_messages, room, limit, after_id, before_id, order
+            )
+        if messages:
+            first, last = messages[0]["id"], messages[-1]["id"]
+            # "next" continues in the requested order, "prev" goes the other way.
+            if order == "asc":
+                next_cursor = {"o": order, "a": last}
+                prev_cursor = {"o": order, "b": first}
+            else:
+                next_cursor = {"o": order, "b": last}
+                prev_cursor = {"o": order, "a": first}
+            response.headers["X-Next-Cursor"] = encode_cursor(next_cursor)
+            response.headers["X-Prev-Cursor"] = encode_cursor(prev_cursor)
+        final = can_be_final and len(messages) == limit
+        etag = _page_etag(key, messages, final)
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE if final else "no-cache"}
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return messages
+
+    @app.get("/api/search", response_model=SearchPage)
+    async def search_messages(
+        q: str = Query(min_length=1, max_length=500),
+        room: str | None = Query(default=None),
+        agent: str | None = Query(default=None),
+        kind: str | None = Query(default=None),
+        order: Literal["rank", "recent"] = Query(default="rank"),
+        limit: int = Query(default=50, ge=1, le=200),
+        cursor: str | None = Query(default=None),
+    ) -> dict:
+        after = None
+        if cursor is not None:
+            try:
+                after = decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="invalid cursor") from None
+        try:
+            hits, next_after = await read(
+                lambda: engine.search(
+                    q, room=room, agent=agent, kind=kind, order=order, after=after, limit=limit
+                )
+            )
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from None
+        next_cursor = encode_cursor(next_after) if next_after is not None else None
+        return {"hits": hits, "next_cursor": next_cursor}
+
+    @app.get("/api/rooms", response_model=list[RoomSummary])
+    async def list_rooms() -> list[dict]:
+        return await read(engine.rooms)
+
+    @app.get("/api/rooms/{room:path}/stats", response_model=RoomStats)
+    async def room_stats(room: str, minutes: int = Query(default=60, ge=1, le=1440)) -> dict:
+        stats = await read(engine.room_stats, room, minutes)
+        if stats is None:
+            raise HTTPException(status_code=404, detail=f"room {room!r} has no messages")
+        return stats
+
+    @app.get("/api/stream")
+    async def stream_messages(
+        request: Request,
+        room: str = Query(default="default", min_length=1),
+        agent: str | None = Query(default=None),
+        kind: str | None = Query(default=None),
+        last_id: int | None = Query(default=None, ge=0),
+    ) -> StreamingResponse:
+        """Server-Sent Events for one room: the same frames as /ws, one event each."""
+        header = request.headers.get("last-event-id", "")
+        if header.isdigit():
+            last_id = int(header)
+        # One slot: the client's writer waits until the response has taken
+        # the previous event, so its bounded queue and overflow policy apply.
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+        async def send(frame) -> None:
+            await outbox.put(frame.encode("sse"))
+
+        async def close(code: int, reason: str) -> None:
+            await outbox.put(None)
+
+        client = manager.open(send, close)
+        try:
+            await subscribe(client, room, _split_filter(agent), _split_filter(kind), last_id)
+        except BaseException:
+            await manager.disconnect(client)
+            raise
+
+        async def events():
+            try:
+                yield f"retry: {SSE_RETRY_MS}\n\n"
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(outbox.get(), sse_heartbeat)
+                    except asyncio.TimeoutError:
+                        yield ": ping\n\n"
+                        continue
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                await manager.disconnect(client)
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
 
     @app.post("/api/messages", response_model=MessageOut)
     async def post_message(message: MessageIn) -> dict:
-        saved = await anyio.to_thread.run_sync(
-            db.insert_message, resolved_db, message.model_dump()
-        )
-        await manager.broadcast(message.room, {"type": "message", "data": saved})
+        data = message.model_dump()
+        try:
+            await attach_blobs([data])
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from None
+        admission.check([data])
+        with admission.slot():
+            saved = await asyncio.wrap_future(engine.submit(data))
+        bus.publish(message.room, {"type": "message", "data": saved})
         return saved
 
-    @app.websocket("/ws")
-    async def websocket_endpoint(websocket: WebSocket, room: str = "default") -> None:
-        await manager.connect(room, websocket)
+    @app.post("/api/blobs", response_model=BlobRef, status_code=201)
+    async def upload_blob(request: Request, response: Response) -> dict:
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > blobs.max_bytes:
+            raise HTTPException(status_code=413, detail=f"larger than {blobs.max_bytes} bytes")
+        with uploads.slot():
+            try:
+                digest, size, created = await blobs.save(request.stream())
+            except BlobTooLarge as exc:
+                raise HTTPException(status_code=413, detail=str(exc)) from None
+        if not created:
+            response.status_code = 200
+        return {"blob": digest, "size": size}
+
+    @app.api_route("/api/blobs/{digest}", methods=["GET", "HEAD"])
+    async def get_blob(request: Request, digest: str) -> Response:
+        if not DIGEST.match(digest):
+            raise HTTPException(status_code=404, detail="unknown blob")
+        # A blob id is the hash of its bytes, so they never change.
+        etag = f'"{digest}"'
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
         try:
-            history = await anyio.to_thread.run_sync(
-                db.fetch_messages, resolved_db, room, history_limit, None
+            media_type = await _run_in_thread(blobs.media_type, digest)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="unknown blob") from None
+        headers["X-Content-Type-Options"] = "nosniff"
+        # Streams the file from a worker thread and answers Range requests.
+        return FileResponse(blobs.path(digest), media_type=media_type, headers=headers)
+
+    @app.post("/api/messages/batch", response_model=list[MessageOut])
+    async def post_messages_batch(messages: list[MessageIn]) -> list[dict]:
+        if len(messages) > ingest_limit:
+            raise HTTPException(
+                status_code=413, detail=f"more than {ingest_limit} messages"
             )
-            await websocket.send_json({"type": "history", "data": history})
+        return await ingest([message.model_dump() for message in messages])
+
+    @app.post("/api/messages/ndjson", response_model=IngestSummary)
+    async def post_messages_ndjson(request: Request) -> dict:
+        saved = await ingest(await _read_ndjson(request, ingest_limit))
+        return {
+            "count": len(saved),
+            "first_id": saved[0]["id"] if saved else None,
+            "last_id": saved[-1]["id"] if saved else None,
+        }
+
+    async def load_history(room: str, last_id: int | None) -> dict:
+        if last_id is not None:
+            delta = await _run_in_thread(
+                engine.fetch_messages, room, history_limit, last_id
+            )
+            # A full page may not be the whole gap; send the latest instead.
+            if len(delta) < history_limit:
+                return {"type": "history", "data": delta, "resumed": True}
+        history = await _run_in_thread(engine.fetch_recent, room, history_limit)
+        return {"type": "history", "data": history}
+
+    async def subscribe(
+        client: Client,
+        room: str,
+        agents: list[str] | None,
+        kinds: list[str] | None,
+        last_id: int | None,
+    ) -> None:
+        manager.subscribe(client, room, agents, kinds)
+        history = await load_history(room, last_id)
+        if agents or kinds:
+            history["data"] = [
+                message
+                for message in history["data"]
+                if (not agents or message["agent"] in agents)
+                and (not kinds or message["kind"] in kinds)
+            ]
+        # Frames broadcast while history was loading wait behind it.
+        client.enqueue({**history, "room": room}, first=True)
+
+    async def acknowledge(client: Client, ref: object, future) -> None:
+        try:
+            saved = await asyncio.wrap_future(future)
+        except Exception as exc:
+            client.enqueue({"type": "error", "ref": ref, "detail": str(exc)})
+            return
+        if len(saved) == 1:
+            bus.publish(saved[0]["room"], {"type": "message", "data": saved[0]})
+        else:
+            publish_batch(saved)
+        client.enqueue({"type": "ack", "ref": ref, "ids": [m["id"] for m in saved]})
+
+    @app.websocket("/ws")
+    async def websocket_endpoint(
+        websocket: WebSocket,
+        room: str = "default",
+        last_id: int | None = None,
+        agent: str | None = None,
+        kind: str | None = None,
+    ) -> None:
+        # ``room`` is subscribed right away (``room=`` for none) and is the
+        # default room of posts; more rooms come from subscribe frames.
+        client = await manager.connect(websocket)
+        pending: set[asyncio.Task] = set()
+        try:
+            if room:
+                await subscribe(client, room, _split_filter(agent), _split_filter(kind), last_id)
             while True:
-                await websocket.receive_text()
+                event = await websocket.receive()
+                if event["type"] == "websocket.disconnect":
+                    break
+                ref = None
+                try:
+                    frame = decode_frame(event)
+                    ref = frame.get("ref")
+                    frame_type = frame.get("type")
+                    if frame_type == "subscribe":
+                        await subscribe(client, *_parse_subscription(frame))
+                        client.enqueue({"type": "ack", "ref": ref})
+                        continue
+                    if frame_type == "unsubscribe":
+                        manager.unsubscribe(client, _parse_subscription(frame)[0])
+                        client.enqueue({"type": "ack", "ref": ref})
+                        continue
+                    if frame_type != "post":
+                        raise ValueError(f"unsupported frame type {frame_type!r}")
+                    messages = _parse_ws_post(frame, room, ingest_limit)
+                    await attach_blobs(messages)
+                    admission.check(messages)
+                except ValueError as exc:
+                    client.enqueue({"type": "error", "ref": ref, "detail": str(exc)})
+                    continue
+                except Throttled as exc:
+                    client.enqueue(
+                        {
+                            "type": "error",
+                            "ref": ref,
+                            "detail": str(exc),
+                            "retry_after": round(exc.retry_after, 3),
+                        }
+                    )
+                    continue
+                # Submitted before the next receive, so one socket's posts are
+                # stored in the order they were sent even though acks are async.
+                # No admission slot: a socket has no 503 to answer with, and its
+                # posts wait on the writer queue, not the thread pool.
+                try:
+                    future = engine.submit_many(messages)
+                except Exception as exc:
+                    client.enqueue({"type": "error", "ref": ref, "detail": str(exc)})
+                    continue
+                task = asyncio.create_task(acknowledge(client, ref, future))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
         except WebSocketDisconnect:
-            await manager.disconnect(room, websocket)
+            pass
+        finally:
+            await manager.disconnect(client)
 
     return app
 
@@ -0,0 +1,197 @@
+﻿from __future__ import annotations
+
+import bisect
+import threading
+from typing import Callable, Iterable, Iterator
+
+# Seconds; spans a cached read (~50us) up to a stalled disk.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+Sample = tuple[str, tuple[tuple[str, str], ...], float]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """A monotonically increasing value per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def inc_each(self, labels: Iterable[tuple]) -> None:
+        """Add one per item, taking the lock once for the whole batch."""
+        with self._lock:
+            values = self._values
+            for key in labels:
+                values[key] = values.get(key, 0.0) + 1
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, tuple(zip(self.labels, key)), value
+
+
+class Histogram:
+    """Bucketed observations; only bucket counts and a sum are kept."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        labels: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = labels
+        # labels -> per-bucket counts (the last bucket is +Inf), then the sum
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            with self._lock:
+                state = self._values.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state[index] += 1
+            state[-1] += value
+
+    def count(self, *labels: str) -> int:
+        state = self._values.get(labels)
+        return sum(state[:-1]) if state is not None else 0
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            items = [(key, state[:-1], state[-1]) for key, state in self._values.items()]
+        for key, counts, total in items:
+            base = tuple(zip(self.labels, key))
+            running = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                running += count
+                yield f"{self.name}_bucket", (*base, ("le", _format_value(bound))), running
+            yield f"{self.name}_sum", base, total
+            yield f"{self.name}_count", base, running
+
+
+class Gauge:
+    """A value read when metrics are scraped; ``read`` yields (labels, value)."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], Iterable[tuple[tuple, float]]],
+        labels: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._read = read
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in self._read():
+            yield self.name, tuple(zip(self.labels, key)), value
+
+
+def render(metrics: Iterable[Counter | Histogram | Gauge]) -> str:
+    """The Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                pairs = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels)
+                lines.append(f"{name}{{{pairs}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Process-wide, like the writer threads and sockets they describe.
+WRITE_QUEUE_SECONDS = Histogram(
+    "agentchat_write_queue_seconds", "Time a write waited for the writer thread."
+)
+WRITE_COMMIT_SECONDS = Histogram(
+    "agentchat_write_commit_seconds", "Duration of one write transaction."
+)
+WRITE_BATCH_ROWS = Histogram(
+    "agentchat_write_batch_rows", "Messages committed per write transaction.", SIZE_BUCKETS
+)
+MESSAGES = Counter("agentchat_messages_total", "Messages stored.", ("room", "kind"))
+READ_SECONDS = Histogram(
+    "agentchat_read_seconds", "Latency of history and search reads.", labels=("op",)
+)
+THREAD_WAIT_SECONDS = Histogram(
+    "agentchat_threadpool_wait_seconds", "Time a request waited for a worker thread."
+)
+BROADCAST_SECONDS = Histogram(
+    "agentchat_broadcast_seconds", "Time to queue one frame for every matching watcher."
+)
+BROADCAST_FANOUT = Histogram(
+    "agentchat_broadcast_fanout", "Watchers one frame was queued for.", (0, *SIZE_BUCKETS)
+)
+SEND_SECONDS = Histogram(
+    "agentchat_send_seconds", "Time to hand one frame to a watcher's connection."
+)
+SEND_FAILURES = Counter("agentchat_send_failures_total", "Watchers dropped after a failed send.")
+DROPPED = Counter(
+    "agentchat_dropped_total", "Frames or messages discarded by the overflow policy."
+)
+EVICTIONS = Counter(
+    "agentchat_evictions_total", "Slow watchers disconnected by the overflow policy."
+)
+THROTTLED = Counter(
+    "agentchat_throttled_total", "Posts refused by a rate limit.", ("scope", "key")
+)
+SHED = Counter("agentchat_shed_total", "Requests refused by the in-flight cap.")
+
+PROCESS_METRICS = (
+    WRITE_QUEUE_SECONDS,
+    WRITE_COMMIT_SECONDS,
+    WRITE_BATCH_ROWS,
+    MESSAGES,
+    READ_SECONDS,
+    THREAD_WAIT_SECONDS,
+    BROADCAST_SECONDS,
+    BROADCAST_FANOUT,
+    SEND_SECONDS,
+    SEND_FAILURES,
+    DROPPED,
+    EVICTIONS,
+    THROTTLED,
+    SHED,
+)
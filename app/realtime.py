@@ -1,36 +1,509 @@
 ﻿from __future__ import annotations
 
 import asyncio
-from typing import Dict, Set
+import json
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterable, Set
 
 from fastapi import WebSocket
 
+from app import metrics
 
-class ConnectionManager:
-    def __init__(self) -> None:
-        self._rooms: Dict[str, Set[WebSocket]] = {}
-        self._lock = asyncio.Lock()
-
-    async def connect(self, room: str, websocket: WebSocket) -> None:
-        await websocket.accept()
-        async with self._lock:
-            self._rooms.setdefault(room, set()).add(websocket)
-
-    async def disconnect(self, room: str, websocket: WebSocket) -> None:
-        async with self._lock:
-            if room not in self._rooms:
-                return
-            self._rooms[room].discard(websocket)
-            if not self._rooms[room]:
-                self._rooms.pop(room, None)
-
-    async def broadcast(self, room: str, payload: dict) -> None:
-        async with self._lock:
-            targets = list(self._rooms.get(room, set()))
-        if not targets:
+try:
+    import msgpack
+except ImportError:  # optional: only binary watchers need it
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_SUBPROTOCOL = "agentchat.msgpack"
+
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+# Close code for evicted slow consumers: "try again later".
+SLOW_CONSUMER_CLOSE = 1013
+_MESSAGE_FRAMES = ("message", "messages")
+
+
+def _frame_messages(payload: dict) -> list[dict]:
+    # "message" carries one message, "messages" and "history" a list.
+    return [payload["data"]] if payload["type"] == "message" else list(payload["data"])
+
+
+def _sse_event(payload: dict, body: str) -> str:
+    # The event id is the newest message id, so a reconnecting EventSource
+    # resumes from it through Last-Event-ID.
+    lines = []
+    if payload["type"] in (*_MESSAGE_FRAMES, "history"):
+        messages = _frame_messages(payload)
+        if messages:
+            lines.append(f"id: {max(message['id'] for message in messages)}")
+    lines.append(f"event: {payload['type']}")
+    lines.append(f"data: {body}")
+    return "\n".join(lines) + "\n\n"
+
+
+def msgpack_available() -> bool:
+    return msgpack is not None
+
+
+def decode_frame(event: dict) -> dict:
+    """The JSON or MessagePack object sent by a client; ValueError if it is neither."""
+    try:
+        if event.get("text") is not None:
+            frame = json.loads(event["text"])
+        elif msgpack is not None:
+            frame = msgpack.unpackb(event.get("bytes") or b"")
+        else:
+            raise ValueError("binary frames need the msgpack package")
+    except Exception as exc:  # json and msgpack raise assorted types
+        raise ValueError(str(exc) or "malformed frame") from None
+    if not isinstance(frame, dict):
+        raise ValueError("frame must be an object")
+    return frame
+
+
+class Frame:
+    """A payload and its wire encodings, each computed at most once.
+
+    One broadcast is a single Frame shared by every watcher, so a room with
+    200 watchers costs one encode per format instead of 200.
+    """
+
+    __slots__ = ("payload", "_encoded")
+
+    def __init__(self, payload: dict) -> None:
+        self.payload = payload
+        self._encoded: dict[str, str | bytes] = {}
+
+    def encode(self, fmt: str = "json") -> str | bytes:
+        data = self._encoded.get(fmt)
+        if data is None:
+            if fmt == "msgpack":
+                data = msgpack.packb(self.payload, use_bin_type=True)
+            elif fmt == "sse":
+                data = _sse_event(self.payload, self.encode("json"))
+            else:
+                # Same output as WebSocket.send_json.
+                data = json.dumps(self.payload, separators=(",", ":"), ensure_ascii=False)
+            self._encoded[fmt] = data
+        return data
+
+
+class Client:
+    """One watcher with its own bounded outbound queue and writer task.
+
+    ``send`` and ``close`` are the transport; everything else only ever calls
+    ``enqueue``, which never waits.
+    When the queue is full ``policy`` decides what gives:
+
+    - ``drop_oldest``: the oldest queued frame is discarded.
+    - ``coalesce``: each run of consecutive queued message frames is merged
+      into one ``messages`` frame, dropping the oldest messages beyond
+      ``max_queue`` in all. Other frames (acks, errors, subscription changes)
+      keep their place and are never dropped; if they alone fill the queue
+      the client is disconnected as below.
+    - ``disconnect``: the queue is discarded, a ``resync`` frame carrying the
+      last delivered message id is sent, and the connection is closed so the
+      client can page the gap from ``GET /api/messages``.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Frame], Awaitable[None]],
+        close: Callable[[int, str], Awaitable[None]] | None = None,
+        *,
+        max_queue: int = 256,
+        policy: str = "coalesce",
+    ) -> None:
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}")
+        self._send = send
+        self._close = close
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.dropped = 0
+        # Highest message id delivered per room (ids only grow within a room).
+        self.last_ids: dict[str, int] = {}
+        # room -> (agents, kinds); None means any.
+        self.subscriptions: dict[str, tuple[frozenset | None, frozenset | None]] = {}
+        self.closed = False
+        self._queue: deque[Frame] = deque()
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self.closed = True
+        task, self._task = self._task, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    @property
+    def last_id(self) -> int:
+        return max(self.last_ids.values(), default=0)
+
+    def enqueue(self, frame: Frame | dict, *, first: bool = False) -> None:
+        """Queue ``frame`` for sending; ``first`` puts it ahead of everything queued."""
+        if self.closed or self._closing:
+            return
+        if not isinstance(frame, Frame):
+            frame = Frame(frame)
+        if first:
+            self._queue.appendleft(frame)
+        elif len(self._queue) < self.max_queue:
+            self._queue.append(frame)
+        else:
+            dropped = self.dropped
+            self._overflow(frame)
+            metrics.DROPPED.inc(amount=self.dropped - dropped)
+            if self._closing:
+                metrics.EVICTIONS.inc()
+        self._wakeup.set()
+
+    def _overflow(self, frame: Frame) -> None:
+        if self.policy == "drop_oldest":
+            self._queue.popleft()
+            self._queue.append(frame)
+            self.dropped += 1
+        elif self.policy == "coalesce":
+            self._coalesce(frame)
+        else:
+            self._evict()
+
+    def _coalesce(self, frame: Frame) -> None:
+        # Control frames as they are, runs of message frames as lists.
+        entries: list[Frame | list[Frame]] = []
+        for queued in [*self._queue, frame]:
+            if queued.payload["type"] not in _MESSAGE_FRAMES:
+                entries.append(queued)
+            elif entries and isinstance(entries[-1], list):
+                entries[-1].append(queued)
+            else:
+                entries.append([queued])
+        excess = -self.max_queue
+        for entry in entries:
+            if isinstance(entry, list):
+                excess += sum(len(_frame_messages(queued.payload)) for queued in entry)
+        trimmed = 0
+        kept: deque[Frame] = deque()
+        for entry in entries:
+            if isinstance(entry, Frame):
+                kept.append(entry)
+                continue
+            if len(entry) == 1 and excess <= 0:
+                kept.append(entry[0])
+                continue
+            messages = [m for queued in entry for m in _frame_messages(queued.payload)]
+            if excess > 0:
+                # The oldest messages go first, whichever run they are in.
+                cut = min(excess, len(messages))
+                messages = messages[cut:]
+                excess -= cut
+                trimmed += cut
+            if messages:
+                kept.append(Frame({"type": "messages", "data": messages}))
+        if len(kept) > self.max_queue:
+            self._evict()
             return
-        for websocket in targets:
+        self.dropped += trimmed
+        self._queue = kept
+
+    def _evict(self) -> None:
+        self.dropped += len(self._queue) + 1
+        self._queue.clear()
+        self._queue.append(Frame({"type": "resync", "reason": "slow consumer"}))
+        self._closing = True
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                while not self._queue:
+                    if self._closing:
+                        await self._shutdown(SLOW_CONSUMER_CLOSE, "slow consumer")
+                        return
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                frame = self._queue.popleft()
+                payload = frame.payload
+                if payload["type"] == "resync":
+                    # Filled in only now: a frame in flight at overflow time
+                    # still counted as delivered.
+                    frame = Frame(
+                        {**payload, "last_id": self.last_id, "last_ids": dict(self.last_ids)}
+                    )
+                elif payload["type"] in _MESSAGE_FRAMES:
+                    # Broadcasts that raced the history frame may repeat it.
+                    messages = _frame_messages(payload)
+                    fresh = [m for m in messages if m["id"] > self.last_ids.get(m["room"], 0)]
+                    if not fresh:
+                        continue
+                    if len(fresh) < len(messages):
+                        frame = Frame({"type": "messages", "data": fresh})
+                started = time.perf_counter()
+                await self._send(frame)
+                metrics.SEND_SECONDS.observe(time.perf_counter() - started)
+                if payload["type"] in (*_MESSAGE_FRAMES, "history"):
+                    for message in _frame_messages(frame.payload):
+                        if message["id"] > self.last_ids.get(message["room"], 0):
+                            self.last_ids[message["room"]] = message["id"]
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The peer went away; the endpoint's receive loop notices as well.
+            metrics.SEND_FAILURES.inc()
+            logger.debug("dropping client after failed send", exc_info=True)
+        self.closed = True
+
+    async def _shutdown(self, code: int, reason: str) -> None:
+        self.closed = True
+        if self._close is not None:
             try:
-                await websocket.send_json(payload)
+                await self._close(code, reason)
             except Exception:
-                await self.disconnect(room, websocket)
+                pass
+
+
+class BurstCoalescer:
+    """Micro-batches message frames per room before they reach watchers.
+
+    The first message of a room opens a window of ``window`` seconds; the
+    buffer goes out as one ``messages`` frame when the window closes or as
+    soon as it holds ``max_messages``, so no message waits longer than
+    ``window`` and a burst of 50 costs one frame instead of 50. Lone
+    messages keep their ``message`` frame type.
+    """
+
+    def __init__(
+        self, deliver: Callable[[str, dict], None], window: float, max_messages: int = 100
+    ) -> None:
+        self.deliver = deliver
+        self.window = max(0.0, window)
+        self.max_messages = max(1, max_messages)
+        self._buffers: dict[str, list[dict]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+
+    def publish(self, room: str, payload: dict) -> None:
+        if payload["type"] not in _MESSAGE_FRAMES:
+            self.flush(room)
+            self.deliver(room, payload)
+            return
+        buffer = self._buffers.setdefault(room, [])
+        buffer.extend(_frame_messages(payload))
+        if len(buffer) >= self.max_messages:
+            self.flush(room)
+        elif room not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[room] = loop.call_later(self.window, self.flush, room)
+
+    def flush(self, room: str) -> None:
+        timer = self._timers.pop(room, None)
+        if timer is not None:
+            timer.cancel()
+        buffer = self._buffers.pop(room, None)
+        if not buffer:
+            return
+        if len(buffer) == 1:
+            self.deliver(room, {"type": "message", "data": buffer[0]})
+        else:
+            self.deliver(room, {"type": "messages", "data": buffer})
+
+    def close(self) -> None:
+        for room in list(self._buffers):
+            self.flush(room)
+
+
+def _subscription_keys(
+    agents: frozenset | None, kinds: frozenset | None
+) -> list[tuple[str | None, str | None]]:
+    return [(agent, kind) for agent in (agents or [None]) for kind in (kinds or [None])]
+
+
+class ConnectionManager:
+    """Subscriptions and fan-out; ``broadcast`` only enqueues.
+
+    Subscriptions are indexed per room by ``(agent, kind)`` with None as a
+    wildcard, so a message is matched with four dict lookups however many
+    watchers filter on other agents or kinds. Long-polling requests park on
+    ``waiter`` futures that the same broadcasts resolve.
+    """
+
+    def __init__(self, *, max_queue: int = 256, policy: str = "coalesce") -> None:
+        self.max_queue = max_queue
+        self.policy = policy
+        self._index: Dict[str, Dict[tuple[str | None, str | None], Set[Client]]] = {}
+        self._clients: Set[Client] = set()
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        self._latest: Dict[str, int] = {}
+
+    def latest_id(self, room: str) -> int | None:
+        """Highest message id broadcast to ``room`` since startup, if any."""
+        return self._latest.get(room)
+
+    def waiter(self, room: str) -> asyncio.Future:
+        """A future resolved by the next message broadcast to ``room``;
+        pass it to ``discard_waiter`` when done with it."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(room, set()).add(future)
+        return future
+
+    def discard_waiter(self, room: str, future: asyncio.Future) -> None:
+        waiters = self._waiters.get(room)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[room]
+
+    @property
+    def connections(self) -> int:
+        return len(self._clients)
+
+    def watcher_counts(self) -> dict[str, int]:
+        """Distinct subscribed clients per room."""
+        counts = {}
+        for room, index in self._index.items():
+            clients: set = set()
+            for subscribed in index.values():
+                clients |= subscribed
+            counts[room] = len(clients)
+        return counts
+
+    def register(self, room: str, client: Client) -> None:
+        """Start ``client`` subscribed to every message of ``room``."""
+        self._clients.add(client)
+        client.start()
+        self.subscribe(client, room)
+
+    async def unregister(self, client: Client) -> None:
+        for room in list(client.subscriptions):
+            self.unsubscribe(client, room)
+        self._clients.discard(client)
+        await client.stop()
+
+    def subscribe(
+        self,
+        client: Client,
+        room: str,
+        agents: Iterable[str] | None = None,
+        kinds: Iterable[str] | None = None,
+    ) -> None:
+        """Subscribe ``client`` to ``room``, replacing any earlier filters for it."""
+        self.unsubscribe(client, room)
+        agent_set = frozenset(agents) if agents else None
+        kind_set = frozenset(kinds) if kinds else None
+        client.subscriptions[room] = (agent_set, kind_set)
+        index = self._index.setdefault(room, {})
+        for key in _subscription_keys(agent_set, kind_set):
+            index.setdefault(key, set()).add(client)
+
+    def unsubscribe(self, client: Client, room: str) -> None:
+        filters = client.subscriptions.pop(room, None)
+        if filters is None:
+            return
+        index = self._index.get(room, {})
+        for key in _subscription_keys(*filters):
+            clients = index.get(key)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del index[key]
+        if not index:
+            self._index.pop(room, None)
+
+    async def connect(self, websocket: WebSocket) -> Client:
+        """Accept ``websocket``, speaking MessagePack when the client asks for it
+        via the ``agentchat.msgpack`` subprotocol or ``?format=msgpack``.
+
+        Without the optional ``msgpack`` package the request is ignored and the
+        socket falls back to JSON text frames. The client starts with no
+        subscriptions.
+        """
+        offered = websocket.scope.get("subprotocols") or []
+        binary = msgpack is not None and (
+            MSGPACK_SUBPROTOCOL in offered or websocket.query_params.get("format") == "msgpack"
+        )
+        await websocket.accept(
+            subprotocol=MSGPACK_SUBPROTOCOL if binary and MSGPACK_SUBPROTOCOL in offered else None
+        )
+
+        async def send(frame: Frame) -> None:
+            if binary:
+                await websocket.send_bytes(frame.encode("msgpack"))
+            else:
+                await websocket.send_text(frame.encode("json"))
+
+        async def close(code: int, reason: str) -> None:
+            await websocket.close(code=code, reason=reason)
+
+        return self.open(send, close)
+
+    def open(
+        self,
+        send: Callable[[Frame], Awaitable[None]],
+        close: Callable[[int, str], Awaitable[None]] | None = None,
+    ) -> Client:
+        """Start a client on any transport, with no subscriptions yet."""
+        client = Client(send, close, max_queue=self.max_queue, policy=self.policy)
+        self._clients.add(client)
+        client.start()
+        return client
+
+    async def disconnect(self, client: Client) -> None:
+        await self.unregister(client)
+
+    def broadcast(self, room: str, payload: dict) -> None:
+        started = time.perf_counter()
+        fanout = self._fan_out(room, payload)
+        metrics.BROADCAST_SECONDS.observe(time.perf_counter() - started)
+        metrics.BROADCAST_FANOUT.observe(fanout)
+
+    def _fan_out(self, room: str, payload: dict) -> int:
+        """Queue ``payload`` for matching watchers; returns how many."""
+        if payload["type"] in _MESSAGE_FRAMES:
+            newest = max(message["id"] for message in _frame_messages(payload))
+            if newest > self._latest.get(room, 0):
+                self._latest[room] = newest
+            for future in self._waiters.pop(room, ()):
+                if not future.done():
+                    future.set_result(newest)
+        index = self._index.get(room)
+        if not index:
+            return 0
+        frame = Frame(payload)
+        if payload["type"] not in _MESSAGE_FRAMES or list(index) == [(None, None)]:
+            targets = set().union(*index.values())
+            for client in targets:
+                client.enqueue(frame)
+            return len(targets)
+        messages = _frame_messages(payload)
+        matched: dict[Client, list[int]] = {}
+        for position, message in enumerate(messages):
+            agent, kind = message["agent"], message["kind"]
+            for key in ((None, None), (agent, None), (None, kind), (agent, kind)):
+                for client in index.get(key, ()):
+                    positions = matched.setdefault(client, [])
+                    if not positions or positions[-1] != position:
+                        positions.append(position)
+        # Watchers with the same filters share one encoded subset frame.
+        subsets: dict[tuple[int, ...], Frame] = {}
+        for client, positions in matched.items():
+            if len(positions) == len(messages):
+                client.enqueue(frame)
+                continue
+            key = tuple(positions)
+            subset = subsets.get(key)
+            if subset is None:
+                data = [messages[position] for position in positions]
+                subset = subsets[key] = Frame({"type": "messages", "data": data})
+            client.enqueue(subset)
+        return len(matched)
@@ -0,0 +1,180 @@
+﻿from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+import anyio
+
+from app.db import (
+    MESSAGE_COLUMNS,
+    Engine,
+    delete_range,
+    release_lease,
+    take_lease,
+    to_micros,
+)
+from app.shards import ShardedEngine
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_ROWS = 5000
+VACUUM_PAGES = 512
+# Every worker runs retention; a lease per shard lets one pass through at a
+# time, so two never archive the same rows. Renewed before each room.
+LEASE_NAME = "retention"
+LEASE_SECONDS = 600.0
+
+
+def _policy_rooms(conn: sqlite3.Connection, policies: dict[str, dict]) -> list[str]:
+    if "*" not in policies:
+        return sorted(policies)
+    rows = conn.execute(
+        "SELECT name FROM rooms r"
+        " WHERE EXISTS (SELECT 1 FROM messages WHERE room_id = r.id)"
+    )
+    return [row[0] for row in rows]
+
+
+def _row_cutoff(conn: sqlite3.Connection, room_id: int, max_rows: int) -> int:
+    """Highest id outside the newest ``max_rows`` messages of the room (0 if none)."""
+    row = conn.execute(
+        "SELECT id FROM messages WHERE room_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (room_id, max_rows),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def archive_room(
+    engine: Engine,
+    conn: sqlite3.Connection,
+    room: str,
+    policy: dict,
+    *,
+    now: datetime,
+    stop: threading.Event,
+) -> int:
+    """Move the expired prefix of ``room`` into archive segments; returns rows moved."""
+    archive = engine.archive
+    room_id = engine.lookup.id_of(conn, "rooms", room)
+    if archive is None or room_id is None:
+        return 0
+    cutoff_ts = None
+    if policy.get("max_age") is not None:
+        cutoff_ts = to_micros((now - timedelta(seconds=policy["max_age"])).isoformat())
+    cutoff_id = 0
+    if policy.get("max_rows") is not None:
+        cutoff_id = _row_cutoff(conn, room_id, policy["max_rows"])
+    archived_to = archive.last_id(room)
+    moved = 0
+    while not stop.is_set():
+        rows = conn.execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages"
+            " WHERE room_id = ? ORDER BY id LIMIT ?",
+            (room_id, SEGMENT_ROWS),
+        ).fetchall()
+        count = 0
+        for row in rows:
+            if row["id"] > cutoff_id and (cutoff_ts is None or row["ts"] >= cutoff_ts):
+                break
+            count += 1
+        if not count:
+            break
+        expired = engine.lookup.messages(conn, rows[:count])
+        # Rows already covered by a segment survived an interrupted pass and
+        # only need deleting; segments are never rewritten.
+        fresh = [row for row in expired if row["id"] > archived_to]
+        if fresh:
+            archive.write_segment(room, fresh)
+            archived_to = fresh[-1]["id"]
+        first_id, last_id = expired[0]["id"], expired[-1]["id"]
+        engine.run_write(
+            lambda writer: delete_range(writer, room_id, first_id, last_id)
+        ).result()
+        moved += len(expired)
+        if len(expired) < SEGMENT_ROWS:
+            break
+    if moved and engine.cache is not None:
+        engine.cache.invalidate(room)
+    return moved
+
+
+def _vacuum_step(conn: sqlite3.Connection, pages: int) -> int:
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not free:
+        return 0
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return min(free, pages)
+
+
+def incremental_vacuum(
+    engine: Engine, stop: threading.Event, pages: int = VACUUM_PAGES
+) -> int:
+    """Release free pages in small writer jobs so inserts keep flowing in between."""
+    freed = 0
+    while not stop.is_set():
+        step = engine.run_write(lambda conn: _vacuum_step(conn, pages)).result()
+        if not step:
+            break
+        freed += step
+    return freed
+
+
+def run_once(
+    engine: Engine | ShardedEngine,
+    policies: dict[str, dict],
+    stop: threading.Event | None = None,
+    now: datetime | None = None,
+) -> dict[str, int]:
+    stop = stop or threading.Event()
+    now = now or datetime.now(timezone.utc)
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    def lease(shard: Engine) -> bool:
+        return shard.run_write(
+            lambda writer: take_lease(writer, LEASE_NAME, owner, LEASE_SECONDS)
+        ).result()
+
+    moved: dict[str, int] = {}
+    for shard in engine.shards:
+        if not lease(shard):
+            logger.info("retention skipped for %s: another process is running it", shard.db_path)
+            continue
+        shard_moved = 0
+        try:
+            with shard.reader() as conn:
+                for room in _policy_rooms(conn, policies):
+                    if stop.is_set() or not lease(shard):
+                        break
+                    policy = policies.get(room) or policies.get("*")
+                    if not policy:
+                        continue
+                    count = archive_room(shard, conn, room, policy, now=now, stop=stop)
+                    if count:
+                        moved[room] = moved.get(room, 0) + count
+                        shard_moved += count
+            if shard_moved:
+                incremental_vacuum(shard, stop)
+        finally:
+            shard.run_write(lambda writer: release_lease(writer, LEASE_NAME, owner)).result()
+    return moved
+
+
+async def run_periodically(
+    engine: Engine | ShardedEngine, policies: dict[str, dict], interval: float, stop: threading.Event
+) -> None:
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        try:
+            moved = await anyio.to_thread.run_sync(run_once, engine, policies, stop)
+        except Exception:
+            logger.exception("retention pass failed")
+            continue
+        if moved:
+            logger.info("archived %s", moved)
@@ -1,15 +1,100 @@
 ﻿from __future__ import annotations
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator, model_serializer, model_validator
+
+from app.db import from_micros, to_micros
 
 
 class MessageIn(BaseModel):
     room: str = Field(default="default", min_length=1, max_length=64)
     agent: str = Field(min_length=1, max_length=64)
     kind: str = Field(default="status", min_length=1, max_length=32)
-    content: str = Field(min_length=1, max_length=4000)
+    # May be left empty with a blob: the server fills in a preview of it.
+    content: str = Field(default="", max_length=4000)
+    # Set by clients replaying messages they could not post at the time.
+    ts: str | None = Field(default=None, max_length=40)
+    # sha256 of an attachment uploaded with POST /api/blobs.
+    blob: str | None = Field(default=None, pattern=r"^[0-9a-f]{64}$")
+
+    @field_validator("ts")
+    @classmethod
+    def _check_ts(cls, value: str | None) -> str | None:
+        if value is not None:
+            # Stored as UTC microseconds: an offset can push a valid ISO
+            # timestamp outside the years datetime can represent.
+            try:
+                from_micros(to_micros(value))
+            except OverflowError:
+                raise ValueError("timestamp out of range") from None
+        return value
+
+    @model_validator(mode="after")
+    def _check_body(self) -> MessageIn:
+        if not self.content and self.blob is None:
+            raise ValueError("content or blob is required")
+        return self
 
 
 class MessageOut(MessageIn):
     id: int
     ts: str
+    blob_size: int | None = None
+
+    @model_serializer(mode="wrap")
+    def _omit_no_blob(self, handler) -> dict:
+        data = handler(self)
+        if data.get("blob") is None:
+            data.pop("blob", None)
+            data.pop("blob_size", None)
+        return data
+
+
+class BlobRef(BaseModel):
+    blob: str
+    size: int
+
+
+class IngestSummary(BaseModel):
+    count: int
+    first_id: int | None = None
+    last_id: int | None = None
+
+
+class SearchHit(MessageOut):
+    snippet: str
+    rank: float
+
+
+class SearchPage(BaseModel):
+    hits: list[SearchHit]
+    next_cursor: str | None = None
+
+
+class RoomSummary(BaseModel):
+    room: str
+    messages: int
+    last_id: int
+    last_ts: str
+
+
+class AgentStats(BaseModel):
+    agent: str
+    messages: int
+    last_id: int
+    last_ts: str
+
+
+class KindStats(BaseModel):
+    kind: str
+    messages: int
+
+
+class MinuteStats(BaseModel):
+    minute: str
+    messages: int
+
+
+class RoomStats(RoomSummary):
+    agents: list[AgentStats]
+    kinds: list[KindStats]
+    per_minute: list[MinuteStats]
@@ -1,5 +1,6 @@
 ﻿from __future__ import annotations
 
+import json
 import os
 from pathlib import Path
 
@@ -12,10 +13,195 @@ def get_db_path() -> Path:
     return Path(raw) if raw else DEFAULT_DB
 
 
-def get_history_limit() -> int:
-    raw = os.environ.get("AGENTCHAT_HISTORY_LIMIT", "200")
+def _read_int(name: str, default: int, minimum: int, maximum: int) -> int:
+    raw = os.environ.get(name, str(default))
     try:
         value = int(raw)
     except ValueError:
-        return 200
-    return max(1, min(value, 1000))
+        return default
+    return max(minimum, min(value, maximum))
+
+
+def get_history_limit() -> int:
+    return _read_int("AGENTCHAT_HISTORY_LIMIT", 200, 1, 1000)
+
+
+def get_write_batch_size() -> int:
+    """Max rows the writer commits in one transaction (AGENTCHAT_WRITE_BATCH)."""
+    return _read_int("AGENTCHAT_WRITE_BATCH", 256, 1, 10000)
+
+
+def get_write_max_wait() -> float:
+    """Seconds the writer waits for more rows before committing a batch.
+
+    Read from AGENTCHAT_WRITE_WAIT_MS (milliseconds); 0 commits as soon as the
+    queue is drained.
+    """
+    return _read_int("AGENTCHAT_WRITE_WAIT_MS", 2, 0, 1000) / 1000
+
+
+def get_ingest_max_messages() -> int:
+    """Max messages accepted by one batch or NDJSON ingest request."""
+    return _read_int("AGENTCHAT_INGEST_MAX_MESSAGES", 5000, 1, 100000)
+
+
+def get_cache_room_messages() -> int:
+    """Messages kept in memory per room (AGENTCHAT_CACHE_ROOM_MESSAGES, 0 disables)."""
+    return _read_int("AGENTCHAT_CACHE_ROOM_MESSAGES", 1000, 0, 100000)
+
+
+def get_cache_max_bytes() -> int:
+    """Memory budget for the history cache, read from AGENTCHAT_CACHE_MAX_MB."""
+    return _read_int("AGENTCHAT_CACHE_MAX_MB", 64, 1, 65536) * 1024 * 1024
+
+
+def get_archive_dir(db_path: Path) -> Path:
+    """Where retention writes archive segments (AGENTCHAT_ARCHIVE_DIR)."""
+    raw = os.environ.get("AGENTCHAT_ARCHIVE_DIR")
+    return Path(raw) if raw else db_path.parent / "archive"
+
+
+def get_blob_dir(db_path: Path) -> Path:
+    """Where uploaded attachments are stored (AGENTCHAT_BLOB_DIR)."""
+    raw = os.environ.get("AGENTCHAT_BLOB_DIR")
+    return Path(raw) if raw else db_path.parent / "blobs"
+
+
+def get_retention_policies() -> dict[str, dict]:
+    """Per-room retention from AGENTCHAT_RETENTION, a JSON object such as
+    ``{"*": {"max_age_days": 30}, "ci": {"max_rows": 50000}}``.
+
+    ``"*"`` applies to every room without its own entry. Returns ``{room:
+    {"max_age": seconds | None, "max_rows": int | None}}``; anything malformed
+    disables retention rather than guessing.
+    """
+    raw = os.environ.get("AGENTCHAT_RETENTION")
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        policies = {}
+        for room, spec in data.items():
+            max_age = spec.get("max_age_days")
+            max_rows = spec.get("max_rows")
+            policies[str(room)] = {
+                "max_age": float(max_age) * 86400 if max_age is not None else None,
+                "max_rows": max(0, int(max_rows)) if max_rows is not None else None,
+            }
+    except (AttributeError, TypeError, ValueError):
+        return {}
+    return policies
+
+
+def get_retention_interval() -> float:
+    """Seconds between background retention passes (AGENTCHAT_RETENTION_INTERVAL)."""
+    return float(_read_int("AGENTCHAT_RETENTION_INTERVAL", 300, 1, 86400))
+
+
+def get_shard_count() -> int:
+    """Number of SQLite shards (AGENTCHAT_SHARDS); 0 keeps the single-file layout."""
+    return _read_int("AGENTCHAT_SHARDS", 0, 0, 256)
+
+
+def get_shard_dir(db_path: Path) -> Path:
+    """Directory holding the shard files: AGENTCHAT_DB without its suffix."""
+    return db_path.with_suffix("") if db_path.suffix else db_path
+
+
+def get_shard_map() -> dict[str, int]:
+    """Explicit room to shard assignments from AGENTCHAT_SHARD_MAP (JSON object)."""
+    raw = os.environ.get("AGENTCHAT_SHARD_MAP")
+    if not raw:
+        return {}
+    try:
+        return {str(room): int(index) for room, index in json.loads(raw).items()}
+    except (AttributeError, TypeError, ValueError):
+        return {}
+
+
+def get_ws_queue_size() -> int:
+    """Outbound frames queued per watcher before AGENTCHAT_WS_OVERFLOW applies."""
+    return _read_int("AGENTCHAT_WS_QUEUE", 256, 1, 100000)
+
+
+def get_ws_overflow_policy() -> str:
+    """What to do when a watcher's queue is full (AGENTCHAT_WS_OVERFLOW):
+    ``coalesce`` (default), ``drop_oldest`` or ``disconnect``.
+    """
+    raw = os.environ.get("AGENTCHAT_WS_OVERFLOW", "coalesce").strip().lower()
+    return raw if raw in ("coalesce", "drop_oldest", "disconnect") else "coalesce"
+
+
+def get_bus_backend() -> str:
+    """How broadcasts reach watchers (AGENTCHAT_BUS): ``local`` for one server
+    process (default) or ``sqlite`` to tail the database so several workers
+    share delivery.
+    """
+    raw = os.environ.get("AGENTCHAT_BUS", "local").strip().lower()
+    return raw if raw in ("local", "sqlite") else "local"
+
+
+def get_bus_poll_interval() -> float:
+    """Seconds between database polls of the sqlite bus (AGENTCHAT_BUS_POLL_MS)."""
+    return _read_int("AGENTCHAT_BUS_POLL_MS", 50, 1, 10000) / 1000
+
+
+def get_coalesce_window() -> float:
+    """Seconds a room's messages are held to be sent as one frame
+    (AGENTCHAT_COALESCE_MS); 0 sends every broadcast as it comes.
+    """
+    return _read_int("AGENTCHAT_COALESCE_MS", 0, 0, 5000) / 1000
+
+
+def get_coalesce_max_messages() -> int:
+    """Messages after which a coalesced frame goes out early (AGENTCHAT_COALESCE_MAX)."""
+    return _read_int("AGENTCHAT_COALESCE_MAX", 100, 1, 10000)
+
+
+def get_sse_heartbeat() -> float:
+    """Seconds of silence after which /api/stream sends a keep-alive comment
+    (AGENTCHAT_SSE_HEARTBEAT)."""
+    return float(_read_int("AGENTCHAT_SSE_HEARTBEAT", 15, 1, 3600))
+
+
+def get_agent_rate_limit() -> tuple[int, int]:
+    """Messages per second and burst allowed per agent (AGENTCHAT_AGENT_RATE,
+    AGENTCHAT_AGENT_BURST); a rate of 0 disables the limit. The burst
+    defaults to ten seconds' worth.
+    """
+    rate = _read_int("AGENTCHAT_AGENT_RATE", 0, 0, 100000)
+    return rate, _read_int("AGENTCHAT_AGENT_BURST", rate * 10, 1, 1000000)
+
+
+def get_room_rate_limit() -> tuple[int, int]:
+    """Like ``get_agent_rate_limit`` per room (AGENTCHAT_ROOM_RATE, AGENTCHAT_ROOM_BURST)."""
+    rate = _read_int("AGENTCHAT_ROOM_RATE", 0, 0, 100000)
+    return rate, _read_int("AGENTCHAT_ROOM_BURST", rate * 10, 1, 1000000)
+
+
+def get_max_in_flight() -> int:
+    """HTTP requests allowed to wait on the database at once before new ones
+    get 503 (AGENTCHAT_MAX_IN_FLIGHT, 0 disables).
+
+    The default stays below anyio's default of 40 worker threads, so reads
+    are shed before they start queueing for a thread.
+    """
+    return _read_int("AGENTCHAT_MAX_IN_FLIGHT", 32, 0, 100000)
+
+
+def get_compress_min_bytes() -> int:
+    """HTTP responses at least this large are gzip/brotli compressed when the
+    client accepts it (AGENTCHAT_COMPRESS_MIN_BYTES, 0 disables)."""
+    return _read_int("AGENTCHAT_COMPRESS_MIN_BYTES", 1024, 0, 100 * 1024 * 1024)
+
+
+def get_max_uploads() -> int:
+    """Attachment uploads allowed at once before new ones get 503
+    (AGENTCHAT_MAX_UPLOADS, 0 disables). Counted apart from
+    AGENTCHAT_MAX_IN_FLIGHT, so slow uploads never crowd out posts."""
+    return _read_int("AGENTCHAT_MAX_UPLOADS", 8, 0, 10000)
+
+
+def get_blob_max_bytes() -> int:
+    """Largest attachment accepted by POST /api/blobs (AGENTCHAT_BLOB_MAX_MB, in MiB)."""
+    return _read_int("AGENTCHAT_BLOB_MAX_MB", 64, 1, 4096) * 1024 * 1024
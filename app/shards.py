@@ -0,0 +1,297 @@
+﻿from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import Future, InvalidStateError
+from pathlib import Path
+
+from app import settings
+from app.archive import ArchiveStore
+from app.cache import HistoryCache
+from app.db import Engine, NameLookup, init_db, iter_messages, write_rows
+
+LAYOUT_FILE = "shards.json"
+
+
+def shard_path(directory: Path, index: int) -> Path:
+    return directory / f"shard-{index:02d}.sqlite3"
+
+
+def shard_for(room: str, count: int, shard_map: dict[str, int] | None = None) -> int:
+    # crc32 rather than hash(): it must not change between processes or runs.
+    explicit = (shard_map or {}).get(room)
+    if explicit is not None:
+        return explicit % count
+    return zlib.crc32(room.encode("utf-8")) % count
+
+
+def check_layout(directory: Path, count: int, shard_map: dict[str, int]) -> None:
+    """Record the layout on first use and refuse to open a directory with another one.
+
+    Changing the shard count or the explicit map would silently move rooms
+    away from their history, so that needs a deliberate migration instead.
+    """
+    path = directory / LAYOUT_FILE
+    layout = {"shards": count, "map": shard_map}
+    if not path.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(layout, indent=2) + "\n", encoding="utf-8")
+        return
+    existing = json.loads(path.read_text(encoding="utf-8"))
+    if existing != layout:
+        raise RuntimeError(
+            f"{path} describes {existing}, but the settings ask for {layout}"
+        )
+
+
+class ShardedEngine:
+    """Rooms spread over several SQLite files, each with its own writer thread.
+
+    A room always lives in one shard, so its ids keep increasing; ids of
+    different rooms may collide across shards. Exposes the same interface as
+    ``Engine`` so the application does not care which one it runs on.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        count: int,
+        *,
+        shard_map: dict[str, int] | None = None,
+        cache: HistoryCache | None = None,
+        archive: ArchiveStore | None = None,
+        **engine_options: object,
+    ) -> None:
+        self.directory = directory
+        self.count = max(1, count)
+        self.shard_map = dict(shard_map or {})
+        self.cache = cache
+        self.archive = archive
+        self.shards = [
+            Engine(shard_path(directory, index), cache=cache, archive=archive, **engine_options)
+            for index in range(self.count)
+        ]
+
+    def start(self) -> None:
+        check_layout(self.directory, self.count, self.shard_map)
+        for shard in self.shards:
+            shard.start()
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+    def shard(self, room: str) -> Engine:
+        return self.shards[shard_for(room, self.count, self.shard_map)]
+
+    def submit(self, message: dict) -> Future:
+        return self.shard(message["room"]).submit(message)
+
+    def submit_many(self, messages: list[dict]) -> Future:
+        """Like ``Engine.submit_many``; each shard commits its part separately."""
+        groups: dict[int, list[int]] = {}
+        for position, message in enumerate(messages):
+            index = shard_for(message["room"], self.count, self.shard_map)
+            groups.setdefault(index, []).append(position)
+        combined: Future = Future()
+        if len(groups) <= 1:
+            if not groups:
+                combined.set_result([])
+                return combined
+            return self.shards[next(iter(groups))].submit_many(messages)
+
+        saved: list[dict | None] = [None] * len(messages)
+        pending = [len(groups)]
+        lock = threading.Lock()
+
+        def collect(positions: list[int], future: Future) -> None:
+            with lock:
+                pending[0] -= 1
+                try:
+                    if combined.done():
+                        return
+                    error = future.exception()
+                    if error is not None:
+                        combined.set_exception(error)
+                        return
+                    for position, row in zip(positions, future.result()):
+                        saved[position] = row
+                    if not pending[0]:
+                        combined.set_result(saved)
+                except InvalidStateError:
+                    pass  # cancelled by the caller meanwhile
+
+        for index, positions in groups.items():
+            future = self.shards[index].submit_many([messages[p] for p in positions])
+            future.add_done_callback(lambda f, positions=positions: collect(positions, f))
+        return combined
+
+    def insert_message(self, message: dict) -> dict:
+        return self.submit(message).result()
+
+    def insert_messages(self, messages: list[dict]) -> list[dict]:
+        return self.submit_many(messages).result()
+
+    def fetch_messages(
+        self,
+        room: str,
+        limit: int,
+        after_id: int | None,
+        before_id: int | None = None,
+        order: str = "asc",
+    ) -> list[dict]:
+        return self.shard(room).fetch_messages(room, limit, after_id, before_id, order)
+
+    def fetch_recent(self, room: str, limit: int) -> list[dict]:
+        return self.shard(room).fetch_recent(room, limit)
+
+    def rooms(self) -> list[dict]:
+        # A room lives in exactly one shard, so the lists never overlap.
+        return sorted(
+            (room for shard in self.shards for room in shard.rooms()),
+            key=lambda room: room["room"],
+        )
+
+    def room_stats(self, room: str, minutes: int = 60) -> dict | None:
+        return self.shard(room).room_stats(room, minutes)
+
+    def search(
+        self,
+        text: str,
+        *,
+        room: str | None = None,
+        agent: str | None = None,
+        kind: str | None = None,
+        order: str = "rank",
+        after: dict | None = None,
+        limit: int = 50,
+    ) -> tuple[list[dict], dict | None]:
+        """Merge per-shard result pages; ``after`` keeps one position per shard."""
+        limit = max(1, min(limit, 200))
+        positions: dict[int, dict] = {}
+        done: set[int] = set()
+        if after is not None:
+            try:
+                positions = {int(index): value for index, value in after["s"].items()}
+                done = {int(index) for index in after.get("d", [])}
+            except (AttributeError, KeyError, TypeError, ValueError):
+                raise ValueError("invalid cursor") from None
+        if room is not None:
+            targets = [shard_for(room, self.count, self.shard_map)]
+        else:
+            targets = list(range(self.count))
+
+        pages: dict[int, list[dict]] = {}
+        for index in targets:
+            if index in done:
+                continue
+            hits, next_after = self.shards[index].search(
+                text,
+                room=room,
+                agent=agent,
+                kind=kind,
+                order=order,
+                after=positions.get(index),
+                limit=limit,
+            )
+            pages[index] = hits
+            if next_after is None:
+                done.add(index)
+
+        # k-way merge that only ever takes the head of a shard's page, so what
+        # each shard contributed is a prefix and its position stays exact.
+        merged: list[dict] = []
+        while len(merged) < limit:
+            heads = [index for index, page in pages.items() if page]
+            if not heads:
+                break
+            if order == "recent":
+                index = max(heads, key=lambda i: (pages[i][0]["ts"], -i))
+            else:
+                index = min(heads, key=lambda i: (pages[i][0]["rank"], i, pages[i][0]["id"]))
+            hit = pages[index].pop(0)
+            merged.append(hit)
+            positions[index] = {"id": hit["id"], "rank": hit["rank"]}
+        for index, page in pages.items():
+            if page:
+                done.discard(index)
+        if all(index in done for index in targets):
+            return merged, None
+        return merged, {
+            "s": {str(index): value for index, value in positions.items()},
+            "d": sorted(done),
+        }
+
+
+def create_engine(
+    db_path: Path,
+    *,
+    cache: HistoryCache | None = None,
+    **engine_options: object,
+) -> Engine | ShardedEngine:
+    """The engine the settings ask for: one file, or shards when AGENTCHAT_SHARDS is set."""
+    archive = ArchiveStore(settings.get_archive_dir(db_path))
+    count = settings.get_shard_count()
+    if count:
+        return ShardedEngine(
+            settings.get_shard_dir(db_path),
+            count,
+            shard_map=settings.get_shard_map(),
+            cache=cache,
+            archive=archive,
+            **engine_options,
+        )
+    return Engine(db_path, cache=cache, archive=archive, **engine_options)
+
+
+def split_database(
+    source: Path,
+    directory: Path,
+    count: int,
+    shard_map: dict[str, int] | None = None,
+    batch_size: int = 10000,
+) -> list[int]:
+    """Copy a single-file database into ``count`` shards, keeping message ids.
+
+    Returns the number of messages written to each shard. Archive segments
+    are keyed by room and id, so they stay valid without being touched.
+    """
+    shard_map = dict(shard_map or {})
+    paths = [shard_path(directory, index) for index in range(count)]
+    existing = [path for path in paths if path.exists()]
+    if existing:
+        raise FileExistsError(f"shard files already exist: {existing[0]}")
+    # Brings an older source up to the current schema first.
+    init_db(source)
+    check_layout(directory, count, shard_map)
+    for path in paths:
+        init_db(path)
+
+    counts = [0] * count
+    buffers: list[list[dict]] = [[] for _ in range(count)]
+    targets = [sqlite3.connect(path) for path in paths]
+    lookups = [NameLookup() for _ in range(count)]
+
+    def flush(index: int) -> None:
+        if not buffers[index]:
+            return
+        with targets[index]:
+            created, _ = write_rows(targets[index], lookups[index], buffers[index], keep_ids=True)
+        lookups[index].remember_created(created)
+        counts[index] += len(buffers[index])
+        buffers[index].clear()
+
+    try:
+        for row in iter_messages(source, chunk=batch_size):
+            index = shard_for(row["room"], count, shard_map)
+            buffers[index].append(row)
+            if len(buffers[index]) >= batch_size:
+                flush(index)
+        for index in range(count):
+            flush(index)
+    finally:
+        for target in targets:
+            target.close()
+    return counts
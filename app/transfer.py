@@ -0,0 +1,218 @@
+﻿"""Bulk export and import of messages as NDJSON, straight against the database files."""
+from __future__ import annotations
+
+import gzip
+import json
+import sqlite3
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import IO, Callable, Iterable
+
+from pydantic import Field, ValidationError
+
+from app.db import NameLookup, bulk_load, init_db, write_rows
+from app.schema import MessageIn
+
+# Lines are API-shaped messages, like archive segments, so either can be
+# fed back to ``import_messages``.
+IMPORT_BATCH = 50000
+# Reasons kept for the report; further invalid lines are only counted.
+MAX_REJECTED_REASONS = 20
+
+
+def open_input(name: str) -> IO[bytes]:
+    """``-`` for stdin; ``.gz`` files are decompressed as they are read."""
+    if name == "-":
+        return sys.stdin.buffer
+    if name.endswith(".gz"):
+        return gzip.open(name, "rb")
+    return open(name, "rb")
+
+
+def open_output(name: str) -> IO[bytes]:
+    if name == "-":
+        return sys.stdout.buffer
+    if name.endswith(".gz"):
+        # Level 6 rather than the default 9: nearly the same size in far less time.
+        return gzip.open(name, "wb", compresslevel=6)
+    return open(name, "wb")
+
+
+def export_messages(messages: Iterable[dict], out: IO[bytes], chunk: int = 1000) -> int:
+    """Write ``messages`` to ``out`` as NDJSON, ``chunk`` lines per write call."""
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    count = 0
+    lines = []
+    for message in messages:
+        lines.append(encode(message))
+        if len(lines) >= chunk:
+            out.write(("\n".join(lines) + "\n").encode("utf-8"))
+            count += len(lines)
+            lines.clear()
+    if lines:
+        out.write(("\n".join(lines) + "\n").encode("utf-8"))
+        count += len(lines)
+    return count
+
+
+class ImportReport:
+    """Counts of one import; ``reasons`` holds (source, line number, reason)
+    for the first few rejected lines."""
+
+    def __init__(self) -> None:
+        self.imported = 0
+        self.rejected = 0
+        self.first_id: int | None = None
+        self.last_id: int | None = None
+        self.reasons: list[tuple[str, int, str]] = []
+        self.started = time.monotonic()
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.imported / self.seconds if self.seconds else 0.0
+
+
+class _Line(MessageIn):
+    id: int | None = Field(default=None, ge=1)
+    blob_size: int | None = Field(default=None, ge=0)
+
+
+def parse_line(line: bytes, keep_ids: bool) -> dict:
+    """A row for ``write_rows``; raises ValueError with the reason it is invalid."""
+    try:
+        # The model is thrown away, so its field dict can be used as the row.
+        message = _Line.model_validate_json(line).__dict__
+    except ValidationError as exc:
+        error = exc.errors()[0]
+        loc = ".".join(str(part) for part in error["loc"])
+        raise ValueError(f"{loc}: {error['msg']}" if loc else error["msg"]) from None
+    if message["ts"] is None:
+        message["ts"] = datetime.now(timezone.utc).isoformat()
+    if keep_ids and message["id"] is None:
+        raise ValueError("id: required to keep ids")
+    return message
+
+
+class _Target:
+    """One database file being loaded: a connection and its pending rows."""
+
+    def __init__(self, path: Path) -> None:
+        init_db(path)
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=1.0)
+        # Rows are written behind the back of any server using the file (its
+        # history cache and ETags would go stale), so the import takes the
+        # file for itself: the lock fails while another connection has it
+        # open, even an idle one, and keeps servers out until the import ends.
+        self.conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+        try:
+            self.conn.execute("BEGIN EXCLUSIVE")
+            self.conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            self.conn.close()
+            raise ValueError(f"{path} is in use; stop the server before importing") from None
+        self.conn.execute("PRAGMA cache_size=-65536")
+        self.lookup = NameLookup()
+        self.rows: list[dict] = []
+        # With kept ids: the highest id seen so far, and those of ``rows``.
+        self.high = 0
+        self.pending_ids: set[int] = set()
+
+    def claim_id(self, ident: int) -> bool:
+        """Whether a kept ``ident`` is still free. Ids above every earlier one
+        (the usual, sorted input) are, without a lookup."""
+        if ident > self.high:
+            self.high = ident
+        elif ident in self.pending_ids or self.conn.execute(
+            "SELECT 1 FROM messages WHERE id = ?", (ident,)
+        ).fetchone():
+            return False
+        self.pending_ids.add(ident)
+        return True
+
+    def flush(self, report: ImportReport, keep_ids: bool) -> None:
+        if not self.rows:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            created, last_id = write_rows(self.conn, self.lookup, self.rows, keep_ids=keep_ids)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.lookup.remember_created(created)
+        first_id = self.rows[0]["id"] if keep_ids else last_id - len(self.rows) + 1
+        if report.first_id is None:
+            report.first_id = first_id
+        report.last_id = last_id
+        report.imported += len(self.rows)
+        self.rows.clear()
+        self.pending_ids.clear()
+
+
+def import_messages(
+    paths: list[Path],
+    sources: Iterable[tuple[str, IO[bytes]]],
+    *,
+    route: Callable[[str], int] | None = None,
+    keep_ids: bool = False,
+    batch_size: int = IMPORT_BATCH,
+    progress: Callable[[ImportReport], None] | None = None,
+) -> ImportReport:
+    """Load NDJSON messages from ``sources`` into the database files ``paths``.
+
+    Messages get new ids after the existing ones, in file order, unless
+    ``keep_ids`` (only allowed into empty databases, e.g. a restore). Rows
+    are written ``batch_size`` at a time with one ``executemany`` per
+    transaction while index upkeep is deferred (``db.bulk_load``), so memory
+    stays flat whatever the input size. ``route`` picks the file for a room
+    when there are several (shards). Invalid lines are skipped and listed in
+    the report, as are repeated ids when keeping them. Raises ValueError if
+    a server has one of the files open.
+    """
+    report = ImportReport()
+
+    def reject(name: str, lineno: int, reason: str) -> None:
+        report.rejected += 1
+        if len(report.reasons) < MAX_REJECTED_REASONS:
+            report.reasons.append((name, lineno, reason))
+    with ExitStack() as stack:
+        targets = []
+        for path in paths:
+            target = _Target(path)
+            stack.callback(target.conn.close)
+            if stack.enter_context(bulk_load(target.conn)) and keep_ids:
+                raise ValueError(
+                    f"{path} is not empty or has held messages; keeping ids needs a new database"
+                )
+            targets.append(target)
+        last_progress = time.monotonic()
+        for name, stream in sources:
+            for lineno, line in enumerate(stream, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = parse_line(line, keep_ids)
+                except ValueError as exc:
+                    reject(name, lineno, str(exc))
+                    continue
+                target = targets[route(row["room"]) if route is not None else 0]
+                if keep_ids and not target.claim_id(row["id"]):
+                    reject(name, lineno, f"id: {row['id']} is already taken")
+                    continue
+                target.rows.append(row)
+                if len(target.rows) >= batch_size:
+                    target.flush(report, keep_ids)
+                    if progress is not None and time.monotonic() - last_progress >= 2:
+                        progress(report)
+                        last_progress = time.monotonic()
+        for target in targets:
+            target.flush(report, keep_ids)
+    return report
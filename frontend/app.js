@@ -8,8 +8,45 @@ const statusEl = document.getElementById('ws-status');
 const roomLabel = document.getElementById('room-label');
 const reconnectButton = document.getElementById('reconnect');
 
-const seenIds = new Set();
+const RECONNECT_MIN_MS = 500;
+const RECONNECT_MAX_MS = 30000;
 let socket = null;
+let socketRoom = null;
+let lastId = null;
+let reconnectDelay = RECONNECT_MIN_MS;
+let reconnectTimer = null;
+let nextRef = 1;
+const pendingPosts = new Map();
+
+// The stream keeps at most MAX_ROWS messages and only the rows near the
+// viewport in the DOM; everything else is a padding spacer.
+const MAX_ROWS = 5000;
+const OVERSCAN_PX = 600;
+const ESTIMATED_ROW_PX = 90;
+const ROW_GAP_PX = 12;
+const PIN_SLACK_PX = 24;
+// Ids this far below the newest one are treated as already seen.
+const DEDUPE_WINDOW = 2048;
+// Background tabs get no animation frames, so frames queued while hidden
+// are applied on a timer instead.
+const HIDDEN_FLUSH_MS = 1000;
+
+const rows = [];
+const rowNodes = new Map();
+let offsets = [0];
+let offsetsDirty = true;
+let incoming = [];
+let resetPending = false;
+let frameRequested = false;
+let pinned = true;
+let seenIds = new Set();
+let seenFloor = 0;
+
+const topSpacer = document.createElement('div');
+const bottomSpacer = document.createElement('div');
+topSpacer.className = 'messages-spacer';
+bottomSpacer.className = 'messages-spacer';
+messagesEl.append(topSpacer, bottomSpacer);
 
 function loadSetting(key, fallback) {
   const value = window.localStorage.getItem(key);
@@ -38,24 +75,234 @@ function formatTime(iso) {
   return date.toLocaleTimeString();
 }
 
+function formatBytes(size) {
+  if (size < 1024) {
+    return `${size} B`;
+  }
+  if (size < 1024 * 1024) {
+    return `${(size / 1024).toFixed(1)} KB`;
+  }
+  return `${(size / (1024 * 1024)).toFixed(1)} MB`;
+}
+
 function renderMessages(messages, reset) {
+  // Frames are only queued here; the DOM is touched once per animation
+  // frame, however many frames or messages arrived in between.
   if (reset) {
-    messagesEl.innerHTML = '';
-    seenIds.clear();
+    incoming = [];
+    resetPending = true;
+  }
+  incoming.push(...messages);
+  if (incoming.length > MAX_ROWS) {
+    // Older rows would be trimmed by the next flush anyway.
+    incoming.splice(0, incoming.length - MAX_ROWS);
   }
-  messages.forEach((msg) => appendMessage(msg));
+  messages.forEach((msg) => {
+    if (msg.id) {
+      lastId = Math.max(lastId || 0, msg.id);
+    }
+  });
+  scheduleFrame();
 }
 
 function appendMessage(msg) {
-  if (msg.id && seenIds.has(msg.id)) {
+  renderMessages([msg], false);
+}
+
+function scheduleFrame() {
+  if (!frameRequested) {
+    frameRequested = true;
+    if (document.hidden) {
+      window.setTimeout(flushFrame, HIDDEN_FLUSH_MS);
+    } else {
+      window.requestAnimationFrame(flushFrame);
+    }
+  }
+}
+
+document.addEventListener('visibilitychange', () => {
+  // A frame requested just before the tab was hidden would otherwise wait
+  // until it is shown again.
+  if (frameRequested) {
+    flushFrame();
+  }
+});
+
+function markSeen(id) {
+  // A bounded stand-in for a set of every id ever shown: recent ids are
+  // remembered exactly, anything older than the window counts as seen.
+  if (id <= seenFloor || seenIds.has(id)) {
+    return false;
+  }
+  seenIds.add(id);
+  if (seenIds.size > DEDUPE_WINDOW * 2) {
+    const newest = Math.max(...seenIds);
+    seenFloor = newest - DEDUPE_WINDOW;
+    seenIds = new Set([...seenIds].filter((seen) => seen > seenFloor));
+  }
+  return true;
+}
+
+function flushFrame() {
+  frameRequested = false;
+  if (resetPending) {
+    resetPending = false;
+    rows.length = 0;
+    rowNodes.forEach((node) => node.remove());
+    rowNodes.clear();
+    seenIds = new Set();
+    seenFloor = 0;
+    offsetsDirty = true;
+    pinned = true;
+  }
+  const batch = incoming;
+  incoming = [];
+  batch.forEach((msg) => {
+    if (msg.id) {
+      if (!markSeen(msg.id)) {
+        return;
+      }
+    }
+    rows.push({ msg, height: null, fresh: true });
+  });
+  if (batch.length) {
+    offsetsDirty = true;
+  }
+  if (rows.length > MAX_ROWS) {
+    const dropped = rows.splice(0, rows.length - MAX_ROWS);
+    const removedHeight = dropped.reduce((sum, row) => sum + rowHeight(row), 0);
+    dropped.forEach((row) => {
+      const node = rowNodes.get(row);
+      if (node) {
+        node.remove();
+        rowNodes.delete(row);
+      }
+    });
+    offsetsDirty = true;
+    if (!pinned) {
+      // Keep what the reader is looking at in place.
+      messagesEl.scrollTop = Math.max(0, messagesEl.scrollTop - removedHeight);
+    }
+  }
+  layout();
+}
+
+function rowHeight(row) {
+  return row.height === null ? ESTIMATED_ROW_PX : row.height;
+}
+
+function computeOffsets() {
+  if (!offsetsDirty) {
     return;
   }
-  if (msg.id) {
-    seenIds.add(msg.id);
+  offsets = new Array(rows.length + 1);
+  offsets[0] = 0;
+  for (let i = 0; i < rows.length; i += 1) {
+    offsets[i + 1] = offsets[i] + rowHeight(rows[i]);
+  }
+  offsetsDirty = false;
+}
+
+function rowAt(position) {
+  // First row whose bottom edge is below ``position``.
+  let low = 0;
+  let high = rows.length;
+  while (low < high) {
+    const mid = (low + high) >> 1;
+    if (offsets[mid + 1] <= position) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return low;
+}
+
+function layout() {
+  computeOffsets();
+  const viewTop = pinned
+    ? Math.max(0, offsets[rows.length] - messagesEl.clientHeight)
+    : messagesEl.scrollTop;
+  const start = rowAt(Math.max(0, viewTop - OVERSCAN_PX));
+  const end = Math.min(rows.length, rowAt(viewTop + messagesEl.clientHeight + OVERSCAN_PX) + 1);
+
+  const visible = new Set(rows.slice(start, end));
+  rowNodes.forEach((node, row) => {
+    if (!visible.has(row)) {
+      node.remove();
+      rowNodes.delete(row);
+    }
+  });
+  // Keyed insert: nodes already in place stay put, so they are neither
+  // rebuilt nor re-animated.
+  let cursor = topSpacer.nextSibling;
+  for (let i = start; i < end; i += 1) {
+    const row = rows[i];
+    let node = rowNodes.get(row);
+    if (node === cursor) {
+      cursor = cursor.nextSibling;
+      continue;
+    }
+    if (!node) {
+      node = buildCard(row.msg, row.fresh);
+      row.fresh = false;
+      rowNodes.set(row, node);
+    }
+    messagesEl.insertBefore(node, cursor);
   }
 
+  // Measure what was just rendered; rows above the viewport that turn out
+  // taller or shorter than estimated shift the scroll position with them.
+  let scrollShift = 0;
+  for (let i = start; i < end; i += 1) {
+    const row = rows[i];
+    const height = rowNodes.get(row).offsetHeight + ROW_GAP_PX;
+    if (height !== row.height) {
+      if (offsets[i + 1] <= viewTop) {
+        scrollShift += height - rowHeight(row);
+      }
+      row.height = height;
+      offsetsDirty = true;
+    }
+  }
+  computeOffsets();
+  topSpacer.style.height = `${offsets[start]}px`;
+  bottomSpacer.style.height = `${offsets[rows.length] - offsets[end]}px`;
+  if (pinned) {
+    messagesEl.scrollTop = messagesEl.scrollHeight;
+  } else if (scrollShift) {
+    messagesEl.scrollTop += scrollShift;
+  }
+}
+
+messagesEl.addEventListener(
+  'scroll',
+  () => {
+    const distance = messagesEl.scrollHeight - messagesEl.scrollTop - messagesEl.clientHeight;
+    pinned = distance <= PIN_SLACK_PX;
+    scheduleFrame();
+  },
+  { passive: true }
+);
+
+if (window.ResizeObserver) {
+  let lastWidth = messagesEl.clientWidth;
+  new ResizeObserver(() => {
+    // Row heights depend on the width; measure again lazily.
+    if (messagesEl.clientWidth !== lastWidth) {
+      lastWidth = messagesEl.clientWidth;
+      rows.forEach((row) => {
+        row.height = null;
+      });
+      offsetsDirty = true;
+    }
+    scheduleFrame();
+  }).observe(messagesEl);
+}
+
+function buildCard(msg, fresh) {
   const card = document.createElement('div');
-  card.className = 'message';
+  card.className = fresh ? 'message fresh' : 'message';
   card.dataset.kind = msg.kind || 'status';
 
   const header = document.createElement('div');
@@ -78,58 +325,148 @@ function appendMessage(msg) {
 
   card.appendChild(header);
   card.appendChild(body);
-
-  messagesEl.appendChild(card);
-  messagesEl.scrollTop = messagesEl.scrollHeight;
+  if (msg.blob) {
+    // ``content`` is only a preview; the full text is fetched on demand.
+    const link = document.createElement('a');
+    link.className = 'message-blob';
+    link.href = `/api/blobs/${msg.blob}`;
+    link.target = '_blank';
+    link.rel = 'noopener';
+    link.textContent = `Full attachment (${formatBytes(msg.blob_size || 0)})`;
+    card.appendChild(link);
+  }
+  return card;
 }
 
-function buildWsUrl(room) {
+function buildWsUrl(room, resumeFrom) {
   const protocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
   const host = window.location.host;
   const params = new URLSearchParams({ room });
+  if (resumeFrom !== null) {
+    params.set('last_id', String(resumeFrom));
+  }
   return `${protocol}://${host}/ws?${params.toString()}`;
 }
 
+function scheduleReconnect() {
+  if (reconnectTimer) {
+    return;
+  }
+  // Jitter spreads reconnects when many tabs lose the server at once.
+  const delay = reconnectDelay * (0.5 + Math.random() / 2);
+  setStatus(`Reconnecting in ${Math.ceil(delay / 1000)}s`, 'bad');
+  reconnectTimer = setTimeout(() => {
+    reconnectTimer = null;
+    connect();
+  }, delay);
+  reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS);
+}
+
+function failPendingPosts() {
+  pendingPosts.forEach((pending) => pending.reject(new Error('connection lost')));
+  pendingPosts.clear();
+}
+
 function connect() {
   const room = roomInput.value.trim() || 'default';
   roomLabel.textContent = room;
   saveSetting('room', room);
 
+  if (reconnectTimer) {
+    clearTimeout(reconnectTimer);
+    reconnectTimer = null;
+  }
   if (socket) {
     socket.close();
   }
+  if (room !== socketRoom) {
+    socketRoom = room;
+    lastId = null;
+  }
 
   setStatus('Connecting…');
-  socket = new WebSocket(buildWsUrl(room));
+  const ws = new WebSocket(buildWsUrl(room, lastId));
+  socket = ws;
 
-  socket.addEventListener('open', () => {
+  ws.addEventListener('open', () => {
+    reconnectDelay = RECONNECT_MIN_MS;
     setStatus('Live');
   });
 
-  socket.addEventListener('message', (event) => {
+  ws.addEventListener('message', (event) => {
     try {
       const payload = JSON.parse(event.data);
       if (payload.type === 'history') {
-        renderMessages(payload.data || [], true);
+        // A resumed history only carries what we missed.
+        renderMessages(payload.data || [], !payload.resumed);
+        return;
+      }
+      if (payload.type === 'messages') {
+        renderMessages(payload.data || [], false);
         return;
       }
       if (payload.type === 'message') {
         appendMessage(payload.data || payload);
+        return;
+      }
+      if (payload.type === 'ack' || payload.type === 'error') {
+        const pending = pendingPosts.get(payload.ref);
+        if (pending) {
+          pendingPosts.delete(payload.ref);
+          if (payload.type === 'ack') {
+            pending.resolve(payload.ids);
+          } else {
+            pending.reject(new Error(payload.detail));
+          }
+        }
+        return;
+      }
+      if (payload.type === 'resync') {
+        // The server dropped us for falling behind; resuming from the last
+        // id we rendered fills the gap.
+        setStatus('Resyncing…');
+        reconnectDelay = RECONNECT_MIN_MS;
       }
     } catch (err) {
       console.error('Bad message', err);
     }
   });
 
-  socket.addEventListener('close', () => {
-    setStatus('Disconnected', 'bad');
+  ws.addEventListener('close', () => {
+    if (ws !== socket) {
+      return;
+    }
+    socket = null;
+    failPendingPosts();
+    scheduleReconnect();
   });
 
-  socket.addEventListener('error', () => {
-    setStatus('Error', 'bad');
+  ws.addEventListener('error', () => {
+    if (ws === socket) {
+      setStatus('Error', 'bad');
+    }
   });
 }
 
+function postOverSocket(message) {
+  return new Promise((resolve, reject) => {
+    const ref = nextRef++;
+    pendingPosts.set(ref, { resolve, reject });
+    socket.send(JSON.stringify({ type: 'post', ref, data: message }));
+  });
+}
+
+async function postOverHttp(message) {
+  const response = await fetch('/api/messages', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(message),
+  });
+  if (!response.ok) {
+    throw new Error(`HTTP ${response.status}`);
+  }
+}
+
 async function sendMessage() {
   const room = roomInput.value.trim() || 'default';
   const agent = agentInput.value.trim();
@@ -143,15 +480,12 @@ async function sendMessage() {
   saveSetting('agent', agent);
   saveSetting('room', room);
 
-  const response = await fetch('/api/messages', {
-    method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ room, agent, kind, content }),
-  });
-
-  if (response.ok) {
+  const message = { room, agent, kind, content };
+  const live = socket && socket.readyState === WebSocket.OPEN && room === socketRoom;
+  try {
+    await (live ? postOverSocket(message) : postOverHttp(message));
     contentInput.value = '';
-  } else {
+  } catch (err) {
     setStatus('Send failed', 'bad');
   }
 }
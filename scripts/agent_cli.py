@@ -1,36 +1,94 @@
 ﻿import argparse
 import asyncio
+import http.client
 import json
+import os
+import random
 import sys
+import time
 import urllib.parse
 import urllib.request
 
-import websockets
+from spool import Spool, flush_command, post_or_spool
+
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+MAX_CONTENT = 4000
+# Well above the server's heartbeat interval, so only a dead connection times out.
+SSE_READ_TIMEOUT = 60.0
 
 
 def normalize_base(url: str) -> str:
     return url.rstrip('/')
 
 
-def build_ws_url(base: str, room: str) -> str:
+def build_ws_url(base: str, room: str, last_id: int | None = None, **filters: str) -> str:
     if base.startswith('https://'):
         ws_base = 'wss://' + base[len('https://') :]
     elif base.startswith('http://'):
         ws_base = 'ws://' + base[len('http://') :]
     else:
         ws_base = 'ws://' + base
-    params = urllib.parse.urlencode({'room': room})
+    query = {'room': room}
+    if last_id is not None:
+        query['last_id'] = last_id
+    query.update({key: value for key, value in filters.items() if value})
+    params = urllib.parse.urlencode(query)
     return f"{ws_base}/ws?{params}"
 
 
+def upload_blob(server: str, name: str) -> dict:
+    """Stream a file (``-`` for stdin) to the hub's blob store; returns {blob, size}."""
+    url = f"{normalize_base(server)}/api/blobs"
+    headers = {'Content-Type': 'application/octet-stream'}
+    if name == '-':
+        # Unknown length: urllib sends it chunked.
+        source = sys.stdin.buffer
+    else:
+        source = open(name, 'rb')
+        headers['Content-Length'] = str(os.fstat(source.fileno()).st_size)
+    try:
+        req = urllib.request.Request(url, data=source, headers=headers)
+        with urllib.request.urlopen(req) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+
+
 def post_message(args: argparse.Namespace) -> int:
-    url = f"{normalize_base(args.server)}/api/messages"
+    if not args.content and not args.attach:
+        print('post needs content or --attach', file=sys.stderr)
+        return 2
     payload = {
         'room': args.room,
         'agent': args.agent,
         'kind': args.kind,
         'content': args.content,
     }
+    if args.attach:
+        # The upload itself is not spooled: only the message referring to it is.
+        try:
+            payload['blob'] = upload_blob(args.server, args.attach)['blob']
+        except Exception as exc:
+            print(f"attach failed: {exc}", file=sys.stderr)
+            return 1
+    if args.no_spool:
+        return post_direct(args.server, payload)
+    outcome, detail = post_or_spool(args.server, payload, spool_only=args.spool)
+    if outcome == 'spooled':
+        if not args.spool:
+            print('hub unavailable; message spooled and will be sent in the background', file=sys.stderr)
+        return 0
+    if outcome == 'rejected':
+        print(f"post failed: {json.dumps(detail)}", file=sys.stderr)
+        return 1
+    print(json.dumps(detail))
+    return 0
+
+
+def post_direct(server: str, payload: dict) -> int:
+    url = f"{normalize_base(server)}/api/messages"
     data = json.dumps(payload).encode('utf-8')
     req = urllib.request.Request(
         url, data=data, headers={'Content-Type': 'application/json'}
@@ -54,25 +112,248 @@ def format_line(msg: dict) -> str:
     return f"[{ts}] ({room}) {agent} {kind}: {content}"
 
 
+def load_websockets():
+    try:
+        import websockets
+    except ImportError:
+        print(
+            'this command needs the websockets package (pip install websockets); '
+            'watch --sse works without it',
+            file=sys.stderr,
+        )
+        return None
+    return websockets
+
+
+def load_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        print('--msgpack needs the msgpack package (pip install msgpack)', file=sys.stderr)
+        return None
+    return msgpack
+
+
+def frame_messages(payload: dict) -> list:
+    if payload.get('type') in ('history', 'messages'):
+        return payload.get('data', [])
+    if payload.get('type') == 'message':
+        return [payload.get('data', {})]
+    return []
+
+
+def print_frame(payload: dict, last_ids: dict) -> bool:
+    """Print a watch frame; False means the server dropped us and we must reconnect."""
+    kind = payload.get('type')
+    if kind == 'resync':
+        print(f"fell behind after id {payload.get('last_id')}; catching up", file=sys.stderr)
+        return False
+    if kind == 'error':
+        print(f"server error: {payload.get('detail')}", file=sys.stderr)
+        return True
+    if kind == 'history' and payload.get('room') in last_ids:
+        if not payload.get('resumed'):
+            print('gap too large to replay; showing latest history', file=sys.stderr)
+    lines = []
+    for msg in frame_messages(payload):
+        # Ids only grow within a room, so resume per room.
+        room = msg.get('room')
+        if msg.get('id', 0) <= last_ids.get(room, 0):
+            continue
+        lines.append(format_line(msg))
+        last_ids[room] = msg.get('id', 0)
+    if lines:
+        # One write per frame, however many messages it batches.
+        print('\n'.join(lines), flush=True)
+    return True
+
+
+def iter_sse(lines):
+    """Yield (event, data) pairs from a text/event-stream body."""
+    event = 'message'
+    data = []
+    for raw in lines:
+        line = raw.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event = 'message'
+            data = []
+            continue
+        if line.startswith(':'):
+            continue  # comment, e.g. the server's keep-alive ping
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+
+
+def watch_sse(args: argparse.Namespace) -> int:
+    """``watch --sse``: follow /api/stream with the standard library only."""
+    if args.msgpack:
+        print('--msgpack is only available over WebSocket', file=sys.stderr)
+        return 1
+    rooms = args.room or ['default']
+    if len(rooms) > 1:
+        print('--sse follows a single room; use the WebSocket mode for several', file=sys.stderr)
+        return 1
+    query = {'room': rooms[0]}
+    if args.filter_agent:
+        query['agent'] = ','.join(args.filter_agent)
+    if args.filter_kind:
+        query['kind'] = ','.join(args.filter_kind)
+    url = f"{normalize_base(args.server)}/api/stream?{urllib.parse.urlencode(query)}"
+    last_ids = {}
+    delay = RECONNECT_MIN
+    while True:
+        headers = {'Accept': 'text/event-stream'}
+        if rooms[0] in last_ids:
+            headers['Last-Event-ID'] = str(last_ids[rooms[0]])
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=SSE_READ_TIMEOUT) as resp:
+                delay = RECONNECT_MIN
+                for _event, data in iter_sse(resp):
+                    if not print_frame(json.loads(data), last_ids):
+                        delay = 0
+                        break
+        except (OSError, ValueError, http.client.HTTPException) as exc:
+            if args.no_reconnect:
+                print(f"watch failed: {exc}", file=sys.stderr)
+                return 1
+            print(f"watch: {exc}; reconnecting in {delay:.1f}s", file=sys.stderr)
+        else:
+            if args.no_reconnect:
+                return 0
+        time.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(max(delay, RECONNECT_MIN) * 2, RECONNECT_MAX)
+
+
 async def watch_messages(args: argparse.Namespace) -> int:
-    ws_url = build_ws_url(normalize_base(args.server), args.room)
+    websockets = load_websockets()
+    if websockets is None:
+        return 1
+    base = normalize_base(args.server)
+    msgpack = None
+    subprotocols = None
+    if args.msgpack:
+        msgpack = load_msgpack()
+        if msgpack is None:
+            return 1
+        subprotocols = ['agentchat.msgpack']
+    rooms = args.room or ['default']
+    agents = args.filter_agent or None
+    kinds = args.filter_kind or None
+    last_ids = {}
+    delay = RECONNECT_MIN
+    while True:
+        ws_url = build_ws_url(
+            base,
+            rooms[0],
+            last_ids.get(rooms[0]),
+            agent=','.join(agents or []),
+            kind=','.join(kinds or []),
+        )
+        try:
+            async with websockets.connect(ws_url, subprotocols=subprotocols) as ws:
+                delay = RECONNECT_MIN
+                for room in rooms[1:]:
+                    subscription = {
+                        'type': 'subscribe',
+                        'room': room,
+                        'agents': agents,
+                        'kinds': kinds,
+                    }
+                    if room in last_ids:
+                        subscription['last_id'] = last_ids[room]
+                    await ws.send(json.dumps(subscription))
+                async for raw in ws:
+                    # Binary frames are MessagePack; a server without msgpack
+                    # support answers with JSON text frames instead.
+                    if isinstance(raw, bytes):
+                        payload = msgpack.unpackb(raw)
+                    else:
+                        payload = json.loads(raw)
+                    if not print_frame(payload, last_ids):
+                        delay = 0
+                        break
+        except (OSError, websockets.exceptions.WebSocketException) as exc:
+            if args.no_reconnect:
+                print(f"watch failed: {exc}", file=sys.stderr)
+                return 1
+            print(f"watch: {exc}; reconnecting in {delay:.1f}s", file=sys.stderr)
+        else:
+            if args.no_reconnect:
+                return 0
+        # Jitter keeps a fleet of watchers from reconnecting in lockstep.
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(max(delay, RECONNECT_MIN) * 2, RECONNECT_MAX)
+
+
+async def stream_messages(args: argparse.Namespace) -> int:
+    """Post stdin lines over one WebSocket, waiting for every ack at the end."""
+    websockets = load_websockets()
+    if websockets is None:
+        return 1
+    # ``room=`` subscribes to nothing: this socket only posts, so history and
+    # broadcasts would be sent to it just to be dropped.
+    ws_url = build_ws_url(normalize_base(args.server), '')
+    pending = set()
+    failed = 0
+    posted = 0
     try:
         async with websockets.connect(ws_url) as ws:
-            async for raw in ws:
-                payload = json.loads(raw)
-                if payload.get('type') == 'history':
-                    for msg in payload.get('data', []):
-                        print(format_line(msg))
+            done = asyncio.Event()
+
+            async def read_acks() -> None:
+                nonlocal failed, posted
+                async for raw in ws:
+                    payload = json.loads(raw)
+                    if payload.get('type') == 'ack':
+                        pending.discard(payload.get('ref'))
+                        posted += len(payload.get('ids', []))
+                    elif payload.get('type') == 'error':
+                        pending.discard(payload.get('ref'))
+                        failed += 1
+                        print(
+                            f"post {payload.get('ref')} failed: {payload.get('detail')}",
+                            file=sys.stderr,
+                        )
+                    if not pending and done.is_set():
+                        return
+
+            reader = asyncio.create_task(read_acks())
+            loop = asyncio.get_running_loop()
+            ref = 0
+            while True:
+                line = await loop.run_in_executor(None, sys.stdin.readline)
+                if not line:
+                    break
+                content = line.rstrip('\n')[:MAX_CONTENT]
+                if not content.strip():
                     continue
-                if payload.get('type') == 'message':
-                    msg = payload.get('data', {})
-                else:
-                    msg = payload
-                print(format_line(msg))
-    except Exception as exc:
-        print(f"watch failed: {exc}", file=sys.stderr)
+                ref += 1
+                pending.add(ref)
+                data = {
+                    'room': args.room,
+                    'agent': args.agent,
+                    'kind': args.kind,
+                    'content': content,
+                }
+                await ws.send(json.dumps({'type': 'post', 'ref': ref, 'data': data}))
+            done.set()
+            if pending:
+                await reader
+            else:
+                reader.cancel()
+    except (OSError, websockets.exceptions.WebSocketException) as exc:
+        print(f"stream failed: {exc}", file=sys.stderr)
         return 1
-    return 0
+    print(f"posted {posted} messages", file=sys.stderr)
+    return 1 if failed or pending else 0
 
 
 def main() -> int:
@@ -85,17 +366,66 @@ def main() -> int:
     post_parser.add_argument('--room', default='default')
     post_parser.add_argument('--agent', required=True)
     post_parser.add_argument('--kind', default='status')
-    post_parser.add_argument('content')
+    post_parser.add_argument(
+        'content', nargs='?', default='', help='message text (with --attach: defaults to a preview)'
+    )
+    post_parser.add_argument(
+        '--attach', metavar='FILE', help='upload FILE (- for stdin) and attach it to the message'
+    )
+    spool_mode = post_parser.add_mutually_exclusive_group()
+    spool_mode.add_argument(
+        '--spool', action='store_true', help='queue locally and return at once (sent in the background)'
+    )
+    spool_mode.add_argument(
+        '--no-spool', action='store_true', help='fail instead of spooling when the hub is unavailable'
+    )
+
+    subparsers.add_parser('flush', help='send spooled messages now')
 
     watch_parser = subparsers.add_parser('watch', help='watch live messages')
-    watch_parser.add_argument('--room', default='default')
+    watch_parser.add_argument(
+        '--room', action='append', help='room to watch (repeat for several; default: default)'
+    )
+    watch_parser.add_argument(
+        '--filter-agent', action='append', help='only messages from this agent (repeatable)'
+    )
+    watch_parser.add_argument(
+        '--filter-kind', action='append', help='only messages of this kind (repeatable)'
+    )
+    watch_parser.add_argument(
+        '--msgpack', action='store_true', help='receive binary MessagePack frames'
+    )
+    watch_parser.add_argument(
+        '--sse',
+        action='store_true',
+        help='follow /api/stream over plain HTTP (no websockets package needed)',
+    )
+    watch_parser.add_argument(
+        '--no-reconnect', action='store_true', help='exit instead of reconnecting'
+    )
+
+    stream_parser = subparsers.add_parser(
+        'stream', help='post each stdin line over one WebSocket'
+    )
+    stream_parser.add_argument('--room', default='default')
+    stream_parser.add_argument('--agent', required=True)
+    stream_parser.add_argument('--kind', default='status')
 
     args = parser.parse_args()
 
     if args.command == 'post':
         return post_message(args)
+    if args.command == 'flush':
+        return flush_command(Spool(args.server))
     if args.command == 'watch':
-        return asyncio.run(watch_messages(args))
+        try:
+            if args.sse:
+                return watch_sse(args)
+            return asyncio.run(watch_messages(args))
+        except KeyboardInterrupt:
+            return 0
+    if args.command == 'stream':
+        return asyncio.run(stream_messages(args))
     return 1
 
 
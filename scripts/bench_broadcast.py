@@ -0,0 +1,95 @@
+"""CPU cost of fanning one message out to many WebSocket watchers.
+
+Compares encoding the payload once per watcher (what ``send_json`` per socket
+did) with one shared ``Frame`` per broadcast. Sockets are replaced by no-op
+coroutines so only the server-side work is measured.
+
+    python scripts/bench_broadcast.py --watchers 200 --messages 2000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.realtime import Client, ConnectionManager, msgpack_available  # noqa: E402
+
+
+def make_payload(index: int, size: int) -> dict:
+    return {
+        "type": "message",
+        "data": {
+            # Ids start at 1: watchers skip ids they have already seen.
+            "id": index + 1,
+            "ts": "2024-05-01T12:00:00.250000+00:00",
+            "room": "bench",
+            "agent": "agent-7",
+            "kind": "status",
+            "content": "x" * size,
+        },
+    }
+
+
+async def per_watcher_encode(watchers: int, messages: int, size: int) -> float:
+    async def send(data: str) -> None:
+        return None
+
+    start = time.process_time()
+    for index in range(messages):
+        payload = make_payload(index, size)
+        for _ in range(watchers):
+            await send(json.dumps(payload, separators=(",", ":"), ensure_ascii=False))
+    return time.process_time() - start
+
+
+async def shared_frame(watchers: int, messages: int, size: int, fmt: str) -> float:
+    manager = ConnectionManager(max_queue=messages + 1)
+    done = asyncio.Event()
+    remaining = [watchers * messages]
+
+    async def send(frame) -> None:
+        frame.encode(fmt)
+        remaining[0] -= 1
+        if not remaining[0]:
+            done.set()
+
+    clients = [Client(send, max_queue=messages + 1) for _ in range(watchers)]
+    for client in clients:
+        manager.register("bench", client)
+    start = time.process_time()
+    for index in range(messages):
+        manager.broadcast("bench", make_payload(index, size))
+    await done.wait()
+    elapsed = time.process_time() - start
+    for client in clients:
+        await manager.unregister(client)
+    return elapsed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--watchers", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=200, help="content length")
+    args = parser.parse_args()
+
+    runs = [("per-watcher json", per_watcher_encode(args.watchers, args.messages, args.size))]
+    runs.append(("shared frame json", shared_frame(args.watchers, args.messages, args.size, "json")))
+    if msgpack_available():
+        runs.append(
+            ("shared frame msgpack", shared_frame(args.watchers, args.messages, args.size, "msgpack"))
+        )
+    print(f"{args.watchers} watchers, {args.messages} broadcasts, {args.size} byte content")
+    for label, run in runs:
+        elapsed = asyncio.run(run)
+        print(f"{label:>22}: {elapsed / args.messages * 1e6:9.1f} us CPU per broadcast")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
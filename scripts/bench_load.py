@@ -0,0 +1,406 @@
+"""End-to-end load benchmark with JSON results, so runs can be compared over time.
+
+Boots the server (``create_app`` via uvicorn) in a subprocess against a
+temporary database, then runs posting agents (one keep-alive HTTP connection
+per thread) and WebSocket watchers spread over several rooms. Reports posts
+per second, post-to-delivery latency percentiles, database growth and the
+server's CPU time, followed by microbenchmarks of the storage functions.
+
+    python scripts/bench_load.py --agents 8 --watchers 40 --rooms 4 --duration 10
+    python scripts/bench_load.py --env AGENTCHAT_COALESCE_MS=5 --output runs/coalesce.json
+
+Load generator and watchers share one process, so on a small machine they
+compete with the server for CPU; compare runs made on the same host.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app import db  # noqa: E402
+
+RESULT_VERSION = 1
+
+
+def percentiles(samples: list[float], scale: float = 1.0) -> dict:
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        index = min(len(ordered) - 1, int(fraction * len(ordered)))
+        return round(ordered[index] * scale, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": at(0.50),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(ordered[-1] * scale, 3),
+    }
+
+
+def directory_bytes(path: Path) -> int:
+    return sum(item.stat().st_size for item in path.rglob("*") if item.is_file())
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def start_server(db_path: Path, port: int, env: dict[str, str]) -> subprocess.Popen:
+    cmd = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "app.main:create_app",
+        "--factory",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--log-level",
+        "warning",
+    ]
+    server_env = {**os.environ, **env, "AGENTCHAT_DB": str(db_path)}
+    return subprocess.Popen(cmd, cwd=ROOT, env=server_env)
+
+
+def wait_for_health(base: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"{base}/health", timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("server did not become healthy")
+        time.sleep(0.1)
+
+
+def run_agent(
+    port: int,
+    agent: str,
+    rooms: list[str],
+    size: int,
+    rate: float,
+    stop: threading.Event,
+    results: list,
+) -> None:
+    """Post round-robin over ``rooms`` until ``stop``; content starts with the send time."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    padding = "x" * size
+    interval = 1.0 / rate if rate else 0.0
+    sent = errors = 0
+    post_seconds: list[float] = []
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        if interval:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+        started = time.perf_counter()
+        body = json.dumps(
+            {
+                "room": rooms[sent % len(rooms)],
+                "agent": agent,
+                "kind": "bench",
+                "content": f"{started:.6f} {padding}",
+            }
+        )
+        try:
+            conn.request("POST", "/api/messages", body, {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        post_seconds.append(time.perf_counter() - started)
+        sent += 1
+    conn.close()
+    results.append({"sent": sent, "errors": errors, "post_seconds": post_seconds})
+
+
+async def run_watchers(
+    port: int,
+    rooms: list[str],
+    count: int,
+    stats: dict,
+    ready: threading.Event,
+    stop: asyncio.Event,
+) -> None:
+    """Watch until ``stop``, recording into ``stats`` as deliveries arrive."""
+    import websockets
+
+    latencies = stats["latencies"]
+    per_room = stats["watchers_per_room"]
+
+    async def watch(room: str, connected: asyncio.Event) -> None:
+        url = f"ws://127.0.0.1:{port}/ws?room={room}"
+        async with websockets.connect(url, max_size=None) as ws:
+            await ws.recv()  # history
+            connected.set()
+            while not stop.is_set():
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), 0.2)
+                except asyncio.TimeoutError:
+                    continue
+                now = time.perf_counter()
+                payload = json.loads(raw)
+                if payload["type"] == "message":
+                    messages = [payload["data"]]
+                elif payload["type"] == "messages":
+                    messages = payload["data"]
+                else:
+                    continue
+                for message in messages:
+                    latencies.append(now - float(message["content"].split(" ", 1)[0]))
+                stats["received"] += len(messages)
+
+    events = []
+    tasks = []
+    for index in range(count):
+        room = rooms[index % len(rooms)]
+        per_room[room] += 1
+        connected = asyncio.Event()
+        events.append(connected)
+        tasks.append(asyncio.create_task(watch(room, connected)))
+    await asyncio.gather(*(event.wait() for event in events))
+    ready.set()
+    await asyncio.gather(*tasks)
+
+
+def run_load(args: argparse.Namespace, workdir: Path) -> dict:
+    db_path = workdir / "load.sqlite3"
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = dict(item.split("=", 1) for item in args.env)
+    rooms = [f"bench-{index}" for index in range(args.rooms)]
+    cpu_before = os.times()
+    server = start_server(db_path, port, env)
+    try:
+        wait_for_health(base)
+        bytes_before = directory_bytes(workdir)
+
+        loop = asyncio.new_event_loop()
+        watchers_ready = threading.Event()
+        stop_watchers = asyncio.Event()
+        stats: dict = {
+            "latencies": [],
+            "received": 0,
+            "watchers_per_room": {room: 0 for room in rooms},
+        }
+        watcher = threading.Thread(
+            target=loop.run_until_complete,
+            args=(run_watchers(port, rooms, args.watchers, stats, watchers_ready, stop_watchers),),
+            daemon=True,
+        )
+        watcher.start()
+        if not watchers_ready.wait(timeout=60):
+            raise RuntimeError("watchers did not connect")
+
+        stop_agents = threading.Event()
+        agent_results: list = []
+        agents = [
+            threading.Thread(
+                target=run_agent,
+                args=(port, f"agent-{index}", rooms, args.size, args.rate, stop_agents, agent_results),
+                daemon=True,
+            )
+            for index in range(args.agents)
+        ]
+        started = time.perf_counter()
+        for agent in agents:
+            agent.start()
+        time.sleep(args.duration)
+        stop_agents.set()
+        for agent in agents:
+            agent.join()
+        elapsed = time.perf_counter() - started
+
+        sent = sum(result["sent"] for result in agent_results)
+        # Every agent posts round-robin from the first room.
+        per_room_sent = [0] * len(rooms)
+        for result in agent_results:
+            for position in range(len(rooms)):
+                per_room_sent[position] += len(range(position, result["sent"], len(rooms)))
+        expected = sum(
+            per_room_sent[index] * stats["watchers_per_room"][room]
+            for index, room in enumerate(rooms)
+        )
+        deadline = time.monotonic() + args.drain
+        while stats["received"] < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        loop.call_soon_threadsafe(stop_watchers.set)
+        watcher.join(timeout=5)
+        if not watcher.is_alive():
+            loop.close()
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+    cpu_after = os.times()
+    bytes_after = directory_bytes(workdir)
+    # The server is a reaped child, so its CPU time shows up in os.times().
+    server_cpu = (cpu_after.children_user - cpu_before.children_user) + (
+        cpu_after.children_system - cpu_before.children_system
+    )
+    post_seconds = [value for result in agent_results for value in result["post_seconds"]]
+    return {
+        "duration_s": round(elapsed, 3),
+        "posts": sent,
+        "post_errors": sum(result["errors"] for result in agent_results),
+        "posts_per_s": round(sent / elapsed, 1) if elapsed else None,
+        "post_latency_ms": percentiles(post_seconds, 1000),
+        "deliveries": stats["received"],
+        "deliveries_expected": expected,
+        "delivery_latency_ms": percentiles(stats["latencies"], 1000),
+        "db_bytes_before": bytes_before,
+        "db_bytes_after": bytes_after,
+        "db_bytes_per_post": round((bytes_after - bytes_before) / sent, 1) if sent else None,
+        "server_cpu_s": round(server_cpu, 3),
+        "server_cpu_per_post_ms": round(server_cpu / sent * 1000, 4) if sent else None,
+    }
+
+
+def time_calls(fn, count: int) -> dict:
+    samples = []
+    started = time.perf_counter()
+    for index in range(count):
+        begin = time.perf_counter()
+        fn(index)
+        samples.append(time.perf_counter() - begin)
+    total = time.perf_counter() - started
+    return {"ops_per_s": round(count / total, 1), "latency_us": percentiles(samples, 1e6)}
+
+
+def run_micro(args: argparse.Namespace, workdir: Path) -> dict:
+    path = workdir / "micro.sqlite3"
+    db.init_db(path)
+    padding = "x" * args.size
+
+    def message(index: int) -> dict:
+        return {
+            "room": f"micro-{index % 4}",
+            "agent": f"agent-{index % 8}",
+            "kind": "bench",
+            "content": padding,
+        }
+
+    results = {
+        "db.insert_message": time_calls(lambda i: db.insert_message(path, message(i)), args.micro),
+        "db.fetch_messages": time_calls(
+            lambda i: db.fetch_messages(path, f"micro-{i % 4}", 50, None, order="desc"),
+            args.micro,
+        ),
+    }
+    engine = db.Engine(workdir / "engine.sqlite3")
+    engine.start()
+    try:
+        results["Engine.insert_message"] = time_calls(
+            lambda i: engine.insert_message(message(i)), args.micro
+        )
+        results["Engine.fetch_messages"] = time_calls(
+            lambda i: engine.fetch_messages(f"micro-{i % 4}", 50, None, order="desc"), args.micro
+        )
+    finally:
+        engine.close()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=8, help="posting threads")
+    parser.add_argument("--watchers", type=int, default=20, help="WebSocket watchers")
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of posting")
+    parser.add_argument("--rate", type=float, default=0.0, help="posts/s per agent (0: flat out)")
+    parser.add_argument("--size", type=int, default=200, help="content length")
+    parser.add_argument("--drain", type=float, default=5.0, help="seconds to wait for deliveries")
+    parser.add_argument("--micro", type=int, default=2000, help="calls per microbenchmark")
+    parser.add_argument(
+        "--env", action="append", default=[], metavar="KEY=VALUE", help="server setting"
+    )
+    parser.add_argument("--no-load", action="store_true", help="only run microbenchmarks")
+    parser.add_argument("--no-micro", action="store_true", help="skip microbenchmarks")
+    parser.add_argument("--output", type=Path, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    for item in args.env:
+        if "=" not in item:
+            parser.error(f"--env expects KEY=VALUE, got {item!r}")
+    args.rooms = max(1, args.rooms)
+
+    report = {
+        "version": RESULT_VERSION,
+        "started": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "no_load", "no_micro")
+        },
+    }
+    with tempfile.TemporaryDirectory(prefix="agentchat-bench-") as tmp:
+        workdir = Path(tmp)
+        if not args.no_load:
+            (workdir / "load").mkdir()
+            report["load"] = run_load(args, workdir / "load")
+        if not args.no_micro:
+            (workdir / "micro").mkdir()
+            report["micro"] = run_micro(args, workdir / "micro")
+
+    text = json.dumps(report, indent=2, default=str)
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
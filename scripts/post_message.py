@@ -5,11 +5,14 @@ import sys
 import urllib.error
 import urllib.request
 from pathlib import Path
+from typing import Iterable, Iterator
 
+from spool import Spool, flush_command, post_or_spool
 
 DEFAULT_SERVER = "http://127.0.0.1:8000"
 DEFAULT_ROOM = "default"
 DEFAULT_KIND = "status"
+MAX_CONTENT = 4000
 
 
 def normalize_base(url: str) -> str:
@@ -51,10 +54,7 @@ def resolve_agent(cli_agent: str | None, config_path: Path) -> str | None:
     return load_agent_from_config(config_path)
 
 
-def post_message(server: str, payload: dict) -> int:
-    url = f"{normalize_base(server)}/api/messages"
-    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+def send_request(req: urllib.request.Request) -> int:
     try:
         with urllib.request.urlopen(req) as resp:
             body = resp.read().decode("utf-8")
@@ -69,6 +69,37 @@ def post_message(server: str, payload: dict) -> int:
         return 1
 
 
+def post_message(server: str, payload: dict) -> int:
+    url = f"{normalize_base(server)}/api/messages"
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    return send_request(req)
+
+
+def iter_ndjson(lines: Iterable[str], base: dict) -> Iterator[bytes]:
+    """Turn each non-empty input line into one NDJSON message (long lines are split)."""
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+        if not line.strip():
+            continue
+        for start in range(0, len(line), MAX_CONTENT):
+            payload = {**base, "content": line[start : start + MAX_CONTENT]}
+            yield (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def post_batch(server: str, base: dict, lines: Iterable[str]) -> int:
+    # An iterable body makes urllib stream it with chunked transfer encoding,
+    # so a large log is never held in memory on either side of the pipe.
+    url = f"{normalize_base(server)}/api/messages/ndjson"
+    req = urllib.request.Request(
+        url,
+        data=iter_ndjson(lines, base),
+        headers={"Content-Type": "application/x-ndjson"},
+        method="POST",
+    )
+    return send_request(req)
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Post a message to Multi-Agent Chat Hub")
     parser.add_argument("--server", default=os.environ.get("AGENTCHAT_SERVER", DEFAULT_SERVER))
@@ -80,6 +111,25 @@ def main() -> int:
         metavar="NAME",
         help="persist default agent name to ~/.agentchat.json (or $env:AGENTCHAT_CONFIG)",
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="read stdin and post every line as its own message in one request",
+    )
+    spool_mode = parser.add_mutually_exclusive_group()
+    spool_mode.add_argument(
+        "--spool",
+        action="store_true",
+        help="queue the message locally and return at once; a background process sends it",
+    )
+    spool_mode.add_argument(
+        "--no-spool",
+        action="store_true",
+        help="fail instead of spooling when the hub is unavailable",
+    )
+    parser.add_argument(
+        "--flush", action="store_true", help="send spooled messages now and exit"
+    )
     parser.add_argument("content", nargs="*", help="message content (or read from stdin)")
     args = parser.parse_args()
 
@@ -94,13 +144,22 @@ def main() -> int:
         print(f"saved agent={agent} to {config_path}")
         return 0
 
-    content = " ".join(args.content).strip()
-    if not content:
-        content = sys.stdin.read().strip()
-    if not content:
-        print("content is required (arg or stdin)", file=sys.stderr)
+    if args.flush:
+        return flush_command(Spool(args.server))
+
+    if args.batch and args.content:
+        print("--batch reads messages from stdin; do not pass content arguments", file=sys.stderr)
         return 2
 
+    content = ""
+    if not args.batch:
+        content = " ".join(args.content).strip()
+        if not content:
+            content = sys.stdin.read().strip()
+        if not content:
+            print("content is required (arg or stdin)", file=sys.stderr)
+            return 2
+
     agent = resolve_agent(args.agent, config_path)
     if not agent:
         print(
@@ -109,8 +168,23 @@ def main() -> int:
         )
         return 2
 
+    if args.batch:
+        base = {"room": args.room, "agent": agent, "kind": args.kind}
+        return post_batch(args.server, base, sys.stdin)
+
     payload = {"room": args.room, "agent": agent, "kind": args.kind, "content": content}
-    return post_message(args.server, payload)
+    if args.no_spool:
+        return post_message(args.server, payload)
+    outcome, detail = post_or_spool(args.server, payload, spool_only=args.spool)
+    if outcome == "spooled":
+        if not args.spool:
+            print("hub unavailable; message spooled and will be sent in the background", file=sys.stderr)
+        return 0
+    if outcome == "rejected":
+        print(json.dumps(detail, ensure_ascii=False), file=sys.stderr)
+        return 1
+    print(json.dumps(detail, ensure_ascii=False))
+    return 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,383 @@
+"""Local spool for messages the hub could not take right now.
+
+Posting CLIs append here when the hub is down (or always, in ``--spool``
+mode) and return at once; a detached drainer then sends the spooled
+messages in order, in batches over one keep-alive connection, until the
+spool is empty. One file per server under ``~/.agentchat-spool`` (or
+``$AGENTCHAT_SPOOL_DIR``), one JSON message per line, each stamped with the
+time it was written so the hub keeps the original timestamps.
+
+    python scripts/spool.py flush     # send everything now
+    python scripts/spool.py status    # how many messages are waiting
+
+Delivery is at least once: if the hub stores a batch but the response is
+lost, that batch is sent again.
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_SERVER = "http://127.0.0.1:8000"
+BATCH_SIZE = 500
+DRAIN_SECONDS = 600.0
+RETRY_MIN = 0.5
+RETRY_MAX = 30.0
+# Statuses that mean "try again later"; other 4xx answers reject the batch.
+RETRYABLE = {408, 425, 429, 500, 502, 503, 504}
+
+
+def normalize_base(url: str) -> str:
+    return url.rstrip("/")
+
+
+def default_spool_dir() -> Path:
+    configured = os.environ.get("AGENTCHAT_SPOOL_DIR")
+    if configured:
+        return Path(configured)
+    return Path.home() / ".agentchat-spool"
+
+
+@contextmanager
+def file_lock(path: Path, *, blocking: bool = True) -> Iterator[bool]:
+    """Hold an exclusive lock on ``path``; yields False if ``blocking`` is off and it is taken."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if blocking:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    finally:
+        os.close(fd)
+
+
+class HubUnavailable(Exception):
+    def __init__(self, detail: str, retry_after: float | None = None) -> None:
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+
+class HubConnection:
+    """One keep-alive HTTP connection to the hub, reopened after errors."""
+
+    def __init__(self, server: str, timeout: float = 10.0) -> None:
+        parsed = urllib.parse.urlsplit(normalize_base(server))
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port
+        self.prefix = parsed.path
+        self.timeout = timeout
+        self._conn: http.client.HTTPConnection | None = None
+
+    def post_json(self, path: str, payload: object) -> tuple[int, bytes, dict]:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        if self._conn is None:
+            factory = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self._conn = factory(self.host, self.port, timeout=self.timeout)
+        try:
+            self._conn.request(
+                "POST", self.prefix + path, body, {"Content-Type": "application/json"}
+            )
+            resp = self._conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException) as exc:
+            self.close()
+            raise HubUnavailable(str(exc) or type(exc).__name__) from exc
+        return resp.status, data, {key.lower(): value for key, value in resp.getheaders()}
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _retry_after(headers: dict) -> float | None:
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class Spool:
+    """The spool of one server: an append file plus batches claimed for sending.
+
+    Appending takes a short lock; sending renames the append file to a
+    ``*.batch`` file under that lock, so writers never wait on the network.
+    Batches are sent oldest first, and a batch cut short by an outage is
+    rewritten with what is left, keeping its place in line.
+    """
+
+    def __init__(self, server: str, directory: Path | None = None) -> None:
+        self.server = normalize_base(server)
+        self.directory = directory or default_spool_dir()
+        self.name = urllib.parse.quote(self.server, safe="")
+        self.path = self.directory / f"{self.name}.ndjson"
+        self.rejected_path = self.directory / f"{self.name}.rejected"
+        self._append_lock = self.directory / f"{self.name}.lock"
+        self._drain_lock = self.directory / f"{self.name}.drain.lock"
+
+    def append(self, messages: list[dict]) -> None:
+        now = datetime.now(timezone.utc).isoformat()
+        data = "".join(
+            json.dumps({"ts": now, **message}, ensure_ascii=False) + "\n" for message in messages
+        ).encode("utf-8")
+        with file_lock(self._append_lock):
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    def batches(self) -> list[Path]:
+        # Zero-padded nanosecond names sort in the order they were claimed.
+        return sorted(self.directory.glob(f"{self.name}.*.batch"))
+
+    def pending(self) -> int:
+        """Messages waiting to be sent."""
+        count = 0
+        for path in [*self.batches(), self.path]:
+            try:
+                with path.open("rb") as handle:
+                    count += sum(1 for line in handle if line.strip())
+            except FileNotFoundError:
+                pass
+        return count
+
+    def has_pending(self) -> bool:
+        if self.batches():
+            return True
+        try:
+            return self.path.stat().st_size > 0
+        except FileNotFoundError:
+            return False
+
+    def _claim(self) -> Path | None:
+        with file_lock(self._append_lock):
+            try:
+                if self.path.stat().st_size == 0:
+                    return None
+            except FileNotFoundError:
+                return None
+            batch = self.directory / f"{self.name}.{time.time_ns():020d}.batch"
+            os.replace(self.path, batch)
+        return batch
+
+    def flush(self, conn: HubConnection | None = None) -> dict:
+        """Send everything spooled so far. Raises HubUnavailable if the hub
+        stops taking messages; what was not sent stays spooled.
+
+        Returns counts of sent and rejected messages, or ``{"busy": True}``
+        when another process is already flushing this spool.
+        """
+        with file_lock(self._drain_lock, blocking=False) as locked:
+            if not locked:
+                return {"busy": True}
+            conn = conn or HubConnection(self.server)
+            totals = {"sent": 0, "rejected": 0}
+            try:
+                while True:
+                    batches = self.batches()
+                    if not batches:
+                        claimed = self._claim()
+                        if claimed is None:
+                            return totals
+                        batches = [claimed]
+                    for batch in batches:
+                        self._send_batch(conn, batch, totals)
+            finally:
+                conn.close()
+
+    def _send_batch(self, conn: HubConnection, batch: Path, totals: dict) -> None:
+        lines, messages = [], []
+        for line in batch.read_bytes().splitlines():
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                self._reject([line], "unreadable line")
+                totals["rejected"] += 1
+                continue
+            lines.append(line)
+        sent = 0
+        try:
+            while sent < len(messages):
+                chunk = messages[sent : sent + BATCH_SIZE]
+                status, body, headers = conn.post_json("/api/messages/batch", chunk)
+                if status in RETRYABLE:
+                    raise HubUnavailable(f"hub answered {status}", _retry_after(headers))
+                if status < 400:
+                    totals["sent"] += len(chunk)
+                    sent += len(chunk)
+                    continue
+                # One bad message fails the whole batch: find it one by one,
+                # since resending what the hub refuses would block the spool.
+                for message in chunk:
+                    status, body, headers = conn.post_json("/api/messages", message)
+                    if status in RETRYABLE:
+                        raise HubUnavailable(f"hub answered {status}", _retry_after(headers))
+                    if status < 400:
+                        totals["sent"] += 1
+                    else:
+                        self._reject([lines[sent]], body.decode("utf-8", errors="replace")[:500])
+                        totals["rejected"] += 1
+                    sent += 1
+        finally:
+            if sent >= len(lines):
+                batch.unlink()
+            elif sent:
+                remaining = batch.with_suffix(".tmp")
+                remaining.write_bytes(b"".join(line + b"\n" for line in lines[sent:]))
+                os.replace(remaining, batch)
+
+    def _reject(self, lines: list[bytes], reason: str) -> None:
+        print(f"spool: hub rejected {len(lines)} message(s): {reason}", file=sys.stderr)
+        with self.rejected_path.open("ab") as handle:
+            for line in lines:
+                handle.write(line + b"\n")
+
+    def drain(self, max_seconds: float = DRAIN_SECONDS) -> int:
+        """Flush with backoff until the spool is empty or ``max_seconds`` pass."""
+        deadline = time.monotonic() + max_seconds
+        delay = RETRY_MIN
+        while True:
+            try:
+                result = self.flush()
+            except HubUnavailable as exc:
+                wait = exc.retry_after if exc.retry_after is not None else delay
+                if time.monotonic() + wait > deadline:
+                    print(f"spool: giving up for now: {exc}", file=sys.stderr)
+                    return 1
+                time.sleep(wait)
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+            if result.get("busy") or not self.has_pending():
+                return 0
+            delay = RETRY_MIN
+
+    def start_drainer(self) -> None:
+        """Make sure a background process is draining this spool; never waits."""
+        with file_lock(self._drain_lock, blocking=False) as free:
+            if not free:
+                return  # a drainer (or a flush) is running and will see the new lines
+        cmd = [sys.executable, str(Path(__file__).resolve()), "--server", self.server, "drain"]
+        env = {**os.environ, "AGENTCHAT_SPOOL_DIR": str(self.directory)}
+        options: dict = {
+            "stdin": subprocess.DEVNULL,
+            "stdout": subprocess.DEVNULL,
+            "stderr": subprocess.DEVNULL,
+            "env": env,
+        }
+        if os.name == "nt":
+            options["creationflags"] = (
+                subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+            )
+        else:
+            options["start_new_session"] = True
+        subprocess.Popen(cmd, **options)
+
+
+def post_or_spool(
+    server: str, message: dict, *, spool_only: bool = False
+) -> tuple[str, dict | None]:
+    """Post ``message`` directly, or spool it when the hub is unavailable.
+
+    Returns ``("posted", saved)``, ``("spooled", None)``, or ``("rejected",
+    detail)`` for a message the hub refuses outright. Anything already
+    spooled goes first, so a message queues behind it instead of jumping ahead.
+    """
+    spool = Spool(server)
+    if spool_only or spool.has_pending():
+        spool.append([message])
+        spool.start_drainer()
+        return "spooled", None
+    conn = HubConnection(server, timeout=5.0)
+    try:
+        status, body, _ = conn.post_json("/api/messages", message)
+    except HubUnavailable:
+        status, body = None, b""
+    finally:
+        conn.close()
+    if status is None or status in RETRYABLE:
+        spool.append([message])
+        spool.start_drainer()
+        return "spooled", None
+    try:
+        detail = json.loads(body)
+    except ValueError:
+        detail = {"detail": body.decode("utf-8", errors="replace")}
+    if status >= 400:
+        return "rejected", detail
+    return "posted", detail
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Send or inspect spooled messages")
+    parser.add_argument("--server", default=os.environ.get("AGENTCHAT_SERVER", DEFAULT_SERVER))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("flush", help="send spooled messages now")
+    subparsers.add_parser("status", help="count spooled messages")
+    drain_parser = subparsers.add_parser(
+        "drain", help="flush with retries (what the background drainer runs)"
+    )
+    drain_parser.add_argument("--max-seconds", type=float, default=DRAIN_SECONDS)
+    args = parser.parse_args()
+
+    spool = Spool(args.server)
+    if args.command == "status":
+        print(f"{spool.pending()} message(s) spooled for {spool.server}")
+        return 0
+    if args.command == "drain":
+        return spool.drain(args.max_seconds)
+    return flush_command(spool)
+
+
+def flush_command(spool: Spool) -> int:
+    started = time.monotonic()
+    try:
+        result = spool.flush()
+    except HubUnavailable as exc:
+        print(f"flush stopped: {exc}; {spool.pending()} message(s) still spooled", file=sys.stderr)
+        return 1
+    if result.get("busy"):
+        print("another process is already sending this spool", file=sys.stderr)
+        return 1
+    elapsed = time.monotonic() - started
+    summary = f"sent {result['sent']} message(s) in {elapsed:.2f}s"
+    if result["rejected"]:
+        summary += f", {result['rejected']} rejected (see {spool.rejected_path})"
+    print(summary)
+    return 1 if result["rejected"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,38 @@
+﻿import pytest
+
+from app.admission import Admission, Overloaded, Throttled, TokenBucket
+
+
+def test_token_bucket_refills_and_caps_oversized_costs():
+    bucket = TokenBucket(rate=2, burst=4)
+    assert bucket.wait_time("a", 4, now=0.0) == 0
+    bucket.charge("a", 4, now=0.0)
+    assert bucket.wait_time("a", 1, now=0.0) == pytest.approx(0.5)
+    assert bucket.wait_time("a", 1, now=0.5) == 0
+    # More than the burst waits for a full bucket instead of never passing.
+    assert bucket.wait_time("a", 100, now=1.0) == pytest.approx(1.0)
+    assert bucket.wait_time("b", 100, now=1.0) == 0
+
+
+def test_admission_charges_all_buckets_or_none():
+    admission = Admission(agent_limit=TokenBucket(1, 2), room_limit=TokenBucket(1, 3))
+    admission.check([{"agent": "a", "room": "r"}, {"agent": "a", "room": "r"}])
+    with pytest.raises(Throttled) as excinfo:
+        admission.check([{"agent": "a", "room": "r"}])
+    assert excinfo.value.scope == "agent" and excinfo.value.retry_after_header == "1"
+    # The refused post did not use up the room's last token.
+    admission.check([{"agent": "b", "room": "r"}])
+    with pytest.raises(Throttled) as excinfo:
+        admission.check([{"agent": "c", "room": "r"}])
+    assert excinfo.value.scope == "room"
+
+
+def test_in_flight_cap_sheds_and_releases():
+    admission = Admission(max_in_flight=1)
+    with admission.slot():
+        with pytest.raises(Overloaded):
+            with admission.slot():
+                pass
+    with admission.slot():
+        assert admission.in_flight == 1
+    assert admission.in_flight == 0
@@ -1,5 +1,19 @@
-﻿from fastapi.testclient import TestClient
+﻿import http.client
+import json
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
+import uvicorn
+import anyio
+from fastapi.testclient import TestClient
+from websockets.sync.client import connect
+
+from app import db, metrics, settings
 from app.main import create_app
 
 
@@ -27,3 +41,505 @@ def test_health_and_messages(tmp_path):
         messages = feed.json()
         assert len(messages) == 1
         assert messages[0]["content"] == "hello"
+
+
+def test_batch_and_ndjson_ingest(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws?room=ci") as ws:
+            assert ws.receive_json()["type"] == "history"
+
+            batch = [
+                {"agent": "ci", "kind": "status", "content": f"line {i}", "room": "ci"}
+                for i in range(3)
+            ]
+            resp = client.post("/api/messages/batch", json=batch)
+            assert resp.status_code == 200
+            assert [m["id"] for m in resp.json()] == [1, 2, 3]
+
+            frame = ws.receive_json()
+            assert frame["type"] == "messages"
+            assert [m["content"] for m in frame["data"]] == ["line 0", "line 1", "line 2"]
+
+        lines = "\n".join(
+            json.dumps({"agent": "ci", "content": f"log {i}", "room": "ci"})
+            for i in range(4)
+        )
+        resp = client.post(
+            "/api/messages/ndjson",
+            content=lines.encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert resp.status_code == 200
+        assert resp.json() == {"count": 4, "first_id": 4, "last_id": 7}
+
+        bad = client.post("/api/messages/ndjson", content=b'{"agent": "ci", "content": ""}\n')
+        assert bad.status_code == 422
+        assert bad.json()["detail"][0]["loc"][:2] == ["body", 1]
+
+
+def test_search_filters_and_pages(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        batch = [
+            {"agent": "ci", "room": "ci", "content": "KeyError: 'user_id' in handler"},
+            {"agent": "ci", "room": "ci", "content": "all green"},
+            {"agent": "bob", "room": "ci", "kind": "blocker", "content": "KeyError again"},
+            {"agent": "ci", "room": "other", "content": "KeyError elsewhere"},
+        ]
+        assert client.post("/api/messages/batch", json=batch).status_code == 200
+
+        resp = client.get("/api/search", params={"q": "keyerror", "room": "ci"})
+        assert resp.status_code == 200
+        assert sorted(hit["id"] for hit in resp.json()["hits"]) == [1, 3]
+        assert "[KeyError]" in resp.json()["hits"][0]["snippet"]
+
+        kinds = client.get("/api/search", params={"q": "KeyError:", "kind": "blocker"})
+        assert [hit["agent"] for hit in kinds.json()["hits"]] == ["bob"]
+
+        seen = []
+        params = {"q": "keyerror", "order": "recent", "limit": 2}
+        while True:
+            page = client.get("/api/search", params=params).json()
+            seen.extend(hit["id"] for hit in page["hits"])
+            if not page["next_cursor"]:
+                break
+            params["cursor"] = page["next_cursor"]
+        assert seen == [4, 3, 1]
+
+
+def test_history_paging_with_cursors(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        batch = [{"agent": "ci", "content": f"m{i}", "room": "busy"} for i in range(7)]
+        client.post("/api/messages/batch", json=batch)
+
+        latest = client.get("/api/messages", params={"room": "busy", "order": "desc", "limit": 3})
+        assert [m["id"] for m in latest.json()] == [7, 6, 5]
+
+        pages = []
+        cursor = latest.headers["X-Next-Cursor"]
+        while True:
+            resp = client.get("/api/messages", params={"room": "busy", "limit": 3, "cursor": cursor})
+            if not resp.json():
+                break
+            pages.append([m["id"] for m in resp.json()])
+            cursor = resp.headers["X-Next-Cursor"]
+        assert pages == [[4, 3, 2], [1]]
+
+        before = client.get("/api/messages", params={"room": "busy", "before_id": 5, "limit": 2})
+        assert [m["id"] for m in before.json()] == [3, 4]
+        forward = client.get(
+            "/api/messages",
+            params={"room": "busy", "limit": 2, "cursor": before.headers["X-Next-Cursor"]},
+        )
+        assert [m["id"] for m in forward.json()] == [5, 6]
+
+        bad = client.get("/api/messages", params={"room": "busy", "cursor": "nope"})
+        assert bad.status_code == 400
+
+
+def test_websocket_resume_and_post(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        batch = [{"agent": "ci", "content": f"m{i}", "room": "ci"} for i in range(5)]
+        client.post("/api/messages/batch", json=batch)
+
+        with client.websocket_connect("/ws?room=ci&last_id=3") as ws:
+            resumed = ws.receive_json()
+            assert resumed["resumed"] is True
+            assert [m["id"] for m in resumed["data"]] == [4, 5]
+
+            ws.send_json({"type": "post", "ref": "a1", "data": {"agent": "bot", "content": "hi"}})
+            frame = ws.receive_json()
+            assert frame["type"] == "message" and frame["data"]["room"] == "ci"
+            assert ws.receive_json() == {"type": "ack", "ref": "a1", "ids": [6]}
+
+            ws.send_json({"type": "post", "ref": 2, "data": {"agent": "bot", "content": ""}})
+            error = ws.receive_json()
+            assert error["type"] == "error" and error["ref"] == 2
+
+        with client.websocket_connect("/ws?room=ci&last_id=6") as ws:
+            assert ws.receive_json() == {"type": "history", "data": [], "resumed": True, "room": "ci"}
+
+
+def test_websocket_multi_room_subscriptions(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        old = {"agent": "ci", "room": "ops", "kind": "error", "content": "old"}
+        client.post("/api/messages", json=old)
+        with client.websocket_connect("/ws?room=ci&kind=error") as ws:
+            assert ws.receive_json() == {"type": "history", "data": [], "room": "ci"}
+            ws.send_json({"type": "subscribe", "ref": 1, "room": "ops", "agents": ["ci"]})
+            history = ws.receive_json()
+            assert history["room"] == "ops" and [m["content"] for m in history["data"]] == ["old"]
+            assert ws.receive_json() == {"type": "ack", "ref": 1}
+
+            client.post(
+                "/api/messages/batch",
+                json=[
+                    {"agent": "ci", "room": "ci", "kind": "status", "content": "skip"},
+                    {"agent": "ci", "room": "ci", "kind": "error", "content": "boom"},
+                    {"agent": "bob", "room": "ops", "content": "skip"},
+                    {"agent": "ci", "room": "ops", "content": "deployed"},
+                ],
+            )
+            frames = [ws.receive_json(), ws.receive_json()]
+            assert sorted(m["content"] for f in frames for m in f["data"]) == ["boom", "deployed"]
+
+            ws.send_json({"type": "unsubscribe", "ref": 2, "room": "ops"})
+            assert ws.receive_json() == {"type": "ack", "ref": 2}
+            ws.send_json({"type": "subscribe", "ref": 3})
+            assert ws.receive_json()["type"] == "error"
+
+
+def test_long_poll_wakes_on_new_message(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        client.post("/api/messages", json={"agent": "ci", "room": "ci", "content": "first"})
+        reads = metrics.READ_SECONDS.count("fetch")
+        started = time.monotonic()
+        empty = client.get("/api/messages", params={"room": "ci", "after_id": 1, "wait": 0.2})
+        assert empty.json() == [] and time.monotonic() - started >= 0.2
+        # The room's latest id was broadcast, so the idle poll never queried.
+        assert metrics.READ_SECONDS.count("fetch") == reads
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            poll = pool.submit(
+                client.get, "/api/messages", params={"room": "ci", "after_id": 1, "wait": 10}
+            )
+            time.sleep(0.2)
+            assert not poll.done()
+            client.post("/api/messages", json={"agent": "ci", "room": "ci", "content": "second"})
+            resp = poll.result(timeout=5)
+        assert [m["content"] for m in resp.json()] == ["second"]
+        assert resp.headers["X-Next-Cursor"]
+
+
+def _read_sse_event(resp) -> tuple[dict, dict]:
+    fields: dict = {}
+    for raw in resp:
+        line = raw.decode("utf-8").rstrip("\n")
+        if not line:
+            if "data" in fields:
+                return fields, json.loads(fields["data"])
+            fields = {}
+        elif not line.startswith(":"):
+            name, _, value = line.partition(": ")
+            fields[name] = value
+    raise AssertionError("stream ended")
+
+
+@contextmanager
+def _running_server(app):
+    """Serve ``app`` with uvicorn on a free port; yields the base URL."""
+    server = uvicorn.Server(uvicorn.Config(app, port=0, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        while not server.started:
+            time.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+
+def test_sse_stream_and_last_event_id(tmp_path):
+    # TestClient buffers whole responses, so the stream runs on a real server.
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with _running_server(app) as base:
+
+        def post(content: str) -> None:
+            body = json.dumps({"agent": "ci", "room": "ci", "content": content}).encode()
+            req = urllib.request.Request(
+                f"{base}/api/messages", data=body, headers={"Content-Type": "application/json"}
+            )
+            urllib.request.urlopen(req, timeout=5).read()
+
+        post("first")
+        with urllib.request.urlopen(f"{base}/api/stream?room=ci", timeout=5) as resp:
+            assert resp.headers["Content-Type"].startswith("text/event-stream")
+            fields, frame = _read_sse_event(resp)
+            assert fields["event"] == "history" and fields["id"] == "1"
+            post("second")
+            fields, frame = _read_sse_event(resp)
+            assert (fields["event"], fields["id"]) == ("message", "2")
+            assert frame["data"]["content"] == "second"
+
+        post("third")
+        req = urllib.request.Request(f"{base}/api/stream?room=ci", headers={"Last-Event-ID": "2"})
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            fields, frame = _read_sse_event(resp)
+            assert frame["resumed"] is True
+            assert [m["content"] for m in frame["data"]] == ["third"]
+
+
+def test_metrics_endpoint(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws?room=metrics-room") as ws:
+            ws.receive_json()
+            client.post(
+                "/api/messages", json={"agent": "ci", "room": "metrics-room", "content": "hi"}
+            )
+            ws.receive_json()
+            client.get("/api/messages", params={"room": "metrics-room"})
+            resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = resp.text.splitlines()
+        assert "# TYPE agentchat_write_commit_seconds histogram" in lines
+        assert 'agentchat_messages_total{room="metrics-room",kind="status"} 1' in lines
+        assert 'agentchat_watchers{room="metrics-room"} 1' in lines
+        assert any(line.startswith('agentchat_read_seconds_count{op="fetch"}') for line in lines)
+        assert any(line.startswith('agentchat_sqlite_wal_bytes{shard="0"}') for line in lines)
+        fanout = [line for line in lines if line.startswith("agentchat_broadcast_fanout_count")]
+        assert fanout and int(fanout[0].split()[-1]) >= 1
+
+
+def test_agent_rate_limit_returns_429(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGENTCHAT_AGENT_RATE", "1")
+    monkeypatch.setenv("AGENTCHAT_AGENT_BURST", "2")
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        # Refused requests are not charged to the bucket.
+        unknown_blob = {"agent": "loop", "content": "x", "blob": "0" * 64}
+        assert client.post("/api/messages", json=unknown_blob).status_code == 400
+        assert client.post("/api/messages/batch", json=[unknown_blob] * 3).status_code == 400
+        statuses = [
+            client.post("/api/messages", json={"agent": "loop", "content": "x"}).status_code
+            for _ in range(2)
+        ]
+        assert statuses == [200, 200]
+        resp = client.post("/api/messages", json={"agent": "loop", "content": "x"})
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "1"
+        calm = client.post("/api/messages", json={"agent": "calm", "content": "x"})
+        assert calm.status_code == 200
+
+        with client.websocket_connect("/ws?room=default") as ws:
+            ws.receive_json()
+            ws.send_json({"type": "post", "ref": 1, "data": {"agent": "loop", "content": "x"}})
+            error = ws.receive_json()
+            assert error["type"] == "error" and error["ref"] == 1 and error["retry_after"] > 0
+
+        lines = client.get("/metrics").text.splitlines()
+        throttled = 'agentchat_throttled_total{scope="agent",key="loop"}'
+        assert any(line.startswith(throttled) for line in lines)
+
+
+def test_post_keeps_client_timestamp(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        message = {"agent": "ci", "content": "late", "ts": "2024-05-01T12:00:00.250000+00:00"}
+        saved = client.post("/api/messages", json=message).json()
+        assert saved["ts"] == "2024-05-01T12:00:00.250000+00:00"
+        bad = client.post("/api/messages", json={**message, "ts": "yesterday"})
+        assert bad.status_code == 422
+        # Valid ISO strings whose UTC instant is outside years 1-9999.
+        for ts in ("0001-01-01T00:00:00+00:01", "9999-12-31T23:59:59-05:00"):
+            assert client.post("/api/messages", json={**message, "ts": ts}).status_code == 422
+            batch = client.post("/api/messages/batch", json=[{**message, "ts": ts}])
+            assert batch.status_code == 422
+
+        with client.websocket_connect("/ws?room=default") as ws:
+            ws.receive_json()  # history
+            late = {**message, "ts": "9999-12-31T23:59:59-05:00"}
+            ws.send_json({"type": "post", "ref": "r1", "data": late})
+            error = ws.receive_json()
+            assert error["type"] == "error" and error["ref"] == "r1"
+            ws.send_json({"type": "post", "ref": "r2", "data": {"agent": "ci", "content": "ok"}})
+            assert ws.receive_json()["type"] == "message"
+            assert ws.receive_json()["type"] == "ack"
+
+
+def test_history_etags_and_compression(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        client.post(
+            "/api/messages/batch",
+            json=[{"agent": "ci", "room": "ci", "content": f"row {i} " * 20} for i in range(30)],
+        )
+        params = {"room": "ci", "after_id": 5, "limit": 10}
+        page = client.get("/api/messages", params=params)
+        assert page.headers["content-encoding"] == "gzip"
+        assert page.headers["cache-control"].endswith("immutable")
+        cached = {"If-None-Match": page.headers["etag"]}
+        assert client.get("/api/messages", params=params, headers=cached).status_code == 304
+
+        plain = client.get(
+            "/api/messages",
+            params={"room": "ci", "limit": 1},
+            headers={"Accept-Encoding": "identity"},
+        )
+        assert "content-encoding" not in plain.headers
+        assert plain.headers["cache-control"] == "no-cache"
+        latest = {"room": "ci", "limit": 5, "order": "desc"}
+        cached = {"If-None-Match": client.get("/api/messages", params=latest).headers["etag"]}
+        assert client.get("/api/messages", params=latest, headers=cached).status_code == 304
+        client.post("/api/messages", json={"agent": "ci", "room": "ci", "content": "new"})
+        changed = client.get("/api/messages", params=latest, headers=cached)
+        assert changed.status_code == 200 and changed.json()[0]["content"] == "new"
+
+
+def test_static_assets_are_content_hashed(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        index = client.get("/")
+        assert index.headers["cache-control"] == "no-cache"
+        script = re.search(r'src="(/static/app\.[0-9a-f]{12}\.js)"', index.text).group(1)
+        assert client.get(script).headers["cache-control"].endswith("immutable")
+        assert client.get("/static/app.js").headers["cache-control"] == "no-cache"
+        stale = client.get("/static/app.000000000000.js")
+        assert stale.status_code == 200 and stale.headers["cache-control"] == "no-cache"
+        revalidate = client.get("/", headers={"If-None-Match": index.headers["etag"]})
+        assert revalidate.status_code == 304
+
+
+def test_websocket_negotiates_permessage_deflate(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with _running_server(app) as base:
+        with connect(base.replace("http", "ws", 1) + "/ws?room=ci") as ws:
+            assert "permessage-deflate" in ws.response.headers["Sec-WebSocket-Extensions"]
+            assert json.loads(ws.recv(timeout=5))["type"] == "history"
+
+
+def test_room_listing_and_stats(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        client.post(
+            "/api/messages/batch",
+            json=[
+                {"agent": "bot", "room": "ci/main", "kind": "error", "content": "red"},
+                {"agent": "bot", "room": "ci/main", "content": "green"},
+                {"agent": "dev", "room": "ops", "content": "deployed"},
+            ],
+        )
+        rooms = client.get("/api/rooms").json()
+        assert [(r["room"], r["messages"], r["last_id"]) for r in rooms] == [
+            ("ci/main", 2, 2),
+            ("ops", 1, 3),
+        ]
+        stats = client.get("/api/rooms/ci%2Fmain/stats", params={"minutes": 5}).json()
+        assert stats["agents"][0]["agent"] == "bot" and stats["agents"][0]["messages"] == 2
+        assert sorted(k["kind"] for k in stats["kinds"]) == ["error", "status"]
+        assert sum(m["messages"] for m in stats["per_minute"]) == 2
+        assert client.get("/api/rooms/nowhere/stats").status_code == 404
+
+
+def test_blob_upload_attach_and_range(tmp_path):
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    trace = "".join(f"frame {n}: in handler\n" for n in range(20000)).encode()
+    with TestClient(app) as client:
+        first = client.post("/api/blobs", content=iter([trace[:70000], trace[70000:]]))
+        assert first.status_code == 201 and first.json()["size"] == len(trace)
+        digest = first.json()["blob"]
+        again = client.post("/api/blobs", content=trace)
+        assert again.status_code == 200 and again.json()["blob"] == digest
+
+        with client.websocket_connect("/ws?room=ci") as ws:
+            ws.receive_json()  # history
+            saved = client.post(
+                "/api/messages", json={"agent": "bot", "room": "ci", "blob": digest}
+            ).json()
+            frame = ws.receive_json()
+        assert saved["blob_size"] == len(trace)
+        assert saved["content"].startswith("frame 0: in handler")
+        assert saved["content"].endswith("…")
+        assert len(saved["content"]) <= 501
+        assert frame["data"] == saved
+
+        history = client.get("/api/messages", params={"room": "ci"}).json()
+        assert history == [saved]
+        missing = client.post(
+            "/api/messages", json={"agent": "bot", "blob": "0" * 64, "content": "x"}
+        )
+        assert missing.status_code == 400
+        assert client.post("/api/messages", json={"agent": "bot"}).status_code == 422
+
+        full = client.get(f"/api/blobs/{digest}")
+        assert full.content == trace and full.headers["content-type"].startswith("text/plain")
+        part = client.get(f"/api/blobs/{digest}", headers={"Range": "bytes=10-19"})
+        assert part.status_code == 206 and part.content == trace[10:20]
+        cached = client.get(f"/api/blobs/{digest}", headers={"If-None-Match": full.headers["etag"]})
+        assert cached.status_code == 304
+        assert client.get(f"/api/blobs/{'f' * 64}").status_code == 404
+
+
+def test_blob_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGENTCHAT_BLOB_MAX_MB", "1")
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        chunks = iter([b"x" * 600_000, b"x" * 600_000])
+        assert client.post("/api/blobs", content=chunks).status_code == 413
+    assert list((tmp_path / "blobs" / "tmp").iterdir()) == []
+
+
+def test_reads_are_shed_before_the_thread_pool_fills(tmp_path, monkeypatch):
+    async def worker_threads() -> float:
+        return anyio.to_thread.current_default_thread_limiter().total_tokens
+
+    limit = settings.get_max_in_flight()
+    assert limit < anyio.run(worker_threads)
+    release = threading.Event()
+
+    def blocked_rooms(self):
+        release.wait(10)
+        return []
+
+    monkeypatch.setattr(db.Engine, "rooms", blocked_rooms)
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    extra = 10
+
+    def fetch(base):
+        try:
+            with urllib.request.urlopen(f"{base}/api/rooms", timeout=15) as resp:
+                return resp.status
+        except urllib.error.HTTPError as exc:
+            return exc.code
+
+    with _running_server(app) as base, ThreadPoolExecutor(limit + extra) as pool:
+        futures = [pool.submit(fetch, base) for _ in range(limit + extra)]
+        # Every slot is held until ``release``, so the first answers are refusals.
+        first = []
+        for future in as_completed(futures, timeout=10):
+            first.append(future.result())
+            if len(first) == extra:
+                break
+        release.set()
+        statuses = [future.result() for future in futures]
+    assert first == [503] * extra
+    assert sorted(statuses) == [200] * limit + [503] * extra
+
+
+def test_slow_uploads_do_not_take_post_slots(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGENTCHAT_MAX_IN_FLIGHT", "1")
+    monkeypatch.setenv("AGENTCHAT_MAX_UPLOADS", "1")
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with _running_server(app) as base:
+        host, port = base.removeprefix("http://").split(":")
+        upload = http.client.HTTPConnection(host, int(port), timeout=5)
+        upload.putrequest("POST", "/api/blobs")
+        upload.putheader("Content-Length", "8")
+        upload.endheaders(b"half")
+        time.sleep(0.2)
+
+        def post(path, body):
+            request = urllib.request.Request(
+                f"{base}{path}", data=body, headers={"Content-Type": "application/json"}
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=5) as resp:
+                    return resp.status
+            except urllib.error.HTTPError as exc:
+                return exc.code
+
+        message = json.dumps({"agent": "ci", "content": "still flowing"}).encode()
+        assert post("/api/messages", message) == 200
+        assert post("/api/blobs", b"other") == 503
+        upload.send(b"done")
+        response = upload.getresponse()
+        assert response.status == 201 and json.loads(response.read())["size"] == 8
+        upload.close()
@@ -0,0 +1,31 @@
+﻿from fastapi.testclient import TestClient
+
+from app.main import create_app
+
+
+def test_sqlite_bus_delivers_across_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGENTCHAT_BUS", "sqlite")
+    monkeypatch.setenv("AGENTCHAT_BUS_POLL_MS", "5")
+    path = tmp_path / "shared.sqlite3"
+    with TestClient(create_app(db_path=path)) as worker_a, TestClient(
+        create_app(db_path=path)
+    ) as worker_b:
+        with worker_b.websocket_connect("/ws?room=ci") as ws:
+            assert ws.receive_json()["type"] == "history"
+            worker_a.post("/api/messages", json={"agent": "a", "room": "ci", "content": "one"})
+            worker_a.post(
+                "/api/messages/batch",
+                json=[
+                    {"agent": "a", "room": "other", "content": "elsewhere"},
+                    {"agent": "a", "room": "ci", "content": "two"},
+                    {"agent": "a", "room": "ci", "content": "three"},
+                ],
+            )
+            worker_b.post("/api/messages", json={"agent": "b", "room": "ci", "content": "four"})
+
+            seen = []
+            while len(seen) < 4:
+                frame = ws.receive_json()
+                data = frame["data"] if frame["type"] == "messages" else [frame["data"]]
+                seen.extend((m["id"], m["content"]) for m in data)
+            assert seen == [(1, "one"), (3, "two"), (4, "three"), (5, "four")]
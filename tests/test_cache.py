@@ -0,0 +1,49 @@
+﻿from app import db
+from app.cache import HistoryCache
+
+
+def _message(room, i):
+    return {"room": room, "agent": "codex", "kind": "status", "content": f"m{i}"}
+
+
+def test_cache_serves_recent_history_and_falls_back(tmp_path):
+    cache = HistoryCache(room_capacity=3, max_bytes=1 << 20)
+    engine = db.Engine(tmp_path / "test.sqlite3", cache=cache)
+    engine.start()
+    try:
+        engine.insert_messages([_message("a", i) for i in range(5)])
+
+        calls = []
+
+        def loader(room, limit):
+            calls.append(room)
+            return engine._load_recent(room, limit)
+
+        cache.ensure("a", loader)
+        cache.ensure("a", loader)
+        assert calls == ["a"]
+
+        engine.insert_message(_message("a", 5))
+        assert [m["content"] for m in cache.recent("a", 2)] == ["m4", "m5"]
+        assert [m["id"] for m in cache.page("a", 4, None, 10)] == [5, 6]
+        assert cache.page("a", 1, None, 10) is None
+        assert [m["id"] for m in cache.page("a", None, 6, 2, descending=True)] == [5, 4]
+        assert cache.page("a", None, 6, 3, descending=True) is None
+        assert [m["id"] for m in engine.fetch_messages("a", 10, 1)] == [2, 3, 4, 5, 6]
+    finally:
+        engine.close()
+
+
+def test_cache_evicts_least_recently_used_room():
+    cache = HistoryCache(room_capacity=10, max_bytes=1500)
+    for room, start in (("a", 1), ("b", 10)):
+        rows = [dict(_message(room, i), id=start + i) for i in range(2)]
+        cache.ensure(room, lambda _room, _limit, rows=rows: rows)
+    assert cache.recent("a", 2) is not None
+
+    cache.ensure("c", lambda _room, _limit: [dict(_message("c", 0), id=20)])
+    cache.append([dict(_message("c", i), id=21 + i) for i in range(2)])
+
+    assert cache.recent("b", 1) is None
+    assert cache.recent("a", 1) is not None
+    assert [m["id"] for m in cache.recent("c", 3)] == [20, 21, 22]
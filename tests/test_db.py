@@ -0,0 +1,135 @@
+﻿import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from app import db
+
+
+def test_engine_group_commit_returns_ids(tmp_path):
+    engine = db.Engine(tmp_path / "test.sqlite3", max_batch=16, max_wait=0.01)
+    engine.start()
+    try:
+        messages = [
+            {"room": "default", "agent": f"agent-{i}", "kind": "status", "content": str(i)}
+            for i in range(50)
+        ]
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            saved = list(pool.map(engine.insert_message, messages))
+
+        assert sorted(m["id"] for m in saved) == list(range(1, 51))
+        for message, row in zip(messages, saved):
+            assert row["content"] == message["content"]
+
+        fetched = engine.fetch_messages("default", 1000, None)
+        by_id = {row["id"]: row["content"] for row in fetched}
+        assert by_id == {row["id"]: row["content"] for row in saved}
+    finally:
+        engine.close()
+
+    assert engine.submit(messages[0]).exception() is not None
+
+
+def test_init_db_migrates_v1_schema(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            room TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX idx_messages_room_id ON messages(room, id);
+        INSERT INTO messages (ts, room, agent, kind, content) VALUES
+            ('2024-05-01T12:00:00.250000+00:00', 'ci', 'runner', 'status', 'build green'),
+            ('2024-05-01T12:00:01+00:00', 'ops', 'pager', 'alert', 'disk full'),
+            ('2024-05-01T12:00:02+00:00', 'ci', 'runner', 'status', 'deploy done');
+        DELETE FROM messages WHERE id = 3;
+        """
+    )
+    conn.commit()
+    conn.close()
+
+    db.init_db(path)
+    db.init_db(path)
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == db.SCHEMA_VERSION
+        assert conn.execute("SELECT typeof(ts) FROM messages LIMIT 1").fetchone()[0] == "integer"
+    assert db.fetch_messages(path, "ci", 10, None) == [
+        {
+            "id": 1,
+            "ts": "2024-05-01T12:00:00.250000+00:00",
+            "room": "ci",
+            "agent": "runner",
+            "kind": "status",
+            "content": "build green",
+        }
+    ]
+    assert db.insert_message(path, {"room": "ci", "agent": "a", "kind": "k", "content": "x"})["id"] == 4
+
+    engine = db.Engine(path)
+    engine.start()
+    try:
+        hits, _ = engine.search("disk", room="ops")
+        assert [hit["agent"] for hit in hits] == ["pager"]
+    finally:
+        engine.close()
+
+
+def _stats_tables(path):
+    with sqlite3.connect(path) as conn:
+        return {
+            table: sorted(conn.execute(f"SELECT * FROM {table}").fetchall())
+            for table in ("room_stats", "room_agent_stats", "room_kind_stats", "room_minute_stats")
+        }
+
+
+def test_stats_follow_writes_and_deletes(tmp_path):
+    path = tmp_path / "test.sqlite3"
+    engine = db.Engine(path)
+    engine.start()
+    try:
+        rows = [
+            ("ci", "bot", "status", "2026-01-01T10:00:05+00:00"),
+            ("ci", "bot", "error", "2026-01-01T10:00:30+00:00"),
+            ("ci", "dev", "status", "2026-01-01T10:01:00+00:00"),
+            ("ops", "bot", "status", None),
+        ]
+        engine.insert_messages(
+            [
+                {"room": room, "agent": agent, "kind": kind, "content": "x", "ts": ts}
+                for room, agent, kind, ts in rows
+            ]
+        )
+        assert [(r["room"], r["messages"], r["last_id"]) for r in engine.rooms()] == [
+            ("ci", 3, 3),
+            ("ops", 1, 4),
+        ]
+        stats = engine.room_stats("ci", minutes=1440)
+        assert stats["last_ts"] == "2026-01-01T10:01:00+00:00"
+        assert [(a["agent"], a["messages"], a["last_id"]) for a in stats["agents"]] == [
+            ("bot", 2, 2),
+            ("dev", 1, 3),
+        ]
+        assert {k["kind"]: k["messages"] for k in stats["kinds"]} == {"status": 2, "error": 1}
+        assert [m["messages"] for m in engine.room_stats("ops")["per_minute"]] == [1]
+        assert engine.room_stats("nowhere") is None
+
+        room_id = engine.run_write(
+            lambda conn: conn.execute("SELECT id FROM rooms WHERE name = 'ci'").fetchone()[0]
+        ).result()
+        engine.run_write(lambda conn: db.delete_range(conn, room_id, 1, 2)).result()
+        stats = engine.room_stats("ci")
+        assert (stats["messages"], stats["last_id"]) == (1, 3)
+        assert [a["agent"] for a in stats["agents"]] == ["dev"]
+        assert [k["kind"] for k in stats["kinds"]] == ["status"]
+    finally:
+        engine.close()
+
+    maintained = _stats_tables(path)
+    with sqlite3.connect(path) as conn:
+        db.rebuild_stats(conn)
+    assert _stats_tables(path) == maintained
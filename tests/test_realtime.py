@@ -0,0 +1,235 @@
+﻿import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import create_app
+from app.realtime import MSGPACK_SUBPROTOCOL, BurstCoalescer, Client, ConnectionManager
+
+
+def _message(i):
+    return {"type": "message", "data": {"id": i, "room": "ci", "content": str(i)}}
+
+
+def test_stalled_watcher_does_not_block_others():
+    async def scenario():
+        manager = ConnectionManager(max_queue=4, policy="drop_oldest")
+        stalled = asyncio.Event()
+        received = []
+
+        async def stuck(frame):
+            await stalled.wait()
+
+        async def healthy(frame):
+            received.append(frame.payload["data"]["id"])
+
+        slow, fast = Client(stuck, max_queue=4, policy="drop_oldest"), Client(healthy)
+        manager.register("ci", slow)
+        manager.register("ci", fast)
+        for i in range(1, 11):
+            manager.broadcast("ci", _message(i))
+        await asyncio.sleep(0.01)
+        assert received == list(range(1, 11))
+        assert slow.queued == 3 and slow.dropped == 6
+        await manager.unregister(slow)
+        await manager.unregister(fast)
+
+    asyncio.run(scenario())
+
+
+def test_overflow_policies():
+    async def scenario():
+        gate = asyncio.Event()
+        sent, closed = [], []
+
+        async def send(frame):
+            await gate.wait()
+            sent.append(frame.payload)
+
+        async def close(code, reason):
+            closed.append(code)
+
+        coalescing = Client(send, max_queue=3, policy="coalesce")
+        coalescing.start()
+        coalescing.enqueue(_message(1))
+        await asyncio.sleep(0)
+        for i in range(2, 9):
+            coalescing.enqueue(_message(i))
+        assert coalescing.queued == 1
+        assert coalescing.dropped == 4
+        gate.set()
+        await asyncio.sleep(0.01)
+        assert sent[1] == {"type": "messages", "data": [_message(i)["data"] for i in (6, 7, 8)]}
+        await coalescing.stop()
+
+        gate.clear()
+        sent.clear()
+        evicting = Client(send, close, max_queue=2, policy="disconnect")
+        evicting.start()
+        evicting.enqueue(_message(1))
+        await asyncio.sleep(0)
+        for i in range(2, 6):
+            evicting.enqueue(_message(i))
+        gate.set()
+        await asyncio.sleep(0.01)
+        assert sent[-1] == {
+            "type": "resync",
+            "reason": "slow consumer",
+            "last_id": 1,
+            "last_ids": {"ci": 1},
+        }
+        assert closed == [1013] and evicting.closed
+
+    asyncio.run(scenario())
+
+
+def test_broadcast_encodes_once_for_all_watchers():
+    async def scenario():
+        manager = ConnectionManager()
+        wire = []
+
+        async def send(frame):
+            wire.append(frame.encode("json"))
+
+        clients = [Client(send) for _ in range(3)]
+        for client in clients:
+            manager.register("ci", client)
+        manager.broadcast("ci", _message(1))
+        await asyncio.sleep(0.01)
+        assert len(wire) == 3
+        assert wire[0] is wire[1] is wire[2]
+        assert json.loads(wire[0]) == _message(1)
+        for client in clients:
+            await manager.unregister(client)
+
+    asyncio.run(scenario())
+
+
+def test_websocket_msgpack_subprotocol(tmp_path):
+    msgpack = pytest.importorskip("msgpack")
+    app = create_app(db_path=tmp_path / "test.sqlite3")
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws?room=ci", subprotocols=[MSGPACK_SUBPROTOCOL]) as ws:
+            assert ws.accepted_subprotocol == MSGPACK_SUBPROTOCOL
+            assert msgpack.unpackb(ws.receive_bytes()) == {"type": "history", "data": [], "room": "ci"}
+            client.post("/api/messages", json={"agent": "ci", "room": "ci", "content": "hi"})
+            frame = msgpack.unpackb(ws.receive_bytes())
+            assert frame["type"] == "message" and frame["data"]["content"] == "hi"
+
+        with client.websocket_connect("/ws?room=ci&format=msgpack") as ws:
+            history = msgpack.unpackb(ws.receive_bytes())
+            assert [m["content"] for m in history["data"]] == ["hi"]
+
+
+def test_subscription_filters_only_touch_matching_watchers():
+    async def scenario():
+        manager = ConnectionManager()
+        received = {"all": [], "errors": [], "bob": []}
+
+        def recorder(name):
+            async def send(frame):
+                data = frame.payload["data"]
+                received[name].extend(m["id"] for m in (data if isinstance(data, list) else [data]))
+
+            return send
+
+        everything, errors, bob = (Client(recorder(name)) for name in ("all", "errors", "bob"))
+        for client in (everything, errors, bob):
+            client.start()
+        manager.subscribe(everything, "ci")
+        manager.subscribe(errors, "ci", kinds=["error"])
+        manager.subscribe(errors, "ops", kinds=["error"])
+        manager.subscribe(bob, "ci", agents=["bob"], kinds=["status", "error"])
+        batch = [
+            {"id": 1, "room": "ci", "agent": "ci", "kind": "status", "content": ""},
+            {"id": 2, "room": "ci", "agent": "bob", "kind": "error", "content": ""},
+            {"id": 3, "room": "ci", "agent": "bob", "kind": "status", "content": ""},
+        ]
+        manager.broadcast("ci", {"type": "messages", "data": batch})
+        alert = {"id": 1, "room": "ops", "agent": "x", "kind": "error", "content": ""}
+        manager.broadcast("ops", {"type": "message", "data": alert})
+        manager.unsubscribe(errors, "ci")
+        manager.broadcast("ci", {"type": "messages", "data": [{**batch[1], "id": 4}]})
+        await asyncio.sleep(0.01)
+        assert received == {"all": [1, 2, 3, 4], "errors": [2, 1], "bob": [2, 3, 4]}
+        for client in (everything, errors, bob):
+            await manager.unregister(client)
+        assert manager._index == {}
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_keeps_control_frames_in_place():
+    async def scenario():
+        sent = []
+        closed = []
+        gate = asyncio.Event()
+
+        async def send(frame):
+            await gate.wait()
+            sent.append(frame.payload)
+
+        async def close(code, reason):
+            closed.append(code)
+
+        client = Client(send, close, max_queue=5, policy="coalesce")
+        client.start()
+        client.enqueue(_message(1))
+        await asyncio.sleep(0)
+        client.enqueue(_message(2))
+        client.enqueue(_message(3))
+        client.enqueue({"type": "ack", "ref": "a", "ids": [3]})
+        client.enqueue(_message(4))
+        client.enqueue({"type": "subscribed", "room": "ops"})
+        client.enqueue(_message(5))
+        assert client.queued == 5 and client.dropped == 0
+        gate.set()
+        await asyncio.sleep(0.01)
+        assert sent == [
+            _message(1),
+            {"type": "messages", "data": [_message(i)["data"] for i in (2, 3)]},
+            {"type": "ack", "ref": "a", "ids": [3]},
+            _message(4),
+            {"type": "subscribed", "room": "ops"},
+            _message(5),
+        ]
+        await client.stop()
+
+        # Control frames alone overflowing the queue: evict rather than drop one.
+        gate.clear()
+        sent.clear()
+        client = Client(send, close, max_queue=2, policy="coalesce")
+        client.start()
+        client.enqueue(_message(1))
+        await asyncio.sleep(0)
+        for ref in range(3):
+            client.enqueue({"type": "ack", "ref": ref, "ids": []})
+        gate.set()
+        await asyncio.sleep(0.01)
+        assert [frame["type"] for frame in sent] == ["message", "resync"]
+        assert closed == [1013]
+
+    asyncio.run(scenario())
+
+
+def test_burst_coalescer_batches_within_window_and_cap():
+    async def scenario():
+        delivered = []
+        coalescer = BurstCoalescer(
+            lambda room, payload: delivered.append((room, payload)), window=0.02, max_messages=3
+        )
+        for i in range(1, 5):
+            coalescer.publish("ci", _message(i))
+        coalescer.publish("ops", {"type": "message", "data": {"id": 9, "room": "ops"}})
+        assert [[m["id"] for m in p["data"]] for _, p in delivered] == [[1, 2, 3]]
+        await asyncio.sleep(0.05)
+        assert delivered[1:] == [
+            ("ci", {"type": "message", "data": _message(4)["data"]}),
+            ("ops", {"type": "message", "data": {"id": 9, "room": "ops"}}),
+        ]
+        coalescer.publish("ci", _message(5))
+        coalescer.close()
+        assert delivered[-1] == ("ci", _message(5))
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+﻿from datetime import datetime, timedelta, timezone
+
+from app import db, retention
+from app.archive import ArchiveStore
+
+
+def test_retention_archives_and_history_still_reads(tmp_path):
+    archive = ArchiveStore(tmp_path / "archive")
+    engine = db.Engine(tmp_path / "test.sqlite3", archive=archive)
+    engine.start()
+    try:
+        old = (datetime.now(timezone.utc) - timedelta(days=10)).isoformat()
+        engine.insert_messages(
+            [
+                {"room": "ci", "agent": "ci", "kind": "status", "content": f"old {i}", "ts": old}
+                for i in range(3)
+            ]
+            + [{"room": "ci", "agent": "ci", "kind": "status", "content": f"new {i}"} for i in range(4)]
+        )
+        policies = {"ci": {"max_age": 86400.0, "max_rows": 3}}
+
+        assert retention.run_once(engine, policies) == {"ci": 4}
+
+        with engine.reader() as conn:
+            remaining = [row[0] for row in conn.execute("SELECT id FROM messages ORDER BY id")]
+            assert remaining == [5, 6, 7]
+            assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert archive.last_id("ci") == 4
+
+        history = engine.fetch_messages("ci", 5, None)
+        assert [m["id"] for m in history] == [1, 2, 3, 4, 5]
+        assert [m["id"] for m in engine.fetch_messages("ci", 10, 2)] == [3, 4, 5, 6, 7]
+        assert [m["content"] for m in engine.fetch_recent("ci", 2)] == ["new 2", "new 3"]
+        backwards = engine.fetch_messages("ci", 5, None, before_id=7, order="desc")
+        assert [m["id"] for m in backwards] == [6, 5, 4, 3, 2]
+        assert [m["id"] for m in engine.fetch_messages("ci", 5, 1, before_id=4)] == [2, 3]
+
+        assert retention.run_once(engine, policies) == {}
+    finally:
+        engine.close()
+
+
+def test_retention_across_processes(tmp_path):
+    """A second worker sees segments it did not write, and waits for the lease."""
+    path = tmp_path / "test.sqlite3"
+    engine = db.Engine(path, archive=ArchiveStore(tmp_path / "archive"))
+    other = db.Engine(path, archive=ArchiveStore(tmp_path / "archive"))
+    engine.start()
+    other.start()
+    try:
+        engine.insert_messages(
+            [{"room": "ci", "agent": "ci", "kind": "status", "content": f"m{i}"} for i in range(6)]
+        )
+        policies = {"ci": {"max_age": None, "max_rows": 2}}
+        assert [m["id"] for m in other.fetch_messages("ci", 10, None)] == [1, 2, 3, 4, 5, 6]
+
+        held = other.run_write(lambda conn: db.take_lease(conn, "retention", "elsewhere", 60))
+        assert held.result()
+        assert retention.run_once(engine, policies) == {}
+        other.run_write(lambda conn: db.release_lease(conn, "retention", "elsewhere")).result()
+
+        assert retention.run_once(engine, policies) == {"ci": 4}
+        assert other.archive.last_id("ci") == 4
+        assert [m["id"] for m in other.fetch_messages("ci", 10, None)] == [1, 2, 3, 4, 5, 6]
+    finally:
+        engine.close()
+        other.close()
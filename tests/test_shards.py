@@ -0,0 +1,46 @@
+﻿import pytest
+
+from app import db
+from app.shards import ShardedEngine, shard_for, split_database
+
+
+def test_split_database_and_sharded_reads(tmp_path):
+    source = tmp_path / "hub.sqlite3"
+    db.init_db(source)
+    rooms = ["alpha", "beta", "gamma", "delta"]
+    for i in range(20):
+        room = rooms[i % len(rooms)]
+        db.insert_message(source, {"room": room, "agent": "ci", "kind": "status", "content": f"build {i}"})
+
+    shard_dir = tmp_path / "hub"
+    counts = split_database(source, shard_dir, 3, {"alpha": 2})
+    assert sum(counts) == 20
+    assert shard_for("alpha", 3, {"alpha": 2}) == 2
+
+    engine = ShardedEngine(shard_dir, 3, shard_map={"alpha": 2})
+    engine.start()
+    try:
+        assert [m["id"] for m in engine.fetch_messages("beta", 10, None)] == [2, 6, 10, 14, 18]
+
+        saved = engine.insert_messages(
+            [{"room": room, "agent": "ci", "kind": "status", "content": "build again"} for room in rooms]
+        )
+        assert [m["room"] for m in saved] == rooms
+        for message in saved:
+            history = engine.fetch_messages(message["room"], 10, None, order="desc")
+            assert history[0]["id"] == message["id"]
+            assert history[1]["id"] < message["id"]
+
+        seen = []
+        after = None
+        while True:
+            hits, after = engine.search("build", order="recent", after=after, limit=7)
+            seen.extend((hit["room"], hit["id"]) for hit in hits)
+            if after is None:
+                break
+        assert len(seen) == len(set(seen)) == 24
+    finally:
+        engine.close()
+
+    with pytest.raises(RuntimeError):
+        ShardedEngine(shard_dir, 4).start()
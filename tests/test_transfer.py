@@ -0,0 +1,123 @@
+﻿import io
+import sqlite3
+
+import pytest
+
+from app import db, transfer
+
+
+def _seed(path, count):
+    db.init_db(path)
+    for i in range(count):
+        room = "ci" if i % 2 else "ops"
+        db.insert_message(
+            path, {"room": room, "agent": "bot", "kind": "status", "content": f"deploy {i}"}
+        )
+
+
+def test_export_import_round_trip(tmp_path):
+    source = tmp_path / "source.sqlite3"
+    _seed(source, 10)
+
+    out = io.BytesIO()
+    exported = list(db.iter_messages(source, rooms=["ci"], before_id=9))
+    assert transfer.export_messages(exported, out, chunk=3) == 4
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 4
+
+    restored = tmp_path / "restored.sqlite3"
+    report = transfer.import_messages([restored], [("ci.ndjson", lines)], keep_ids=True)
+    assert (report.imported, report.first_id, report.last_id) == (4, 2, 8)
+    assert list(db.iter_messages(restored)) == exported
+
+    conn = sqlite3.connect(restored)
+    try:
+        indexes = conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        assert ("idx_messages_room_id",) in indexes
+        hits = conn.execute(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'deploy'"
+        ).fetchall()
+        assert sorted(row[0] for row in hits) == [2, 4, 6, 8]
+    finally:
+        conn.close()
+
+    with pytest.raises(ValueError, match="not empty"):
+        transfer.import_messages([restored], [("ci.ndjson", lines)], keep_ids=True)
+
+
+def test_import_remaps_ids_and_skips_invalid_lines(tmp_path):
+    target = tmp_path / "target.sqlite3"
+    _seed(target, 3)
+    lines = [
+        b'{"id": 1, "ts": "2025-01-01T00:00:00+00:00", "room": "ci", "agent": "a",'
+        b' "content": "old"}',
+        b"",
+        b'{"room": "ci", "content": "no agent"}',
+        b"not json",
+        b'{"id": 2, "room": "ci", "agent": "b", "content": "newer"}',
+    ]
+    report = transfer.import_messages([target], [("in.ndjson", lines)], batch_size=1)
+    assert (report.imported, report.first_id, report.last_id) == (2, 4, 5)
+    assert report.rejected == 2 and [r[1] for r in report.reasons] == [3, 4]
+
+    rows = list(db.iter_messages(target, after_id=3))
+    assert [row["content"] for row in rows] == ["old", "newer"]
+    assert rows[0]["ts"] == "2025-01-01T00:00:00+00:00"
+
+    engine = db.Engine(target)
+    engine.start()
+    try:
+        hits, _ = engine.search("newer")
+        assert [hit["id"] for hit in hits] == [5]
+    finally:
+        engine.close()
+
+
+def test_import_refuses_a_database_in_use(tmp_path):
+    target = tmp_path / "target.sqlite3"
+    engine = db.Engine(target)
+    engine.start()
+    try:
+        engine.insert_messages([{"room": "ci", "agent": "a", "kind": "status", "content": "x"}])
+        line = b'{"room": "ci", "agent": "b", "content": "imported"}'
+        with pytest.raises(ValueError, match="in use"):
+            transfer.import_messages([target], [("in.ndjson", [line])])
+        assert [m["content"] for m in engine.fetch_recent("ci", 10)] == ["x"]
+    finally:
+        engine.close()
+    report = transfer.import_messages([target], [("in.ndjson", [line])])
+    assert report.imported == 1
+
+
+def test_import_keeping_ids_rejects_repeats(tmp_path):
+    target = tmp_path / "target.sqlite3"
+    lines = [
+        f'{{"id": {ident}, "room": "ci", "agent": "a", "content": "deploy {n}"}}'.encode()
+        for n, ident in enumerate([1, 2, 3, 2, 5, 4, 1])
+    ]
+    report = transfer.import_messages([target], [("in.ndjson", lines)], keep_ids=True, batch_size=2)
+    assert (report.imported, report.rejected) == (5, 2)
+    assert [(r[1], r[2]) for r in report.reasons] == [
+        (4, "id: 2 is already taken"),
+        (7, "id: 1 is already taken"),
+    ]
+    conn = sqlite3.connect(target)
+    try:
+        hits = conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'deploy'")
+        assert sorted(row[0] for row in hits) == [1, 2, 3, 4, 5]
+    finally:
+        conn.close()
+
+
+def test_import_keeping_ids_refuses_a_purged_database(tmp_path):
+    target = tmp_path / "target.sqlite3"
+    _seed(target, 2)
+    conn = sqlite3.connect(target)
+    conn.execute("DELETE FROM messages")
+    conn.commit()
+    conn.close()
+    line = b'{"id": 1, "room": "ci", "agent": "a", "content": "reused"}'
+    with pytest.raises(ValueError, match="not empty"):
+        transfer.import_messages([target], [("in.ndjson", [line])], keep_ids=True)
+    report = transfer.import_messages([target], [("in.ndjson", [line])])
+    assert report.first_id == 3